@@ -1,45 +1,47 @@
 import collections
+import io
 import json
-import os
-import re
 import textwrap
 from pathlib import Path
 from urllib.parse import parse_qs
 
 import click
 import genson
+from apiutils import apicache
+from apiutils import apiindex
+from apiutils import apireader
+from apiutils import apistore
+from apiutils import apiwatch
+from apiutils import jsonlib
 from apiutils import util
 
 
-class HTTPMessage(object):
-    headers = dict()
-    body = b''
-    decoded_body = ''
-    simplified_body = ''
-    schema = None
-
-    def parse_body(self, keep_list_item):
-        self.decoded_body = util.decode_body(self.headers, self.body)
+class HTTPMessage(apireader.HTTPMessage):
+    def parse_body(self, keep_list_item, max_body_size=0):
+        self.decoded_body = util.decode_body(self.headers, self.body, max_body_size)
 
+        # 简化数据，只保留部分数据，并保存数据 Schema 以供比较。
+        # 不是 JSON、嵌套太深（见 util.MAX_JSON_DEPTH）或者生成 Schema 出错时保留原文
         # noinspection PyBroadException
         try:
-            obj = json.loads(self.decoded_body)
+            obj = util.json_loads_simplified(self.decoded_body, keep_list_item, util.MAX_JSON_DEPTH)
+            simplified_body = jsonlib.dumps(obj)
+            schema = genson.Schema()
+            schema.add_object(obj)
+            schema = schema.to_schema()
         except:
             self.simplified_body = self.decoded_body
             return
 
-        # 简化数据，只保留部分数据
-        util.simplify(obj, keep_list_item)
-        self.simplified_body = json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
-
-        # 保存数据 Schema 以供比较
-        self.schema = genson.Schema()
-        self.schema.add_object(obj)
+        self.simplified_body = simplified_body
+        self.schema = schema
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            return self.schema.to_json(sort_keys=True) == other.schema.to_json(sort_keys=True)
-        return self.simplified_body == other.simplified_body
+    def body_key(self):
+        """比较 body 用的 key：有 schema 时比较 schema，否则比较简化后的 body
+        """
+        if self.schema:
+            return 'schema', jsonlib.dumps(self.schema)
+        return 'body', self.simplified_body
 
 
 class Request(HTTPMessage):
@@ -48,8 +50,8 @@ class Request(HTTPMessage):
         self.payload = payload
 
         self.request_line, raw_headers, self.body = util.http_split_message(payload)
-        self.raw_headers = util.hack_gor_real_ip(raw_headers)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.headers = util.http_parse_headers(raw_headers, real_ip=True)
+        self.raw_headers = util.http_headers_text(raw_headers, self.headers)
         self.method, self.url, self.version = self.request_line.split(' ')
 
         self.host = self.headers.get('host', 'n/a')
@@ -58,8 +60,8 @@ class Request(HTTPMessage):
     def __str__(self):
         return '%s %s' % (self.timestamp, self.request_line)
 
-    def like(self, other):
-        return self.method == other.method and self.compare_body(other)
+    def key(self):
+        return self.method, self.body_key()
 
 
 class Response(HTTPMessage):
@@ -74,21 +76,20 @@ class Response(HTTPMessage):
     def __str__(self):
         return '%s %s' % (self.latency, self.response_line)
 
-    def like(self, other):
-        return self.response_line == other.response_line and self.compare_body(other)
+    def key(self):
+        return self.response_line, self.code_key(), self.body_key()
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            # !!! 这里已经深入 API 数据内部，不再是通用的代码
-            # 如果 Response 中的 code 不同则认为不同
-            data = json.loads(self.simplified_body)
+    def code_key(self):
+        # !!! 这里已经深入 API 数据内部，不再是通用的代码
+        # 如果 Response 中的 code 不同则认为不同（schema 相同时，要么都有 code，要么都没有）
+        if self.schema:
+            data = jsonlib.loads(self.simplified_body)
             if isinstance(data, dict) and 'code' in data:
-                other_data = json.loads(other.simplified_body)
-                if isinstance(other_data, dict) and 'code' in other_data:
-                    if data['code'] != other_data['code']:
-                        return False
-
-        return super().compare_body(other)
+                code = data['code']
+                if isinstance(code, (dict, list)):
+                    return 'json', jsonlib.dumps(code)
+                return 'code', code
+        return None
 
 
 class ApiSession(object):
@@ -102,8 +103,10 @@ class ApiSession(object):
 
         self.parameters = parse_qs(request.query)
 
-    def like(self, other):
-        return self.request.like(other.request) and self.response.like(other.response)
+    def key(self):
+        """request 和 response 的 key 都相同的 session 认为是重复的
+        """
+        return self.request.key(), self.response.key()
 
 
 class Api:
@@ -113,14 +116,22 @@ class Api:
 
     def __init__(self):
         self.sessions = []
+        # 已有 session 的 key（ApiSession.key），用来去重
+        self.keys = set()
         self.parameters = collections.OrderedDict()
+        # 参数名 -> 各个 session（包括重复的）中参数的值，用来推断参数的类型
+        self.values = collections.OrderedDict()
 
     def add_session(self, session):
+        for name, values in session.parameters.items():
+            self.values.setdefault(name, []).extend(values)
+
         # 检查是不是和原来的 session 重复
-        for s in self.sessions:
-            if s.like(session):
-                return
+        key = session.key()
+        if key in self.keys:
+            return
 
+        self.keys.add(key)
         self.sessions.append(session)
         if self.path is None:
             self.path = session.request.path
@@ -138,12 +149,23 @@ class Api:
 
 
 class ApiBlue(object):
-    def __init__(self, title, host, keep_list_item, data_dir, output):
+    def __init__(self, title, host, keep_list_item, data_dir, output, max_body_size=0, jobs=1, cache_file=None,
+                 filters=(), index_file=None, update_index=False):
         self.title = title
         self.host = host
         self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
         self.data_dir = data_dir
+        self.store = apistore.ApiStore(data_dir)
+        self.filters = filters
+        self.index_file = index_file
+        self.update_index = update_index
+        # output 为打开的文件（生成一次时）或文件名（监视时不打开，只用 atomic_write 替换整个文件）
         self.output = output
+        self.output_name = output if isinstance(output, str) else output.name
+        cache = apicache.ParseCache(cache_file, 'apiblue', keep_list_item, max_body_size) if cache_file else None
+        self.loader = apireader.SessionLoader(
+            self.store, keep_list_item, max_body_size, Request, Response, ApiSession, jobs, cache)
 
     def write(self, data):
         if isinstance(data, bytes):
@@ -154,60 +176,98 @@ class ApiBlue(object):
     def run(self):
         self.write_header()
 
-        for root, _, files in os.walk(self.data_dir):
-            apifiles = [fn for fn in files if fn.endswith('.api')]
-            if not apifiles:
-                continue
-            # noinspection PyTypeChecker
-            self.write_group(Path(root), apifiles)
+        groups = apiindex.walk_apis(self.store, self.filters, self.index_file, self.update_index)
+        with self.loader:
+            self.loader.prefetch(groups)
+            for root, apis in groups:
+                # noinspection PyTypeChecker
+                self.write_group(Path(root), apis)
+            if not self.filters:
+                self.loader.prune(groups)
+
+    def watch(self, interval):
+        """每 interval 秒检查一次数据目录，只重新生成有变化的 API，再替换整个输出文件
+        """
+        watcher = apiwatch.ApiWatcher(self.store, self.loader, self.filters, self.index_file)
+        watcher.run(interval, self.process_api, self.write_apis)
+
+    def process_api(self, root, apiname, filenames):
+        """返回 write_api 输出的内容
+        """
+        output, self.output = self.output, io.BytesIO()
+        try:
+            self.write_api(Path(root), apiname, filenames)
+            return self.output.getvalue()
+        finally:
+            self.output = output
+
+    def write_apis(self, groups, apis):
+        output, self.output = self.output, io.BytesIO()
+        try:
+            self.write_header()
+            for root, names in groups:
+                self.write('# Group %s\n\n' % Path(root))
+                for name in names:
+                    self.write(apis[root, name])
+            util.atomic_write(self.output_name, self.output.getvalue())
+        finally:
+            self.output = output
 
     def write_header(self):
         self.write('FORMAT: 1A\n')
         self.write('HOST: %s\n\n' % self.host)
         self.write('# %s\n\n' % self.title)
 
-    def write_group(self, root, apifiles):
+    def write_group(self, root, apis):
         self.write('# Group %s\n\n' % root)
-        apis = collections.OrderedDict()
-
-        # 按名称分组
-        for filename in apifiles:
-            name = re.sub(r'^[\d_]+-(.*?)\.api', r'\1', filename)
-            apis.setdefault(name, []).append(filename)
-
         for name, filenames in apis.items():
             self.write_api(root, name, filenames)
 
     def write_api(self, root, apiname, filenames):
-        api = Api()
-        for filename in filenames:
-            api.add_session(self.read_session(root / filename))
-
-        self.write('## %s [%s]\n\n' % (apiname, api.path))
-        last_method = None
-        for seq_no, session in enumerate(api.sessions, 1):
-            if last_method != session.method:
-                self.write('### %s %s [%s %s]\n\n' % (
-                    session.method, apiname, session.method, api.url_template))
-                self.write_parameters(api.parameters)
-                last_method = session.method
-            if len(api.sessions) > 1:
-                self.write_session(session, seq_no)
-            else:
-                self.write_session(session)
+        # session 中的 payload 和 body 只在 with 中有效
+        with self.loader.load([root / filename for filename in filenames]) as sessions:
+            api = Api()
+            for session in sessions:
+                api.add_session(session)
+
+            self.write('## %s [%s]\n\n' % (apiname, api.path))
+            last_method = None
+            for seq_no, session in enumerate(api.sessions, 1):
+                if last_method != session.method:
+                    self.write('### %s %s [%s %s]\n\n' % (
+                        session.method, apiname, session.method, api.url_template))
+                    self.write_parameters(api.parameters, api.values)
+                    last_method = session.method
+                if len(api.sessions) > 1:
+                    self.write_session(session, seq_no)
+                else:
+                    self.write_session(session)
 
     def write_session(self, session, seq_no=None):
         self.write_request(session.request, seq_no)
         self.write_response(session.response)
 
-    def write_parameters(self, parameters):
+    def write_parameters(self, parameters, values):
         if not parameters:
             return
         self.write('+ Parameters\n')
         for name, value in parameters.items():
             if len(value) == 1:
                 value = value[0]
-            self.write('    + `%s`: `%s` (string)\n' % (name, value))
+            value_type = util.infer_type(values[name])
+            # API Blueprint 中没有 integer
+            type_name = 'number' if value_type.type == 'integer' else value_type.type
+            if value_type.enum:
+                type_name = 'enum[%s]' % type_name
+            if not value_type.enum and value_type.minimum != value_type.maximum:
+                self.write('    + `%s`: `%s` (%s) - %s ~ %s\n' % (
+                    name, value, type_name, value_type.minimum, value_type.maximum))
+            else:
+                self.write('    + `%s`: `%s` (%s)\n' % (name, value, type_name))
+            if value_type.enum:
+                self.write('        + Members\n')
+                for member in value_type.enum:
+                    self.write('            + `%s`\n' % (member if isinstance(member, str) else json.dumps(member)))
         self.write('\n')
 
     def write_request(self, request, seq_no=None):
@@ -236,64 +296,32 @@ class ApiBlue(object):
         self.write('    + Body\n\n')
         self.write(textwrap.indent(body, '            '))
 
-    def read_session(self, apifile):
-        fp = apifile.open('rb')
-
-        # API Headers
-        headers = self.read_headers(fp)
-        timestamp = headers.get('request-time', 'N/A')
-        latency = headers.get('latency', 'N/A')
-
-        # Request
-        line = fp.readline()
-        if not line.startswith(b'Request '):
-            print('API 文件格式错误(1):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        request = Request(timestamp, payload)
-        request.parse_body(self.keep_list_item)
-
-        # Skip empty line
-        line = fp.readline()
-        if line != b'\r\n':
-            print('API 文件格式错误(2):', fp.name)
-            return
-
-        # Response
-        line = fp.readline()
-        if not line.startswith(b'Response '):
-            print('API 文件格式错误(3):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        response = Response(latency, payload)
-        response.parse_body(self.keep_list_item)
-
-        return ApiSession(request, response)
-
-    @staticmethod
-    def read_headers(fp):
-        headers = {}
-        for line in fp:
-            if line == b'\r\n':
-                break
-            name, _, value = line.decode().partition(':')
-            headers[name.lower()] = value.strip()
-        return headers
-
 
 @click.command()
 @click.option('--title', '-t', default='API', help='API 标题.')
 @click.option('--host', '-h', default='http://{host}', help='API 主机.')
 @click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
 @click.option('--data-dir', '-d', default='.', help='API 数据文件目录.')
-@click.option('--output', '-o', default='api.apib', type=click.File('wb'), help='API Blueprint 文件名.')
-def run(title, host, keep_list_item, data_dir, output):
-    apiblue = ApiBlue(title, host, keep_list_item, data_dir, output)
-    apiblue.run()
+@click.option('--max-body-size', '-m', default=64, help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制）.')
+@click.option('--output', '-o', default='api.apib', help='API Blueprint 文件名.')
+@click.option('--jobs', '-j', default=1, help='读取 API 数据文件的进程数（0 表示 CPU 数）.')
+@click.option('--cache', '-c', default=None, help='解析结果的缓存文件（SQLite），没有变化的 API 数据文件直接使用缓存.')
+@click.option('--filter', '-F', 'filters', multiple=True, help='过滤条件，只使用索引中符合条件的 session（允许指定多个）.')
+@click.option('--index', '-i', default=None, help='索引文件名（默认为数据目录下的 apiindex.db）.')
+@click.option('--update-index', '-U', is_flag=True, help='使用索引前先更新（默认只在没有索引时建立）.')
+@click.option('--watch', '-w', default=0, help='每隔多少秒检查一次数据目录，增量更新输出文件（0 表示只生成一次）.')
+def run(title, host, keep_list_item, data_dir, max_body_size, output, jobs, cache, filters, index, update_index,
+        watch):
+    if watch:
+        if output == '-':
+            raise click.BadParameter('监视时不能输出到 stdout', param_hint='--output')
+        # 监视时不打开（截断）原来的输出文件，有变化时再整个替换
+        ApiBlue(title, host, keep_list_item, data_dir, output, max_body_size << 20, jobs, cache,
+                filters, index, update_index).watch(watch)
+    else:
+        with click.open_file(output, 'wb') as fp:
+            ApiBlue(title, host, keep_list_item, data_dir, fp, max_body_size << 20, jobs, cache,
+                    filters, index, update_index).run()
 
 
 if __name__ == "__main__":
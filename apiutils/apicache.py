@@ -0,0 +1,105 @@
+"""解析结果的缓存：保存每个 API 数据文件解析后的 session（简化后的 body、schema、header 等），
+数据文件没有变化时直接使用，不用再解码、简化 body 和生成 schema
+
+缓存是一个 SQLite 文件，每个工具（apiblue、apiman、apiswagger）的缓存分开保存。
+
+* 数据文件按绝对路径查找，ApiStore.signature（.api 文件的大小和修改时间、segment 记录所在的文件和位置）
+  不同时认为文件变了
+* 工具的版本、keep_list_item 或 max_body_size 不同时，这个工具原来的缓存全部作废
+* 没有过滤条件时，生成文档以后删除已经不存在的文件（删除或改名了）的缓存，见 prune
+
+session 用 apireader.dump_session 转成 bytes 后保存。
+"""
+import os
+import sqlite3
+
+import apiutils
+
+# 缓存的格式改变时加 1，原来的缓存全部作废
+CACHE_FORMAT = 1
+
+# 每写入这么多个 session 提交一次，其他进程也在用同一个缓存文件时不必等太久
+COMMIT_INTERVAL = 1000
+
+
+class ParseCache(object):
+    def __init__(self, filename, tool, keep_list_item, max_body_size):
+        self.filename = filename
+        self.tool = tool
+        self.params = '%s/%d keep_list_item=%d max_body_size=%d' % (
+            apiutils.__version__, CACHE_FORMAT, keep_list_item, max_body_size)
+        self.hits = 0
+        self.misses = 0
+        self.removed = 0
+        self.pending = 0
+
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                tool TEXT NOT NULL,
+                path TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                params TEXT NOT NULL,
+                session BLOB NOT NULL,
+                PRIMARY KEY (tool, path)
+            )''')
+        self.db.execute('DELETE FROM sessions WHERE tool = ? AND params != ?', (self.tool, self.params))
+        self.db.commit()
+        # 路径 -> signature，只在需要时才读取 session
+        self.signatures = dict(self.db.execute('SELECT path, signature FROM sessions WHERE tool = ?', (self.tool,)))
+
+    @staticmethod
+    def key(apifile):
+        return os.path.abspath(str(apifile))
+
+    def contains(self, apifile, signature):
+        return self.signatures.get(self.key(apifile)) == signature
+
+    def get(self, apifile, signature):
+        """返回保存的 session（bytes），没有或者文件变了时返回 None
+        """
+        key = self.key(apifile)
+        data = None
+        if self.signatures.get(key) == signature:
+            row = self.db.execute('SELECT session FROM sessions WHERE tool = ? AND path = ?',
+                                  (self.tool, key)).fetchone()
+            if row is not None:
+                data = row[0]
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, apifile, signature, data):
+        key = self.key(apifile)
+        self.db.execute('INSERT OR REPLACE INTO sessions (tool, path, signature, params, session) '
+                        'VALUES (?, ?, ?, ?, ?)', (self.tool, key, signature, self.params, data))
+        self.signatures[key] = signature
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def prune(self, apifiles):
+        """删除这个工具中不在 apifiles（数据目录中所有的文件）里的文件的缓存
+        """
+        existing = set(map(self.key, apifiles))
+        removed = [key for key in self.signatures if key not in existing]
+        self.db.executemany('DELETE FROM sessions WHERE tool = ? AND path = ?', ((self.tool, key) for key in removed))
+        for key in removed:
+            del self.signatures[key]
+        self.removed += len(removed)
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def __str__(self):
+        return 'cache: %d hits, %d misses, %d removed' % (self.hits, self.misses, self.removed)
@@ -2,88 +2,985 @@
 说明： Goreplay 中 Response 的 timestamp 和 Request 一样，不必要特别记录和处理
 """
 
+import asyncio
 import binascii
 import collections
 import fnmatch
+import functools
+import heapq
 import logging
+import multiprocessing
 import os
+import re
+import signal
+import stat
 import sys
+import time
+import zlib
 from pathlib import Path
+from queue import Full
+from pathlib import PurePosixPath
 
 import apiutils
 import click
+from apiutils import apistore
 from apiutils import util
 
 
-class Request(object):
+class HTTPMessage(object):
+    """HTTP 消息，只分析第一行，Header 和 body 用到时再分析
+    """
+    __slots__ = ('payload', 'line_end', '_header_end', '_raw_headers', '_headers', '_body_headers')
+    # 是否转换 gor 的 X-Real-IP
+    real_ip = False
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.line_end = payload.find(b'\r\n')
+        if self.line_end < 0:
+            self.line_end = len(payload)
+        self._header_end = None
+        self._raw_headers = None
+        self._headers = None
+        self._body_headers = None
+
+    @property
+    def first_line(self):
+        return self.payload[:self.line_end].decode(errors='replace')
+
+    @property
+    def header_end(self):
+        if self._header_end is None:
+            end = self.payload.find(b'\r\n\r\n', self.line_end + 2)
+            self._header_end = end if end >= 0 else len(self.payload)
+        return self._header_end
+
+    @property
+    def header_block(self):
+        return self.payload[self.line_end + 2:self.header_end]
+
+    @property
+    def raw_headers(self):
+        if self._raw_headers is None:
+            self._raw_headers = util.http_headers_text(self.header_block, self.headers if self.real_ip else None)
+        return self._raw_headers
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = util.http_parse_headers(self.header_block, real_ip=self.real_ip)
+        return self._headers
+
+    @property
+    def body_headers(self):
+        """解码 body 用到的 Header，只分析这几个
+        """
+        if self._headers is not None:
+            return self._headers
+        if self._body_headers is None:
+            self._body_headers = util.http_parse_headers(self.header_block, util.BODY_HEADERS)
+        return self._body_headers
+
+    @property
+    def body(self):
+        return self.payload[self.header_end + 4:]
+
+
+class Request(HTTPMessage):
+    __slots__ = ('timestamp', 'request_line', 'method', 'url', 'version', 'host', 'path', 'query')
+    real_ip = True
+
     def __init__(self, timestamp, payload):
+        super().__init__(payload)
         self.timestamp = round(int(timestamp) / 1000000000, 3)
-        self.payload = payload
 
-        self.request_line, raw_headers, self.body = util.http_split_message(payload)
-        self.raw_headers = util.hack_gor_real_ip(raw_headers)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.request_line = self.first_line
         self.method, self.url, self.version = self.request_line.split(' ')
 
-        self.host = self.headers.get('host', 'n/a')
+        self.host = self.find_host()
         self.path, _, self.query = self.url.partition('?')
 
+    def find_host(self):
+        """不分析全部 Header，直接从原始数据中找出 Host
+        """
+        payload = self.payload
+        pos = payload.find(b'\r\nHost:', self.line_end, self.header_end + 2)
+        if pos >= 0:
+            start = pos + len(b'\r\nHost:')
+            end = payload.find(b'\r\n', start)
+            # 后面有续行时仍然分析全部 Header
+            if end >= 0 and payload[end + 2:end + 3] not in (b' ', b'\t'):
+                return payload[start:end].decode('iso-8859-1').strip()
+        return self.headers.get('host', 'n/a')
+
     def __str__(self):
         return '%s %s' % (util.strftime(self.timestamp), self.request_line)
 
     def filter_by_hosts(self, hosts):
-        if not hosts:
-            return True
-        for pattern in hosts:
-            if fnmatch.fnmatchcase(self.host, pattern):
-                return True
-        return False
+        return hosts(self.host)
 
     def filter_by_urls(self, urls):
-        if not urls:
-            return True
-        for pattern in urls:
-            if fnmatch.fnmatchcase(self.url, pattern):
-                return True
-        return False
+        return urls(self.url)
+
 
+class Response(HTTPMessage):
+    __slots__ = ('latency', 'response_line', 'version', 'status_code', 'reason')
 
-class Response(object):
     def __init__(self, latency, payload):
+        super().__init__(payload)
         self.latency = round(int(latency) / 1000000000, 3)
-        self.payload = payload
 
-        self.response_line, self.raw_headers, self.body = util.http_split_message(payload)
-        self.headers = util.http_parse_headers(self.raw_headers)
-        self.version, self.status_code, self.reason = self.response_line.partition(' ')
+        self.response_line = self.first_line
+        self.version, _, status = self.response_line.partition(' ')
+        self.status_code, _, self.reason = status.partition(' ')
 
     def __str__(self):
         return '%s %s' % (self.latency, self.response_line)
 
 
+class PatternMatcher(object):
+    """把一组 fnmatch 模式编译成一个匹配器，并统计每个模式的命中次数
+
+    * 不含通配符的模式：集合中精确匹配
+    * 只在末尾有 `*` 的模式：按前缀匹配
+    * 其他模式：合并成一个正则表达式
+    """
+    def __init__(self, patterns):
+        self.patterns = list(collections.OrderedDict.fromkeys(patterns))
+        self.hits = collections.OrderedDict((pattern, 0) for pattern in self.patterns)
+
+        self.exact = set()
+        self.prefixes = {}
+        regex = []
+        for index, pattern in enumerate(self.patterns):
+            if not has_magic(pattern):
+                self.exact.add(pattern)
+            elif pattern.endswith('*') and not has_magic(pattern[:-1]):
+                self.prefixes[pattern[:-1]] = pattern
+            else:
+                regex.append('(?P<p%d>%s)' % (index, fnmatch.translate(pattern)))
+        # 先匹配较长的前缀
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+        self.regex = re.compile('|'.join(regex)) if regex else None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, text):
+        """返回匹配的模式，没有匹配时返回 None：优先精确匹配，其次是最长的前缀，最后是正则表达式中第一个匹配的模式
+        """
+        if text in self.exact:
+            pattern = text
+        else:
+            pattern = None
+            for length in self.prefix_lengths:
+                pattern = self.prefixes.get(text[:length])
+                if pattern is not None:
+                    break
+            else:
+                if self.regex is None:
+                    return None
+                m = self.regex.match(text)
+                if m is None:
+                    return None
+                # 外层的分组最后结束，lastgroup 就是这个模式对应的分组
+                pattern = self.patterns[int(m.lastgroup[1:])]
+        self.hits[pattern] += 1
+        return pattern
+
+    def __str__(self):
+        return ', '.join('%s=%d' % item for item in self.hits.items())
+
+
+class PatternFilter(object):
+    """包含和排除两组模式：没有包含模式时不限制，匹配任一排除模式时过滤掉
+    """
+    def __init__(self, includes=(), excludes=()):
+        self.includes = PatternMatcher(includes)
+        self.excludes = PatternMatcher(excludes)
+
+    def __call__(self, text):
+        if self.includes and self.includes.match(text) is None:
+            return False
+        if self.excludes and self.excludes.match(text) is not None:
+            return False
+        return True
+
+    def __str__(self):
+        if self.excludes:
+            return '%s; exclude: %s' % (self.includes, self.excludes)
+        return str(self.includes)
+
+
+def has_magic(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def load_filter_file(filename):
+    """从文件中读取过滤规则，每行一条，`!` 开头表示排除::
+
+        # 注释
+        host *.example.com
+        url /interface/*
+        !url /interface/health*
+
+    返回 (hosts, urls, exclude_hosts, exclude_urls)
+    """
+    rules = {'host': [], 'url': [], '!host': [], '!url': []}
+    with open(filename, encoding='utf-8') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, _, pattern = line.partition(' ')
+            if kind not in rules or not pattern.strip():
+                raise click.BadParameter('invalid filter rule: %s' % line, param_hint='--filter-file')
+            rules[kind].append(pattern.strip())
+    return rules['host'], rules['url'], rules['!host'], rules['!url']
+
+
+class TokenBucket(object):
+    """令牌桶：每秒补充 rate 个令牌，最多 burst 个
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'time')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = now
+
+    def take(self, now):
+        if now > self.time:
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FirstN(object):
+    """每 window 秒只保留前 count 个
+    """
+    __slots__ = ('count', 'window', 'start', 'seen')
+
+    def __init__(self, count, window, now):
+        self.count = count
+        self.window = window
+        self.start = now
+        self.seen = 0
+
+    def take(self, now):
+        if now - self.start >= self.window:
+            self.start = now
+            self.seen = 0
+        self.seen += 1
+        return self.seen <= self.count
+
+
+def parse_sample_policy(policy):
+    """解析采样策略 `<url 模式>=<策略>`，返回 (模式, 创建状态的函数)
+
+    策略:
+
+    * rate:R[:B] -- 令牌桶，每秒 R 个，最多连续 B 个（缺省等于 R）
+    * first:N/S -- 每 S 秒保留前 N 个
+    * all -- 全部保留
+    * none -- 全部丢弃（慢的和出错的除外）
+
+    R 必须大于 0，B 不小于 1，N 不小于 0，S 大于 0。
+    """
+    pattern, _, spec = policy.rpartition('=')
+    if not pattern:
+        raise click.BadParameter('missing url pattern: %s' % policy, param_hint='--sample')
+    kind, _, args = spec.partition(':')
+    try:
+        if kind == 'rate':
+            rate, _, burst = args.partition(':')
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1)
+            if 0 < rate < float('inf') and 1 <= burst < float('inf'):
+                return pattern, functools.partial(TokenBucket, rate, burst)
+        elif kind == 'first':
+            count, _, window = args.partition('/')
+            count, window = int(count), float(window or 60)
+            if count >= 0 and window > 0:
+                return pattern, functools.partial(FirstN, count, window)
+        elif kind == 'all' and not args:
+            return pattern, None
+        elif kind == 'none' and not args:
+            return pattern, functools.partial(FirstN, 0, float('inf'))
+    except ValueError:
+        pass
+    raise click.BadParameter('invalid sample policy: %s' % policy, param_hint='--sample')
+
+
+class Sampler(object):
+    """按 endpoint（URL 路径）采样，在保存和输出 API 之前决定是否保留
+
+    每个路径有自己的状态（令牌桶或计数），使用 PatternMatcher.match 选中的模式的策略（优先不含通配符的模式，
+    其次是最长的前缀模式，最后是其他模式中的第一个），没有匹配的模式时全部保留。慢的（latency >= keep_slow）和出错的（status >= 400）总是保留。
+    """
+    # 最多记录多少个路径的状态，超过时丢弃最早的
+    max_endpoints = 65536
+
+    def __init__(self, policies, keep_slow=0, keep_errors=True):
+        self.policies = collections.OrderedDict(parse_sample_policy(policy) for policy in policies)
+        self.matcher = PatternMatcher(self.policies)
+        self.keep_slow = keep_slow
+        self.keep_errors = keep_errors
+        self.states = collections.OrderedDict()
+
+        self.kept = 0
+        self.dropped = 0
+
+    def __bool__(self):
+        return bool(self.policies)
+
+    def keep(self, request, response):
+        if self.sample(request, response):
+            self.kept += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def sample(self, request, response):
+        if self.keep_slow and response.latency >= self.keep_slow:
+            return True
+        if self.keep_errors and response.status_code.isdigit() and int(response.status_code) >= 400:
+            return True
+
+        pattern = self.matcher.match(request.path)
+        if pattern is None or self.policies[pattern] is None:
+            return True
+
+        state = self.states.get(request.path)
+        if state is None:
+            state = self.states[request.path] = self.policies[pattern](request.timestamp)
+            if len(self.states) > self.max_endpoints:
+                self.states.popitem(False)
+        return state.take(request.timestamp)
+
+    def __str__(self):
+        return 'kept: %d, dropped: %d, endpoints: %d' % (self.kept, self.dropped, len(self.states))
+
+
+class ShapeDeduper(object):
+    """按结构去重：同一 endpoint（URL 路径）下结构相同的 API 只保留前 exemplars 个
+
+    结构包括 method、status、request 和 response body 的 JSON 结构（参见 util.json_shape），
+    以及 response 中的 code（apiblue 等认为 code 不同的 API 不同）。
+    """
+    # 最多记录多少个路径，以及每个路径最多记录多少种结构，超过时丢弃最早的
+    max_endpoints = 65536
+    max_shapes = 256
+
+    def __init__(self, exemplars, keep_list_item, max_body_size=0):
+        self.exemplars = exemplars
+        self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
+        self.endpoints = collections.OrderedDict()
+
+        self.kept = 0
+        self.duplicates = 0
+
+    def __bool__(self):
+        return self.exemplars > 0
+
+    def keep(self, request, response):
+        response_shape, code = self.body_shape(response)
+        fingerprint = (request.method, response.status_code, self.body_shape(request)[0], response_shape, code)
+
+        shapes = self.endpoints.get(request.path)
+        if shapes is None:
+            shapes = self.endpoints[request.path] = collections.OrderedDict()
+            if len(self.endpoints) > self.max_endpoints:
+                self.endpoints.popitem(False)
+
+        count = shapes.get(fingerprint, 0)
+        if count >= self.exemplars:
+            self.duplicates += 1
+            return False
+        shapes[fingerprint] = count + 1
+        if len(shapes) > self.max_shapes:
+            shapes.popitem(False)
+        self.kept += 1
+        return True
+
+    def body_shape(self, message):
+        """返回 (结构, code)
+        """
+        if not message.body:
+            return 'empty', None
+        # noinspection PyBroadException
+        try:
+            data = self.loads(self.decode_body(message))
+            shape = util.json_shape(data, self.keep_list_item)
+            code = repr(data.get('code')) if isinstance(data, dict) else repr(None)
+        except:
+            return 'text', None
+        return shape, code
+
+    def decode_body(self, message):
+        return util.decode_body(message.body_headers, message.body, self.max_body_size)
+
+    def loads(self, body):
+        return util.json_loads_simplified(body, self.keep_list_item)
+
+    def __str__(self):
+        return 'kept: %d, duplicates: %d, endpoints: %d' % (self.kept, self.duplicates, len(self.endpoints))
+
+
+class StageStats(object):
+    """apicapture 各个阶段的统计：调用次数、总耗时、最长耗时，以及读入和写出的字节数
+
+    打开统计时用 wrap 返回的计时函数代替各个阶段的函数（见 APICapture.instrument），
+    关闭时什么都不替换，没有额外的开销。阶段可以嵌套（如 dedup 包括 body 和 simplify），
+    耗时分别统计。
+    """
+    def __init__(self, name='stats'):
+        self.name = name
+        self.stages = collections.OrderedDict()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start_time = time.time()
+
+    def wrap(self, name, func, bytes_in=None, bytes_out=None):
+        """返回计时的 func，bytes_in(args) 和 bytes_out(result) 分别返回读入和写出的字节数
+        """
+        # [次数, 总耗时, 最长耗时]
+        counter = self.stages.setdefault(name, [0, 0.0, 0.0])
+        perf_counter = time.perf_counter
+
+        def wrapper(*args):
+            start = perf_counter()
+            result = func(*args)
+            elapsed = perf_counter() - start
+            counter[0] += 1
+            counter[1] += elapsed
+            if elapsed > counter[2]:
+                counter[2] = elapsed
+            if bytes_in is not None:
+                self.bytes_in += bytes_in(args)
+            if bytes_out is not None:
+                self.bytes_out += bytes_out(result)
+            return result
+        return wrapper
+
+    def log(self):
+        prefix = self.name
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        logging.info('%s: bytes in: %d (%.2f MB/s), bytes out: %d (%.2f MB/s)', prefix, self.bytes_in,
+                     self.bytes_in / elapsed / 1e6, self.bytes_out, self.bytes_out / elapsed / 1e6)
+        for name, (count, total, longest) in self.stages.items():
+            if not count:
+                continue
+            logging.info('%s: %-8s count: %d, total: %.3fs, avg: %.1fus, max: %.1fms', prefix, name, count, total,
+                         total / count * 1e6, longest * 1e3)
+
+
+class GorLineSplitter(object):
+    """把分块到达的 gor 数据流切分成行（memoryview，不复制数据）
+
+    不完整的最后一行留到下一块中处理。
+    """
+    def __init__(self):
+        self.parts = []
+
+    def feed(self, block):
+        end = block.rfind(b'\n') + 1
+        if not end:
+            # 单个数据包比块还大
+            self.parts.append(block)
+            return []
+        if self.parts:
+            self.parts.append(block)
+            block = b''.join(self.parts)
+            end = block.rfind(b'\n') + 1
+            self.parts = []
+
+        view = memoryview(block)
+        find = block.find
+        lines = []
+        start = 0
+        while start < end:
+            pos = find(b'\n', start, end)
+            if pos > start:
+                lines.append(view[start:pos])
+            start = pos + 1
+        if end < len(block):
+            self.parts.append(block[end:])
+        return lines
+
+    def flush(self):
+        tail = b''.join(self.parts).strip()
+        self.parts = []
+        return [memoryview(tail)] if tail else []
+
+
+def split_gor_lines(stream, block_size):
+    """按块读取 gor 数据流，每块产生一批行
+    """
+    # ! 对于管道，read() 会一直等到读满 block_size，read1() 有多少读多少
+    read = getattr(stream, 'read1', stream.read)
+    splitter = GorLineSplitter()
+    while True:
+        block = read(block_size)
+        if not block:
+            break
+        lines = splitter.feed(block)
+        if lines:
+            yield lines
+
+    lines = splitter.flush()
+    if lines:
+        yield lines
+
+
+def parse_listen_address(address):
+    """解析监听地址：`unix:/path/to/sock`, `tcp://host:port`, `host:port` 或 `:port`
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if path.startswith('//'):
+            path = path[2:]
+        return 'unix', path
+    if address.startswith('tcp://'):
+        address = address[len('tcp://'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', host.strip('[]') or None, int(port)
+
+
+def unhexlify_lines(lines):
+    """解码一批 hex 行，出错时再逐行解码以跳过错误的行
+
+    每行本来就只调用一次 unhexlify（C 实现），整块一次解码要先去掉换行、再按行切开，多复制两遍反而更慢。
+    """
+    unhexlify = binascii.unhexlify
+    try:
+        return [unhexlify(line) for line in lines]
+    except (binascii.Error, ValueError):
+        pass
+
+    packets = []
+    for line in lines:
+        line = bytes(line).rstrip()
+        try:
+            packets.append(unhexlify(line))
+        except (binascii.Error, ValueError):
+            logging.error('Invalid hex packet: %s', line[:64])
+    return packets
+
+
+class PendingRequests(object):
+    """等待 Response 的 Request 缓存
+
+    * 按 gor 时间戳过期（ttl 秒，0 表示不过期）：以见到的最大时间戳为当前时间，加入 Request 和
+      取出 Request（包括找不到的）时都检查。Request 不一定按时间顺序到达（多个 gor 数据流、时间戳乱序），
+      所以另外按时间戳排一个堆，不依赖加入的顺序
+    * 限制 Request 个数和 payload 总字节数（0 表示不限制），超出时淘汰最早加入的
+    * 统计配对、过期、淘汰和找不到 Request 的 Response 的次数
+    """
+    def __init__(self, max_count, max_bytes=0, ttl=0):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.bytes = 0
+        # (timestamp, 序号, uuid, Request) 的堆，已经取出的 Request 到过期检查时才从堆中去掉
+        self.heap = []
+        self.seq = 0
+        # 见到的最大时间戳
+        self.now = 0
+
+        self.matched = 0
+        self.expired = 0
+        self.evicted = 0
+        self.orphans = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+        self.heap.clear()
+        self.bytes = 0
+
+    def put(self, uuid, request):
+        old = self.items.pop(uuid, None)
+        if old is not None:
+            self.bytes -= len(old.payload)
+        self.items[uuid] = request
+        self.bytes += len(request.payload)
+
+        if self.ttl:
+            self.seq += 1
+            heapq.heappush(self.heap, (request.timestamp, self.seq, uuid, request))
+            self.tick(request.timestamp)
+
+        while len(self.items) > self.max_count or (self.max_bytes and self.bytes > self.max_bytes):
+            _, discard = self.items.popitem(False)
+            self.bytes -= len(discard.payload)
+            self.evicted += 1
+            logging.debug('discard request for cache is full: %s', discard)
+
+    def tick(self, timestamp):
+        """timestamp 为新的数据包的时间戳，过期 ttl 秒以前的 Request
+        """
+        if timestamp > self.now:
+            self.now = timestamp
+        self.expire(self.now - self.ttl)
+
+    def expire(self, deadline):
+        heap = self.heap
+        items = self.items
+        while heap and heap[0][0] < deadline:
+            _, _, uuid, request = heapq.heappop(heap)
+            # 已经配对、被淘汰或者被同一个 uuid 替换的跳过
+            if items.get(uuid) is not request:
+                continue
+            del items[uuid]
+            self.bytes -= len(request.payload)
+            self.expired += 1
+            logging.debug('discard request for timeout: %s', request)
+
+        # 堆中已经取出的 Request 太多时重建，堆的大小和缓存的 Request 数相当
+        if len(heap) > 2 * len(items) + 1024:
+            self.heap = [entry for entry in heap if items.get(entry[2]) is entry[3]]
+            heapq.heapify(self.heap)
+
+    def pop(self, uuid, timestamp=None):
+        """取出 uuid 的 Request，timestamp 为 Response 的 gor 时间戳（秒），用来过期其他 Request
+        """
+        request = self.items.pop(uuid, None)
+        if request is not None:
+            self.bytes -= len(request.payload)
+            self.matched += 1
+        else:
+            self.orphans += 1
+        if self.ttl and timestamp is not None:
+            self.tick(timestamp)
+        return request
+
+    def __str__(self):
+        return 'cached: %d (%d bytes), matched: %d, expired: %d, evicted: %d, orphans: %d' % (
+            len(self.items), self.bytes, self.matched, self.expired, self.evicted, self.orphans)
+
+
+# 停止工作进程时等待它们写完已收到的数据的时间（秒），超时后强制结束
+WORKER_STOP_TIMEOUT = 10
+
+# gor 数据包头（`1 <uuid> <timestamp>`）足够短，只解码前面这部分就能取到 uuid
+GOR_HEADER_PEEK = 160
+
+
+def gor_packet_uuid(line):
+    """从 hex 编码的 gor 数据包中取出 uuid，只解码包头部分
+    """
+    peek = line[:GOR_HEADER_PEEK]
+    header = binascii.unhexlify(peek[:len(peek) & ~1])
+    return header.partition(b'\n')[0].split(b' ', 2)[1]
+
+
 class APICapture(object):
-    requests = collections.OrderedDict()
+    # 各个阶段使用的函数，打开统计时在实例上替换为计时的函数（见 instrument）
+    unhexlify = staticmethod(binascii.unhexlify)
+    unhexlify_lines = staticmethod(unhexlify_lines)
+    new_request = Request
+    new_response = Response
 
-    def __init__(self, hosts, urls, save_dir, watch, keep_list_item, cache_size):
-        self.hosts = hosts
-        self.urls = urls
+    def __init__(self, hosts, urls, save_dir, watch, keep_list_item, cache_size, block_size=0, workers=0,
+                 listen=None, cache_bytes=0, cache_ttl=0, exclude_hosts=(), exclude_urls=(), storage='tree',
+                 segment_size=256 << 20, writer_threads=0, writer_queue=1024, writer_policy='block',
+                 flush_interval=1.0, samples=(), keep_slow=0, keep_errors=True, dedup=0, max_body_size=0,
+                 stage_stats=False, stats_interval=60):
+        self.hosts = PatternFilter(hosts, exclude_hosts)
+        self.urls = PatternFilter(urls, exclude_urls)
         self.save_dir = Path(save_dir) if save_dir else None
+        self.storage = storage
+        self.segment_size = segment_size
+        self.segment_prefix = 'segment'
+        self.writer_threads = writer_threads
+        self.writer_queue = writer_queue
+        self.writer_policy = writer_policy
+        self.flush_interval = flush_interval
+        self.writer = None
         self.watch = watch
         self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
         self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache_ttl = cache_ttl
+        self.block_size = block_size
+        self.workers = workers
+        self.listen = listen
+        self.stage_stats = stage_stats
+        # 定期输出统计信息的间隔（秒）
+        self.stats_interval = stats_interval
+
+        self.requests = PendingRequests(cache_size, cache_bytes, cache_ttl)
+        self.sampler = Sampler(samples, keep_slow, keep_errors)
+        self.deduper = ShapeDeduper(dedup, keep_list_item, max_body_size)
+        self.filtered = 0
+        self.stats = None
+        self.stats_time = time.time()
 
     def run(self):
         logging.info('apicapture-%s started.' % apiutils.__version__)
-        logging.info('hosts: %s', list(self.hosts))
-        logging.info('urls: %s', list(self.urls))
-        for line in sys.stdin:
+        logging.info('hosts: %s', self.hosts.includes.patterns)
+        logging.info('urls: %s', self.urls.includes.patterns)
+        if self.hosts.excludes or self.urls.excludes:
+            logging.info('exclude hosts: %s', self.hosts.excludes.patterns)
+            logging.info('exclude urls: %s', self.urls.excludes.patterns)
+        # 多进程模式下由各个工作进程统计
+        if self.stage_stats and (self.listen or self.workers <= 1):
+            self.instrument()
+        try:
+            if self.listen:
+                self.ingest_sockets(self.listen)
+                self.log_stats()
+            elif self.workers > 1:
+                # 统计信息由各个工作进程输出
+                self.ingest_workers(sys.stdin.buffer)
+            else:
+                if self.block_size:
+                    self.ingest_blocks(sys.stdin.buffer)
+                else:
+                    self.ingest_lines(sys.stdin)
+                self.log_stats()
+        finally:
+            self.close_writer()
+        logging.info('stopped.')
+
+    def log_stats(self):
+        logging.info('%s, filtered: %d', self.requests, self.filtered)
+        if self.writer_threads and self.writer is not None:
+            logging.info('writer: %s', self.writer)
+        if self.hosts.includes or self.hosts.excludes:
+            logging.info('host hits: %s', self.hosts)
+        if self.urls.includes or self.urls.excludes:
+            logging.info('url hits: %s', self.urls)
+        if self.sampler:
+            logging.info('sampling: %s', self.sampler)
+        if self.deduper:
+            logging.info('dedup: %s', self.deduper)
+        if self.stats is not None:
+            self.stats.log()
+        self.stats_time = time.time()
+
+    def instrument(self, name='stats'):
+        """打开各阶段的统计：在实例上用计时的函数代替各个阶段的函数，并在收到 SIGUSR1 时输出统计信息
+
+        关闭统计时各个阶段直接调用原来的函数，没有额外的开销。
+        """
+        stats = self.stats = StageStats(name)
+        self.unhexlify = stats.wrap('hex', binascii.unhexlify, lambda args: len(args[0]))
+        self.unhexlify_lines = stats.wrap('hex', unhexlify_lines, lambda args: sum(map(len, args[0])))
+        self.new_request = stats.wrap('parse', Request)
+        self.new_response = stats.wrap('parse', Response)
+        self.filter_request = stats.wrap('filter', self.filter_request)
+        self.requests.put = stats.wrap('pair', self.requests.put)
+        self.requests.pop = stats.wrap('pair', self.requests.pop)
+        self.sampler.keep = stats.wrap('sample', self.sampler.keep)
+        self.deduper.keep = stats.wrap('dedup', self.deduper.keep)
+        self.deduper.decode_body = stats.wrap('body', self.deduper.decode_body)
+        self.deduper.loads = stats.wrap('simplify', self.deduper.loads)
+        self.decode_body = stats.wrap('body', self.decode_body)
+        self.simplify_body = stats.wrap('simplify', self.simplify_body)
+        self.save_api = stats.wrap('save', self.save_api, bytes_out=lambda size: size)
+        self.output_api = stats.wrap('output', self.output_api)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: stats.log())
+
+    def ingest_lines(self, stream):
+        """按行读取文本模式的 gor 数据流
+        """
+        for line in stream:
             # noinspection PyBroadException
             try:
-                packet = binascii.unhexlify(line.rstrip())
+                packet = self.unhexlify(line.rstrip())
                 self.parse_gor_packet(packet)
             except:
                 logging.exception('Unknown error: %s', line)
-        logging.info('stopped.')
+
+    def ingest_blocks(self, stream):
+        """按块读取二进制模式的 gor 数据流
+
+        和按行读取的吞吐量相同（见 benchmarks/bench_ingest.py），只是读取方式不同。
+        """
+        for lines in split_gor_lines(stream, self.block_size):
+            self.parse_gor_lines(lines)
+
+    def ingest_workers(self, stream):
+        """多进程模式：本进程只负责读取数据，并按 uuid 把数据包分给各个工作进程
+
+        同一个 uuid 的 Request 和 Response 总是由同一个工作进程处理。有工作进程意外退出时停止所有进程，
+        以非 0 状态退出；Ctrl-C 或 kill（SIGTERM）时让工作进程写完已收到的数据后退出。
+        """
+        # 工作进程也继承这个处理：SIGTERM 和 Ctrl-C 一样
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        queues = [multiprocessing.Queue(8) for _ in range(self.workers)]
+        processes = [multiprocessing.Process(target=self.run_worker, args=(index, queue), daemon=True)
+                     for index, queue in enumerate(queues)]
+        for process in processes:
+            process.start()
+
+        if self.stage_stats and hasattr(signal, 'SIGUSR1'):
+            # 统计信息在各个工作进程中，把 SIGUSR1 转发给它们
+            def forward(signum, frame):
+                for process in processes:
+                    if process.is_alive():
+                        try:
+                            os.kill(process.pid, signum)
+                        except ProcessLookupError:
+                            pass
+            signal.signal(signal.SIGUSR1, forward)
+
+        failed = False
+        try:
+            self.dispatch(stream, queues, processes)
+        except KeyboardInterrupt:
+            logging.info('interrupted, stopping workers.')
+        except RuntimeError as e:
+            logging.error('%s, stopping workers.', e)
+            failed = True
+        finally:
+            self.stop_workers(queues, processes)
+
+        exited = ['%s (%s)' % (process.name, process.exitcode) for process in processes if process.exitcode]
+        if exited:
+            logging.error('workers exited abnormally: %s', ', '.join(exited))
+        if failed or exited:
+            sys.exit(1)
+
+    def dispatch(self, stream, queues, processes):
+        for lines in split_gor_lines(stream, self.block_size or 1 << 20):
+            batches = [[] for _ in queues]
+            for line in lines:
+                try:
+                    uuid = gor_packet_uuid(line)
+                except (binascii.Error, ValueError, IndexError):
+                    logging.error('Invalid gor packet: %s', bytes(line[:64]))
+                    continue
+                batches[zlib.crc32(uuid) % len(queues)].append(bytes(line))
+            for queue, batch in zip(queues, batches):
+                if batch:
+                    self.put_batch(queue, batch, processes)
+
+        for queue in queues:
+            self.put_batch(queue, None, processes)
+        for process in processes:
+            process.join()
+
+    @staticmethod
+    def put_batch(queue, batch, processes):
+        """队列满时等待，同时检查工作进程是否还在，有进程退出时抛出 RuntimeError，不会一直阻塞
+        """
+        while True:
+            try:
+                queue.put(batch, timeout=1)
+                return
+            except Full:
+                dead = [process.name for process in processes if not process.is_alive()]
+                if dead:
+                    raise RuntimeError('worker exited: %s' % ', '.join(dead))
+
+    @staticmethod
+    def stop_workers(queues, processes):
+        """通知还在运行的工作进程退出，超时后强制结束
+        """
+        for queue, process in zip(queues, processes):
+            if process.is_alive():
+                try:
+                    queue.put(None, timeout=1)
+                except Full:
+                    pass
+        deadline = time.time() + WORKER_STOP_TIMEOUT
+        for process in processes:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                logging.error('%s did not stop, terminating.', process.name)
+                process.terminate()
+                process.join()
+        # 工作进程都退出了，队列中剩下的数据没有人读，退出时不用等它们写入管道
+        for queue in queues:
+            queue.cancel_join_thread()
+
+    def ingest_sockets(self, address):
+        """监听 TCP 或 unix socket，同时接收多个 gor 数据流，Ctrl-C 或 kill（SIGTERM）时正常退出
+        """
+        try:
+            asyncio.run(self.serve(address))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+
+    async def serve(self, address):
+        # 每个连接最多缓存 limit 字节，读不过来时暂停从该连接读取（TCP 背压），不影响其他连接
+        limit = self.block_size or 1 << 20
+        kind, *address = parse_listen_address(address)
+        if kind == 'unix':
+            path, = address
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle_connection, path, limit=limit)
+        else:
+            host, port = address
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=limit)
+
+        for sock in server.sockets:
+            logging.info('listening on %s', sock.getsockname())
+        # kill（SIGTERM）时取消 serve_forever，和 Ctrl-C 一样写完已收到的数据后退出
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or 'unix socket'
+        logging.info('connected: %s', peer)
+        splitter = GorLineSplitter()
+        try:
+            while True:
+                block = await reader.read(self.block_size or 1 << 20)
+                if not block:
+                    break
+                self.parse_gor_lines(splitter.feed(block))
+                # 处理完一块后让出控制权，避免一个连接独占
+                await asyncio.sleep(0)
+            self.parse_gor_lines(splitter.flush())
+        except ConnectionError as e:
+            logging.warning('connection error: %s %s', peer, e)
+        finally:
+            writer.close()
+        logging.info('disconnected: %s', peer)
+
+    def run_worker(self, index, queue):
+        # 每个工作进程只缓存自己那一部分 Request
+        self.requests = PendingRequests(
+            max(1, self.cache_size // self.workers), self.cache_bytes // self.workers, self.cache_ttl)
+        # 每个工作进程写自己的 segment 文件
+        self.segment_prefix = 'segment-w%d' % index
+        if self.stage_stats:
+            self.instrument('worker %d stats' % index)
+        logging.debug('worker %d started.', index)
+        try:
+            for lines in iter(queue.get, None):
+                self.parse_gor_lines(lines)
+        except KeyboardInterrupt:
+            # 主进程负责停止，这里写完已经收到的数据就退出
+            pass
+        finally:
+            self.close_writer()
+        self.log_stats()
+        logging.debug('worker %d stopped.', index)
+
+    def parse_gor_lines(self, lines):
+        for packet in self.unhexlify_lines(lines):
+            # noinspection PyBroadException
+            try:
+                self.parse_gor_packet(packet)
+            except:
+                logging.exception('Unknown error: %s', packet)
 
     def parse_gor_packet(self, packet):
         header, _, payload = packet.partition(b'\n')
@@ -96,50 +993,77 @@ class APICapture(object):
             self.parse_request(uuid, timestamp, payload)
         elif message_type == '2':
             uuid, timestamp, latency = tokens[1:]
-            # 说明： Response 的 timestamp 和 Request 一样，不必要特别记录和处理
-            self.parse_response(uuid, latency, payload)
+            # 说明： Response 的 timestamp 和 Request 一样，不必要特别记录，只用来过期缓存中的 Request
+            self.parse_response(uuid, latency, payload, timestamp)
         else:
             logging.warning('Unknown gor message type: %s', packet)
 
     def parse_request(self, uuid, timestamp, payload):
-        request = Request(timestamp, payload)
+        request = self.new_request(timestamp, payload)
+        if not self.filter_request(request):
+            self.filtered += 1
+            return
 
+        self.requests.put(uuid, request)
+        if time.time() - self.stats_time >= self.stats_interval:
+            self.log_stats()
+
+    def filter_request(self, request):
         # host 过滤
         if not request.filter_by_hosts(self.hosts):
             logging.debug('host does not match: %s', request)
-            return
+            return False
 
         # URL 过滤
         if not request.filter_by_urls(self.urls):
             logging.debug('url does not match: %s', request)
-            return
-
-        self.requests[uuid] = request
-        if len(self.requests) > self.cache_size:
-            _, discard = self.requests.popitem(False)
-            logging.warning('discard request for cache is full: %s', discard)
-
-    def parse_response(self, uuid, latency, payload):
-        response = Response(latency, payload)
+            return False
+        return True
 
-        request = self.requests.pop(uuid, None)
+    def parse_response(self, uuid, latency, payload, timestamp=None):
+        # 找不到 Request 时不必分析 Response
+        request = self.requests.pop(uuid, round(int(timestamp) / 1000000000, 3) if timestamp else None)
         if not request:
             return
 
+        response = self.new_response(latency, payload)
+
         logging.info('%s - %s', request.request_line, response.response_line)
+        if self.sampler and not self.sampler.keep(request, response):
+            logging.debug('sampled out: %s', request)
+            return
+        if self.deduper and not self.deduper.keep(request, response):
+            logging.debug('duplicate: %s', request)
+            return
+
         if self.save_dir:
             self.save_api(request, response)
         if self.watch:
             self.output_api(request, response)
 
+    def open_writer(self):
+        if self.storage == 'segment':
+            writer = apistore.SegmentWriter(
+                self.save_dir, self.segment_size, self.segment_prefix, self.flush_interval)
+        else:
+            writer = apistore.TreeWriter(self.save_dir)
+        if self.writer_threads:
+            writer = apistore.BackgroundWriter(
+                writer, self.writer_threads, self.writer_queue, self.writer_policy, self.flush_interval)
+        return writer
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            if self.writer_threads:
+                logging.info('writer: %s', self.writer)
+            self.writer = None
+
     def save_api(self, request, response):
-        filepath = self.save_dir / request.path.lstrip('/')
-        path = filepath.parent
+        filepath = PurePosixPath(request.path.lstrip('/'))
         request_time = util.strftime(request.timestamp, '%Y%m%d_%H%M%S')
         name = '%s-%s.api' % (request_time, filepath.name)
-        filepath = path / name
-        if not path.exists():
-            path.mkdir(0o777, True)
+        relpath = str(filepath.parent / name)
         lines = [
             ('Request-Time: %s\r\n' % util.strftime(request.timestamp)).encode(),
             ('Latency: %.3f\r\n' % response.latency).encode(),
@@ -150,8 +1074,10 @@ class APICapture(object):
             ('Response %d\r\n' % len(response.payload)).encode(),
             response.payload,
         ]
-        with filepath.open('wb') as fp:
-            fp.writelines(lines)
+        if self.writer is None:
+            self.writer = self.open_writer()
+        self.writer.write(relpath, lines)
+        return sum(map(len, lines))
 
     def output_api(self, request, response):
         lines = [
@@ -162,7 +1088,7 @@ class APICapture(object):
             '',
             request.raw_headers,
             '',
-            self.parse_body(request.headers, request.body),
+            self.parse_body(request.body_headers, request.body),
             '',
             '# Response',
             '',
@@ -170,28 +1096,61 @@ class APICapture(object):
             '',
             response.raw_headers,
             '',
-            self.parse_body(response.headers, response.body),
+            self.parse_body(response.body_headers, response.body),
             '',
         ]
         sys.stderr.write('\n'.join(lines))
 
     def parse_body(self, headers, body):
-        return util.simplify_body(util.decode_body(headers, body), self.keep_list_item)
+        return self.simplify_body(self.decode_body(headers, body))
+
+    def decode_body(self, headers, body):
+        return util.decode_body(headers, body, self.max_body_size)
+
+    def simplify_body(self, body):
+        return util.simplify_body(body, self.keep_list_item)
 
 
 @click.command()
 @click.option('--save-dir', '-s', default=None, help='保存 API 数据文件目录.')
+@click.option('--storage', default='tree', type=click.Choice(['tree', 'segment']),
+              help='保存方式：每个 API 一个文件（tree）或追加写入 segment 文件（segment）.')
+@click.option('--segment-size', default=256, help='单个 segment 文件的大小，单位: MB.')
+@click.option('--writer-threads', default=0, help='后台写文件的线程数（0 表示直接写）.')
+@click.option('--writer-queue', default=1024, help='后台写文件的队列长度.')
+@click.option('--writer-policy', default='block', type=click.Choice(apistore.BackgroundWriter.POLICIES),
+              help='队列满时的处理方式：等待（block），丢弃新的（drop-newest）或最早的（drop-oldest）数据.')
+@click.option('--flush-interval', default=1.0, help='写文件时 flush 的间隔，单位: 秒（必须大于 0）.')
+@click.option('--sample', multiple=True, help='按 URL 路径采样: <url 模式>=rate:R[:B]|first:N/S|all|none（允许指定多个）.')
+@click.option('--keep-slow', default=0.0, help='采样时总是保留 latency 超过指定秒数的 API（0 表示不限制）.')
+@click.option('--keep-errors/--no-keep-errors', default=True, help='采样时是否总是保留出错（status >= 400）的 API.')
+@click.option('--stage-stats', is_flag=True, help='统计各阶段的次数、耗时和字节数（定期输出到日志，收到 SIGUSR1 时也输出）.')
+@click.option('--stats-interval', default=60, help='定期输出统计信息的间隔，单位: 秒.')
+@click.option('--dedup', default=0, help='按结构去重：结构相同的 API 最多保留的个数（0 表示不去重）.')
 @click.option('--watch', '-w', is_flag=True, help='是否输出详细信息.')
 @click.option('--host', '-h', multiple=True, help='host 过滤（允许指定多个）.')
 @click.option('--url', '-u', multiple=True, help='url 过滤（允许指定多个）.')
+@click.option('--filter-file', '-f', default=None, help='从文件读取 host/url 过滤规则.')
 @click.option('--keep-list-item', '-k', default=1, help='列表中保留的项数.')
+@click.option('--max-body-size', '-m', default=64, help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制）.')
 @click.option('--cache-size', '-c', default=128, help='Request 缓存个数.')
+@click.option('--cache-bytes', default=64 << 20, help='Request 缓存的最大字节数（0 表示不限制）.')
+@click.option('--cache-ttl', default=60, help='Request 缓存的过期时间，单位: 秒（按 gor 时间戳，0 表示不过期）.')
+@click.option('--block-size', '-b', default=0, help='每次读取的字节数（0 表示 stdin 按行读取，-p/-l 时每次 1 MB）.')
+@click.option('--workers', '-p', default=0, help='工作进程数（按 uuid 分配数据包）.')
+@click.option('--listen', '-l', default=None, help='监听地址，从 socket 而不是 stdin 接收数据（如 :28020, unix:/tmp/gor.sock）.')
 @click.option('--debug', '-d', is_flag=True, help='是否输出调试信息.')
 @click.option('--version', '-v', is_flag=True, is_eager=True, help='版本信息.')
-def run(host, url, save_dir, watch, keep_list_item, debug, cache_size, version):
+def run(host, url, filter_file, save_dir, storage, segment_size, writer_threads, writer_queue, writer_policy,
+        flush_interval, sample, keep_slow, keep_errors, stage_stats, stats_interval, dedup, watch, keep_list_item,
+        max_body_size, debug, cache_size, cache_bytes, cache_ttl, block_size, workers, listen, version):
     if version:
         print('apicapture %s' % apiutils.__version__)
         return
+    if listen and workers > 1:
+        raise click.BadParameter('--listen 时不支持多个工作进程', param_hint='--workers')
+    if flush_interval <= 0:
+        raise click.BadParameter('flush 的间隔必须大于 0', param_hint='--flush-interval')
 
     log_format = '%(asctime)s - %(levelname)s - %(message)s'
     log_level = logging.DEBUG if debug else logging.INFO
@@ -200,7 +1159,16 @@ def run(host, url, save_dir, watch, keep_list_item, debug, cache_size, version):
     if save_dir:
         os.makedirs(save_dir, 0o777, True)
 
-    capture = APICapture(host, url, save_dir, watch, keep_list_item, cache_size)
+    exclude_hosts = exclude_urls = ()
+    if filter_file:
+        hosts, urls, exclude_hosts, exclude_urls = load_filter_file(filter_file)
+        host += tuple(hosts)
+        url += tuple(urls)
+
+    capture = APICapture(host, url, save_dir, watch, keep_list_item, cache_size, block_size, workers, listen,
+                         cache_bytes, cache_ttl, exclude_hosts, exclude_urls, storage, segment_size << 20,
+                         writer_threads, writer_queue, writer_policy, flush_interval, sample, keep_slow, keep_errors,
+                         dedup, max_body_size << 20, stage_stats, stats_interval)
     capture.run()
 
 
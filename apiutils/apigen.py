@@ -48,7 +48,7 @@ class Defination(object):
                     type = "boolean"
                 self.type = type
             else:
-                self.type = util.guess_value_type(default)
+                self.type = util.infer_type([default]).type
             self.default = default
             self.description = description
         else:
@@ -137,21 +137,17 @@ class ApiGen(object):
             parameters.append(('path', defination))
 
         # 分析 query 中的参数
-        for name, value in sorted(parse_qs(query).items()):
-            if len(value) == 1:
-                value = value[0]
+        for name, values in sorted(parse_qs(query).items()):
             defination = self.get_defination(name)
-            defination.type = util.guess_value_type(value)
+            defination.type = util.infer_type(values).type
             parameters.append(('query', defination))
 
         # 分析 form 中的参数，仅支持 form-urlencoded
         form = request.get('form')
         if form:
-            for name, value in sorted(parse_qs(form).items()):
-                if len(value) == 1:
-                    value = value[0]
+            for name, values in sorted(parse_qs(form).items()):
                 defination = self.get_defination(name)
-                defination.type = util.guess_value_type(value)
+                defination.type = util.infer_type(values).type
                 parameters.append(('formData', defination))
 
         if parameters:
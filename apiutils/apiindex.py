@@ -0,0 +1,420 @@
+"""API 数据文件的索引（SQLite），按条件查找 session 时不用遍历目录、分析所有文件
+
+    apiindex -d api_save_dir                                  # 建立或更新索引
+    apiindex -d api_save_dir -F 'method=POST path=/order status=500 time>=2017-02-14 time<2017-02-15'
+    apiswagger -d api_save_dir -F 'path~/interface/user/*'    # 只用索引中符合条件的 session
+
+每个 session 一行，记录路径（segment 中的记录还有所在的 segment 文件和位置）、遍历目录的顺序、请求时间、
+latency、method、URL 路径、query 参数名、status、request 和 response body 的大小，以及 body 结构的指纹。
+更新索引时只分析新的和变了的文件（见 ApiStore.signature），并删除已经不存在的文件。
+
+其他工具按条件查找时直接用索引中的记录，不再遍历目录；索引只在不存在（或格式不同）时建立，
+新的文件要等 apiindex 或 -U 更新索引以后才能查到。
+
+过滤条件由空格分开的 <字段><操作符><值> 组成，各个条件同时满足（多个 -F 也一样），值中有空格时用引号：
+
+* 操作符：= != > >= < <=，~ 表示通配符匹配（支持 * ? [abc]）
+* 字段：time（Request-Time，按字符串比较）、latency、method、path、query（有这个参数）、status、
+  request_size、response_size、fingerprint、name（API 名称）、file（相对数据目录的路径）
+"""
+import collections
+import hashlib
+import os
+import shlex
+import sqlite3
+import sys
+
+import click
+import apiutils
+from apiutils import apireader
+from apiutils import apistore
+from apiutils import util
+
+# 缺省的索引文件：数据目录下的 apiindex.db
+INDEX_FILE = 'apiindex.db'
+
+# 索引的格式改变时加 1，原来的索引需要重建（2: 指纹改用 util.json_shape 的摘要计算，3: 增加 seq 列）
+INDEX_FORMAT = 3
+
+# 没有索引时建立索引用的参数
+KEEP_LIST_ITEM = 3
+MAX_BODY_SIZE = 64 << 20
+
+# 每更新这么多个文件提交一次
+COMMIT_INTERVAL = 1000
+
+# 字段 -> (列, 值的类型)
+FIELDS = {
+    'time': ('time', str),
+    'latency': ('latency', float),
+    'method': ('method', str.upper),
+    'path': ('url_path', str),
+    'query': ('query', str),
+    'status': ('status', int),
+    'request_size': ('request_size', int),
+    'response_size': ('response_size', int),
+    'fingerprint': ('fingerprint', str),
+    'name': ('name', str),
+    'file': ('path', str),
+}
+
+# 按长度排列，先匹配 >= 再匹配 >
+OPERATORS = ('!=', '>=', '<=', '=', '>', '<', '~')
+
+
+def parse_filter(expression):
+    """把过滤条件转成 SQL 的 WHERE 子句和参数
+    """
+    clauses = []
+    params = []
+    for term in shlex.split(expression):
+        field = operator = value = None
+        for i, c in enumerate(term):
+            if not (c.isalnum() or c == '_'):
+                field = term[:i]
+                operator = next((op for op in OPERATORS if term.startswith(op, i)), None)
+                value = term[i + len(operator):] if operator else None
+                break
+        if field not in FIELDS or operator is None:
+            raise click.BadParameter('invalid filter: %s' % term, param_hint='--filter')
+        column, convert = FIELDS[field]
+
+        if field == 'query':
+            # query 列为 ",a,b,"，判断有没有某个参数
+            if operator == '=':
+                clauses.append('instr(query, ?) > 0')
+                params.append(',%s,' % value)
+            elif operator == '!=':
+                clauses.append('instr(query, ?) = 0')
+                params.append(',%s,' % value)
+            elif operator == '~':
+                clauses.append('query GLOB ?')
+                params.append('*,%s,*' % value)
+            else:
+                raise click.BadParameter('invalid filter: %s' % term, param_hint='--filter')
+            continue
+
+        if operator == '~':
+            clauses.append('%s GLOB ?' % column)
+            params.append(value)
+            continue
+        try:
+            value = convert(value)
+        except ValueError:
+            raise click.BadParameter('invalid filter: %s' % term, param_hint='--filter')
+        clauses.append('%s %s ?' % (column, operator))
+        params.append(value)
+    return ' AND '.join(clauses), params
+
+
+def body_shape(headers, body, keep_list_item, max_body_size):
+    """返回 (结构, code)，和 apicapture 按结构去重时一样
+    """
+    if not body:
+        return 'empty', None
+    # noinspection PyBroadException
+    try:
+        data = util.json_loads_simplified(util.decode_body(headers, body, max_body_size), keep_list_item)
+        shape = util.json_shape(data, keep_list_item)
+        code = repr(data.get('code')) if isinstance(data, dict) else repr(None)
+    except:
+        return 'text', None
+    return shape, code
+
+
+def fingerprint(request_shape, response_shape, code):
+    """request 和 response body 的结构（util.json_shape）以及 code（repr 或 None）的指纹
+    """
+    text = '%s,%s,%r' % (request_shape, response_shape, code)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def summarize(record, keep_list_item=3, max_body_size=0):
+    """从 ApiRecord 得到索引中的各列
+    """
+    request_line, raw_headers, request_body = util.http_split_message(record.request)
+    request_headers = util.http_parse_headers(raw_headers)
+    method, _, url = request_line.partition(' ')
+    url = url.rpartition(' ')[0] or url
+    url_path, _, query = url.partition('?')
+    query_keys = sorted(set(key for key, _, _ in (item.partition('=') for item in query.split('&')) if key))
+
+    response_line, raw_headers, response_body = util.http_split_message(record.response)
+    response_headers = util.http_parse_headers(raw_headers)
+    try:
+        status = int(response_line.split(' ', 2)[1])
+    except (IndexError, ValueError):
+        status = None
+    try:
+        latency = float(record.latency)
+    except ValueError:
+        latency = None
+
+    request_shape, _ = body_shape(request_headers, request_body, keep_list_item, max_body_size)
+    response_shape, code = body_shape(response_headers, response_body, keep_list_item, max_body_size)
+    return {
+        'time': record.timestamp,
+        'latency': latency,
+        'method': method.upper(),
+        'url_path': url_path,
+        'query': ',%s,' % ','.join(query_keys) if query_keys else '',
+        'status': status,
+        'request_size': len(request_body),
+        'response_size': len(response_body),
+        'fingerprint': fingerprint(request_shape, response_shape, code),
+    }
+
+
+def index_file(data_dir, index=None):
+    """索引文件名，缺省为数据目录下的 apiindex.db
+    """
+    return index or os.path.join(data_dir, INDEX_FILE)
+
+
+class ApiIndex(object):
+    COLUMNS = ('path', 'root', 'filename', 'name', 'segment', 'offset', 'length', 'signature', 'seq',
+               'time', 'latency', 'method', 'url_path', 'query', 'status', 'request_size', 'response_size',
+               'fingerprint')
+
+    def __init__(self, filename, keep_list_item=None, max_body_size=None):
+        """keep_list_item、max_body_size 为 None 时使用索引原来的参数（没有索引时为缺省值），
+        和原来的不同时，下次 update 重建索引
+        """
+        self.filename = filename
+        self.format = '%s/%d' % (apiutils.__version__, INDEX_FORMAT)
+
+        self.added = 0
+        self.updated = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.errors = 0
+
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        # 版本或格式不同时，原来的索引不能用（可能没有某些列），只能重建
+        self.stale = meta.get('format') != self.format
+        stored_keep_list_item = KEEP_LIST_ITEM if self.stale else int(meta['keep_list_item'])
+        stored_max_body_size = MAX_BODY_SIZE if self.stale else int(meta['max_body_size'])
+        self.keep_list_item = stored_keep_list_item if keep_list_item is None else keep_list_item
+        self.max_body_size = stored_max_body_size if max_body_size is None else max_body_size
+        if (self.keep_list_item, self.max_body_size) != (stored_keep_list_item, stored_max_body_size):
+            self.stale = True
+
+    def create(self):
+        """删除原来的索引，按现在的格式和参数重新建立（空的）索引
+        """
+        # path、root 都是相对数据目录的路径，root 为 '' 表示数据目录本身；seq 为遍历目录的顺序
+        self.db.executescript('''
+            DROP TABLE IF EXISTS sessions;
+            CREATE TABLE sessions (
+                path TEXT PRIMARY KEY,
+                root TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                name TEXT NOT NULL,
+                segment TEXT,
+                offset INTEGER,
+                length INTEGER,
+                signature TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                time TEXT,
+                latency REAL,
+                method TEXT,
+                url_path TEXT,
+                query TEXT,
+                status INTEGER,
+                request_size INTEGER,
+                response_size INTEGER,
+                fingerprint TEXT
+            );
+            CREATE INDEX sessions_url_path ON sessions (url_path, method);
+            CREATE INDEX sessions_time ON sessions (time);
+            CREATE INDEX sessions_status ON sessions (status);
+            DELETE FROM meta;
+        ''')
+        self.db.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', (
+            ('format', self.format), ('keep_list_item', str(self.keep_list_item)),
+            ('max_body_size', str(self.max_body_size))))
+        self.db.commit()
+        self.stale = False
+
+    def update(self, data_dir):
+        """更新索引：分析新的和变了的文件，删除已经不存在的文件，并记录遍历目录的顺序
+
+        索引的版本、格式或参数（keep_list_item、max_body_size）变了时重建。
+        """
+        if self.stale:
+            self.create()
+
+        # path -> (signature, seq)
+        existing = {path: (signature, seq) for path, signature, seq in
+                    self.db.execute('SELECT path, signature, seq FROM sessions')}
+        store = apistore.ApiStore(data_dir)
+        insert = 'INSERT OR REPLACE INTO sessions (%s) VALUES (%s)' % (
+            ', '.join(self.COLUMNS), ', '.join('?' * len(self.COLUMNS)))
+        # 没有变的文件，遍历的顺序可能变了（例如前面增加了文件）
+        moved = []
+        seq = 0
+        pending = 0
+        with apireader.ApiReader(store, self.keep_list_item, self.max_body_size) as reader:
+            for root, _, files in store.walk():
+                relroot = os.path.relpath(root, data_dir)
+                relroot = '' if relroot == '.' else relroot
+                for filename in files:
+                    if not filename.endswith('.api'):
+                        continue
+                    apifile = os.path.join(root, filename)
+                    path = os.path.join(relroot, filename)
+                    try:
+                        signature = store.signature(apifile)
+                    except FileNotFoundError:
+                        # 遍历以后被删除了，和不存在的文件一样从索引中删除
+                        continue
+                    old, old_seq = existing.pop(path, (None, None))
+                    seq += 1
+                    if old == signature:
+                        self.unchanged += 1
+                        if old_seq != seq:
+                            moved.append((seq, path))
+                        continue
+
+                    try:
+                        columns = summarize(reader.read(apifile), self.keep_list_item, self.max_body_size)
+                    except FileNotFoundError:
+                        if old is not None:
+                            existing[path] = (old, old_seq)
+                        continue
+                    except apireader.ApiFormatError as e:
+                        print(e, file=sys.stderr)
+                        self.errors += 1
+                        continue
+                    finally:
+                        reader.release()
+
+                    segment, offset, length = store.locate(apifile)
+                    if length is None:
+                        segment = offset = None
+                    else:
+                        segment = os.path.relpath(segment, data_dir)
+                    columns.update(path=path, root=relroot, filename=filename, name=apireader.api_name(filename),
+                                   segment=segment, offset=offset, length=length, signature=signature, seq=seq)
+                    self.db.execute(insert, [columns[column] for column in self.COLUMNS])
+                    if old is None:
+                        self.added += 1
+                    else:
+                        self.updated += 1
+                    pending += 1
+                    if pending >= COMMIT_INTERVAL:
+                        self.db.commit()
+                        pending = 0
+
+        self.db.executemany('UPDATE sessions SET seq = ? WHERE path = ?', moved)
+        # 剩下的是已经不存在的文件
+        self.db.executemany('DELETE FROM sessions WHERE path = ?', ((path,) for path in existing))
+        self.removed += len(existing)
+        self.db.commit()
+
+    def select(self, filters, columns=('root', 'filename', 'segment', 'offset', 'length')):
+        """返回符合所有过滤条件的 session，按遍历目录的顺序排序
+        """
+        clauses = []
+        params = []
+        for expression in filters:
+            clause, clause_params = parse_filter(expression)
+            if clause:
+                clauses.append(clause)
+                params.extend(clause_params)
+        sql = 'SELECT %s FROM sessions' % ', '.join(columns)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY seq'
+        return self.db.execute(sql, params)
+
+    def walk_apis(self, store, filters):
+        """和 apireader.walk_apis 一样返回 [(root, {API 名称: [文件名, ...]}), ...]，但只包括符合过滤条件的 session
+
+        不遍历目录，直接用索引中的记录（segment 中的记录用 store.add_record 登记），顺序和更新索引时遍历
+        目录的顺序一样，生成的文档和不过滤时的一致。索引中有、但已经不存在的文件不包括在内。
+        """
+        groups = []
+        missing = 0
+        # segment 文件 -> 是否存在
+        segments = {}
+        for root, filename, name, segment, offset, length in self.select(
+                filters, ('root', 'filename', 'name', 'segment', 'offset', 'length')):
+            root = os.path.join(store.data_dir, root) if root else store.data_dir
+            apifile = os.path.join(root, filename)
+            if length is None:
+                exists = os.path.isfile(apifile)
+            else:
+                segment = os.path.join(store.data_dir, segment)
+                exists = segments.get(segment)
+                if exists is None:
+                    exists = segments[segment] = os.path.isfile(segment)
+                if exists:
+                    store.add_record(apifile, segment, offset, length)
+            if not exists:
+                missing += 1
+                continue
+            if not groups or groups[-1][0] != root:
+                groups.append((root, collections.OrderedDict()))
+            groups[-1][1].setdefault(name, []).append(filename)
+        if missing:
+            print('%d files in the index no longer exist, run apiindex to update the index' % missing,
+                  file=sys.stderr)
+        return groups
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __str__(self):
+        return 'added: %d, updated: %d, removed: %d, unchanged: %d, errors: %d' % (
+            self.added, self.updated, self.removed, self.unchanged, self.errors)
+
+
+def walk_apis(store, filters=(), index=None, update=False):
+    """没有过滤条件时遍历目录，否则从索引中查找，见 ApiIndex.walk_apis
+
+    update 为 True 时先更新索引（新的文件才能查到），否则只在没有索引（或格式不同）时建立；
+    都使用索引自己的参数，不会因为调用者的 -k、-m 不同而重建索引。
+    """
+    if not filters:
+        return apireader.walk_apis(store)
+    with ApiIndex(index_file(store.data_dir, index)) as api_index:
+        if update or api_index.stale:
+            api_index.update(store.data_dir)
+        return api_index.walk_apis(store, filters)
+
+
+@click.command()
+@click.option('--data-dir', '-d', default='.', help='API 数据文件目录.')
+@click.option('--index', '-i', default=None, help='索引文件名（默认为数据目录下的 apiindex.db）.')
+@click.option('--keep-list-item', '-k', default=None, type=int,
+              help='列表中保留的项数（计算 body 结构的指纹时，默认为索引原来的参数或 3）.')
+@click.option('--max-body-size', '-m', default=None, type=int,
+              help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制，默认为索引原来的参数或 64）.')
+@click.option('--update/--no-update', default=True, help='是否先更新索引.')
+@click.option('--filter', '-F', 'filters', multiple=True, help='过滤条件，输出符合条件的 session（允许指定多个）.')
+def run(data_dir, index, keep_list_item, max_body_size, update, filters):
+    if max_body_size is not None:
+        max_body_size <<= 20
+    with ApiIndex(index_file(data_dir, index), keep_list_item, max_body_size) as api_index:
+        if update or api_index.stale:
+            api_index.update(data_dir)
+            print(api_index, file=sys.stderr)
+        if filters:
+            columns = ('path', 'time', 'latency', 'method', 'url_path', 'status', 'fingerprint')
+            for row in api_index.select(filters, columns):
+                print('\t'.join('' if value is None else str(value) for value in row))
+
+
+if __name__ == "__main__":
+    run()
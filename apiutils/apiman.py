@@ -9,38 +9,41 @@ from urllib.parse import parse_qs
 import click
 import genson
 import jsonschema
+from apiutils import apicache
+from apiutils import apiindex
+from apiutils import apireader
+from apiutils import apistore
+from apiutils import apiwatch
+from apiutils import jsonlib
 from apiutils import util
 
 
-class HTTPMessage(object):
-    headers = dict()
-    body = b''
-    decoded_body = ''
-    simplified_body = ''
-    schema = None
-
-    def parse_body(self, keep_list_item):
-        self.decoded_body = util.decode_body(self.headers, self.body)
+class HTTPMessage(apireader.HTTPMessage):
+    def parse_body(self, keep_list_item, max_body_size=0):
+        self.decoded_body = util.decode_body(self.headers, self.body, max_body_size)
 
+        # 简化数据，只保留部分数据，并保存数据 Schema 以供比较。
+        # 不是 JSON、嵌套太深（见 util.MAX_JSON_DEPTH）或者生成 Schema 出错时保留原文
         # noinspection PyBroadException
         try:
-            obj = json.loads(self.decoded_body)
+            obj = util.json_loads_simplified(self.decoded_body, keep_list_item, util.MAX_JSON_DEPTH)
+            simplified_body = jsonlib.dumps(obj)
+            schema = genson.Schema()
+            schema.add_object(obj)
+            schema = schema.to_schema()
         except:
             self.simplified_body = self.decoded_body
             return
 
-        # 简化数据，只保留部分数据
-        util.simplify(obj, keep_list_item)
-        self.simplified_body = json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
-
-        # 保存数据 Schema 以供比较
-        self.schema = genson.Schema()
-        self.schema.add_object(obj)
+        self.simplified_body = simplified_body
+        self.schema = schema
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            return self.schema.to_json(sort_keys=True) == other.schema.to_json(sort_keys=True)
-        return self.simplified_body == other.simplified_body
+    def body_key(self):
+        """比较 body 用的 key：有 schema 时比较 schema，否则比较简化后的 body
+        """
+        if self.schema:
+            return 'schema', jsonlib.dumps(self.schema)
+        return 'body', self.simplified_body
 
 
 class Request(HTTPMessage):
@@ -49,8 +52,8 @@ class Request(HTTPMessage):
         self.payload = payload
 
         self.request_line, raw_headers, self.body = util.http_split_message(payload)
-        self.raw_headers = util.hack_gor_real_ip(raw_headers)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.headers = util.http_parse_headers(raw_headers, real_ip=True)
+        self.raw_headers = util.http_headers_text(raw_headers, self.headers)
         self.method, self.url, self.version = self.request_line.split(' ')
 
         self.host = self.headers.get('host', 'n/a')
@@ -59,8 +62,8 @@ class Request(HTTPMessage):
     def __str__(self):
         return '%s %s' % (self.timestamp, self.request_line)
 
-    def like(self, other):
-        return self.method == other.method and self.compare_body(other)
+    def key(self):
+        return self.method, self.body_key()
 
 
 class Response(HTTPMessage):
@@ -68,28 +71,28 @@ class Response(HTTPMessage):
         self.latency = latency
         self.payload = payload
 
-        self.response_line, self.raw_headers, self.body = util.http_split_message(payload)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.response_line, raw_headers, self.body = util.http_split_message(payload)
+        self.headers = util.http_parse_headers(raw_headers)
+        self.raw_headers = util.http_headers_text(raw_headers)
         self.version, self.status_code, self.reason = self.response_line.split(' ', 2)
 
     def __str__(self):
         return '%s %s' % (self.latency, self.response_line)
 
-    def like(self, other):
-        return self.response_line == other.response_line and self.compare_body(other)
+    def key(self):
+        return self.response_line, self.code_key(), self.body_key()
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            # !!! 这里已经深入 API 数据内部，不再是通用的代码
-            # 如果 Response 中的 code 不同则认为不同
-            data = json.loads(self.simplified_body)
+    def code_key(self):
+        # !!! 这里已经深入 API 数据内部，不再是通用的代码
+        # 如果 Response 中的 code 不同则认为不同（schema 相同时，要么都有 code，要么都没有）
+        if self.schema:
+            data = jsonlib.loads(self.simplified_body)
             if isinstance(data, dict) and 'code' in data:
-                other_data = json.loads(other.simplified_body)
-                if isinstance(other_data, dict) and 'code' in other_data:
-                    if data['code'] != other_data['code']:
-                        return False
-
-        return super().compare_body(other)
+                code = data['code']
+                if isinstance(code, (dict, list)):
+                    return 'json', jsonlib.dumps(code)
+                return 'code', code
+        return None
 
 
 class ApiSession(object):
@@ -104,8 +107,10 @@ class ApiSession(object):
 
         self.parameters = parse_qs(request.query)
 
-    def like(self, other):
-        return self.request.like(other.request) and self.response.like(other.response)
+    def key(self):
+        """request 和 response 的 key 都相同的 session 认为是重复的
+        """
+        return self.request.key(), self.response.key()
 
 
 class Api:
@@ -115,14 +120,17 @@ class Api:
 
     def __init__(self):
         self.sessions = []
+        # 已有 session 的 key（ApiSession.key），用来去重
+        self.keys = set()
         self.parameters = collections.OrderedDict()
 
     def add_session(self, session):
         # 检查是不是和原来的 session 重复
-        for s in self.sessions:
-            if s.like(session):
-                return
+        key = session.key()
+        if key in self.keys:
+            return
 
+        self.keys.add(key)
         self.sessions.append(session)
         if self.path is None:
             self.path = session.request.path
@@ -228,22 +236,48 @@ class Postman(dict):
 
 
 class ApiMan(object):
-    def __init__(self, title, host, keep_list_item, data_dir, output_file):
+    def __init__(self, title, host, keep_list_item, data_dir, output_file, max_body_size=0, jobs=1, cache_file=None,
+                 filters=(), index_file=None, update_index=False):
         self.title = title
         self.host = host.rstrip('/')
         self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
         self.data_dir = data_dir
+        self.store = apistore.ApiStore(data_dir)
+        self.filters = filters
+        self.index_file = index_file
+        self.update_index = update_index
         self.output_file = output_file
+        cache = apicache.ParseCache(cache_file, 'apiman', keep_list_item, max_body_size) if cache_file else None
+        self.loader = apireader.SessionLoader(
+            self.store, keep_list_item, max_body_size, Request, Response, ApiSession, jobs, cache)
 
         self.postman = Postman(title)
 
     def run(self):
-        for root, _, files in os.walk(self.data_dir):
-            apifiles = [fn for fn in files if fn.endswith('.api')]
-            if not apifiles:
-                continue
-            # noinspection PyTypeChecker
-            folder = self.process_folder(root, apifiles)
+        groups = apiindex.walk_apis(self.store, self.filters, self.index_file, self.update_index)
+        with self.loader:
+            self.loader.prefetch(groups)
+            for root, apis in groups:
+                folder = self.process_folder(root, apis)
+                self.postman.folders.append(folder)
+            if not self.filters:
+                self.loader.prune(groups)
+
+        self.validate()
+        self.output()
+
+    def watch(self, interval):
+        """每 interval 秒检查一次数据目录，只重新生成有变化的 API，再替换整个输出文件
+        """
+        watcher = apiwatch.ApiWatcher(self.store, self.loader, self.filters, self.index_file)
+        watcher.run(interval, self.process_action, self.write_actions)
+
+    def write_actions(self, groups, actions):
+        self.postman = Postman(self.title)
+        for root, names in groups:
+            folder = Postman.Folder(root.lstrip('./'))
+            folder.actions.extend(actions[root, name] for name in names)
             self.postman.folders.append(folder)
 
         self.validate()
@@ -267,46 +301,34 @@ class ApiMan(object):
             print(e.message)
 
     def output(self):
-        with open(self.output_file, 'w') as fp:
-            json.dump(
-                self.postman,
-                fp,
-                ensure_ascii=False,
-                sort_keys=True,
-                indent=2
-            )
-
-    def process_folder(self, root, apifiles):
-        folder = Postman.Folder(root.lstrip('./'))
-
-        actions = collections.OrderedDict()
+        util.atomic_write(self.output_file, jsonlib.dumps(self.postman))
 
-        # 按名称分组
-        for filename in apifiles:
-            name = re.sub(r'^[\d_]+-(.*?)\.api', r'\1', filename)
-            actions.setdefault(name, []).append(filename)
+    def process_folder(self, root, apis):
+        folder = Postman.Folder(root.lstrip('./'))
 
-        for name, filenames in actions.items():
+        for name, filenames in apis.items():
             action = self.process_action(root, name, filenames)
             folder.actions.append(action)
 
         return folder
 
     def process_action(self, root, apiname, filenames):
-        api = Api()
-        for filename in filenames:
-            api.add_session(self.read_session(Path(root) / filename))
+        # session 中的 payload 和 body 只在 with 中有效
+        with self.loader.load([Path(root) / filename for filename in filenames]) as sessions:
+            api = Api()
+            for session in sessions:
+                api.add_session(session)
 
-        action = Postman.Action('%s [%s]' % (apiname, api.path))
+            action = Postman.Action('%s [%s]' % (apiname, api.path))
 
-        for seq_no, session in enumerate(api.sessions, 1):
-            request = self.create_request(session.request)
-            if seq_no == 1:
-                action.request = request
-            response = self.create_response(seq_no, request, session.response)
-            action.responses.append(response)
+            for seq_no, session in enumerate(api.sessions, 1):
+                request = self.create_request(session.request)
+                if seq_no == 1:
+                    action.request = request
+                response = self.create_response(seq_no, request, session.response)
+                action.responses.append(response)
 
-        return action
+            return action
 
     def create_request(self, req):
         url = '%s%s' % (self.host, req.url)
@@ -326,62 +348,22 @@ class ApiMan(object):
             resp.simplified_body,
         )
 
-    def read_session(self, apifile):
-        fp = apifile.open('rb')
-
-        # API Headers
-        headers = self.read_headers(fp)
-        timestamp = headers.get('request-time', 'N/A')
-        latency = headers.get('latency', 'N/A')
-
-        # Request
-        line = fp.readline()
-        if not line.startswith(b'Request '):
-            print('API 文件格式错误(1):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        request = Request(timestamp, payload)
-        request.parse_body(self.keep_list_item)
-
-        # Skip empty line
-        line = fp.readline()
-        if line != b'\r\n':
-            print('API 文件格式错误(2):', fp.name)
-            return
-
-        # Response
-        line = fp.readline()
-        if not line.startswith(b'Response '):
-            print('API 文件格式错误(3):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        response = Response(latency, payload)
-        response.parse_body(self.keep_list_item)
-
-        return ApiSession(request, response)
-
-    @staticmethod
-    def read_headers(fp):
-        headers = {}
-        for line in fp:
-            if line == b'\r\n':
-                break
-            name, _, value = line.decode().partition(':')
-            headers[name.lower()] = value.strip()
-        return headers
-
 
 @click.command()
 @click.option('--title', '-t', default=None, help='API 标题.')
 @click.option('--host', '-h', default='http://{host}', help='API 主机.')
 @click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
 @click.option('--data-dir', '-d', default='.', help='API 数据文件目录.')
+@click.option('--max-body-size', '-m', default=64, help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制）.')
 @click.option('--output', '-o', help='Postman 文件名.')
-def run(title, host, keep_list_item, data_dir, output):
+@click.option('--jobs', '-j', default=1, help='读取 API 数据文件的进程数（0 表示 CPU 数）.')
+@click.option('--cache', '-c', default=None, help='解析结果的缓存文件（SQLite），没有变化的 API 数据文件直接使用缓存.')
+@click.option('--filter', '-F', 'filters', multiple=True, help='过滤条件，只使用索引中符合条件的 session（允许指定多个）.')
+@click.option('--index', '-i', default=None, help='索引文件名（默认为数据目录下的 apiindex.db）.')
+@click.option('--update-index', '-U', is_flag=True, help='使用索引前先更新（默认只在没有索引时建立）.')
+@click.option('--watch', '-w', default=0, help='每隔多少秒检查一次数据目录，增量更新输出文件（0 表示只生成一次）.')
+def run(title, host, keep_list_item, data_dir, max_body_size, output, jobs, cache, filters, index, update_index,
+        watch):
     if not output:
         if title is not None:
             output = 'apiman-%s.json' % (re.sub('[^\w.]', '-', title).lower())
@@ -389,8 +371,12 @@ def run(title, host, keep_list_item, data_dir, output):
             output = 'apiman.json'
     if title is None:
         title = 'API - Apiman'
-    apiblue = ApiMan(title, host, keep_list_item, data_dir, output)
-    apiblue.run()
+    apiblue = ApiMan(title, host, keep_list_item, data_dir, output, max_body_size << 20, jobs, cache,
+                     filters, index, update_index)
+    if watch:
+        apiblue.watch(watch)
+    else:
+        apiblue.run()
 
 
 if __name__ == "__main__":
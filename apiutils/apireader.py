@@ -0,0 +1,486 @@
+"""读取 API 数据文件（.api 文件或 segment 中的记录）
+
+    with apireader.ApiReader(store, keep_list_item, max_body_size) as reader:
+        session = reader.read_session(apifile, Request, Response, ApiSession)
+
+* 小文件一次读入，大文件和 segment 文件用 mmap 映射，Request 和 Response 的 payload、body
+  都是这些数据的切片（memoryview），不复制
+* body 在第一次访问 decoded_body、simplified_body 或 schema 时才解码
+* 关闭 reader 时释放所有切片并关闭映射的文件，之后不能再访问 payload 和 body（以及还没有解码的 body），
+  所以要在关闭前用完 session
+* 文件格式错误时抛出 ApiFormatError
+
+SessionLoader 在此基础上按顺序读取各个 API 的 session，可以用进程池并行读取。
+"""
+import collections
+import contextlib
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import signal
+import sys
+from pathlib import Path
+
+from apiutils import apistore
+from apiutils import util
+
+# 小于这个大小的文件直接读入内存：mmap 对小文件没有好处，而且每个映射要占用一个文件描述符
+MMAP_THRESHOLD = 64 << 10
+
+
+class ApiFormatError(ValueError):
+    """API 文件格式错误
+
+    code 是错误的位置：1 Request 行，2 Request 后的空行，3 Response 行
+    """
+    def __init__(self, filename, code, line=b''):
+        super().__init__('API 文件格式错误(%d): %s' % (code, filename))
+        self.filename = filename
+        self.code = code
+        self.line = line
+
+    def __reduce__(self):
+        # 从进程池中返回时需要 pickle
+        return self.__class__, (self.filename, self.code, self.line)
+
+
+class ApiRecord(object):
+    """一个 .api 文件的内容：API Headers 和 Request、Response 的 payload（memoryview）
+    """
+    def __init__(self, name, headers, request, response):
+        self.name = name
+        self.headers = headers
+        self.timestamp = headers.get('request-time', 'N/A')
+        self.latency = headers.get('latency', 'N/A')
+        self.request = request
+        self.response = response
+
+    def release(self):
+        self.request.release()
+        self.response.release()
+
+
+def parse_record(data, name, start=0, end=None):
+    """解析 data[start:end] 中的一个 .api 文件，data 是 bytes 或 mmap
+
+    文件格式::
+
+        Request-Time: ...\\r\\n
+        Latency: ...\\r\\n
+        \\r\\n
+        Request <length>\\r\\n
+        <payload>\\r\\n
+        Response <length>\\r\\n
+        <payload>
+    """
+    if end is None:
+        end = len(data)
+    find = data.find
+    pos = start
+
+    def readline():
+        nonlocal pos
+        line_start = pos
+        line_end = find(b'\n', pos, end)
+        pos = end if line_end < 0 else line_end + 1
+        return data[line_start:pos]
+
+    def read_payload(prefix, code):
+        nonlocal pos
+        line = readline()
+        if not line.startswith(prefix):
+            raise ApiFormatError(name, code, line)
+        try:
+            length = int(line[len(prefix):])
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ApiFormatError(name, code, line)
+        payload = (pos, min(pos + length, end))
+        pos = payload[1]
+        return payload
+
+    # API Headers
+    headers = {}
+    while pos < end:
+        line = readline()
+        if line == b'\r\n':
+            break
+        key, _, value = line.decode(errors='replace').partition(':')
+        headers[key.lower()] = value.strip()
+
+    request = read_payload(b'Request ', 1)
+    line = readline()
+    if line != b'\r\n':
+        raise ApiFormatError(name, 2, line)
+    response = read_payload(b'Response ', 3)
+
+    # 格式正确才创建切片，出错时没有需要释放的切片
+    view = memoryview(data)
+    return ApiRecord(name, headers, view[request[0]:request[1]], view[response[0]:response[1]])
+
+
+class LazyBody(object):
+    """HTTPMessage 中解码 body 得到的属性，第一次访问时解码
+
+    这是非数据描述符，parse_body 把结果保存到实例的属性中以后，直接访问实例的属性，不再经过这里。
+    """
+    def __init__(self, default):
+        self.default = default
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        instance.load_body()
+        return instance.__dict__.get(self.name, self.default)
+
+
+class HTTPMessage(object):
+    """Request 和 Response 的基类，parse_body(keep_list_item, max_body_size) 解码 body，
+    设置 decoded_body、simplified_body 和 schema。默认只解码和简化 body，子类可以覆盖它，另外生成 schema 等
+    """
+    headers = dict()
+    payload = b''
+    body = b''
+    decoded_body = LazyBody('')
+    simplified_body = LazyBody('')
+    schema = LazyBody(None)
+    _body_args = None
+
+    def parse_body(self, keep_list_item, max_body_size=0):
+        self.decoded_body = util.decode_body(self.headers, self.body, max_body_size)
+        self.simplified_body = util.simplify_body(self.decoded_body, keep_list_item)
+
+    def defer_body(self, keep_list_item, max_body_size=0):
+        """第一次访问 decoded_body 等属性时再调用 parse_body
+        """
+        self._body_args = (keep_list_item, max_body_size)
+
+    def load_body(self):
+        args = self._body_args
+        if args is not None:
+            self._body_args = None
+            self.parse_body(*args)
+
+    def release(self):
+        """释放 payload 和 body 的切片
+        """
+        for view in (self.body, self.payload):
+            if isinstance(view, memoryview):
+                view.release()
+
+    def detach(self):
+        """解码 body，然后去掉 payload、body 和 decoded_body，只留下生成文档需要的数据，
+        这样 session 不再引用文件的数据，而且可以 pickle（从进程池中返回）
+
+        生成文档时只用 body 判断是否为空，所以只保留 body 的第一个字节。
+        """
+        self.load_body()
+        self.body = bytes(self.body[:1])
+        self.payload = b''
+        self.__dict__.pop('decoded_body', None)
+
+
+class ApiReader(object):
+    """读取 API 数据文件，关闭时释放读取的所有数据，见模块的说明
+    """
+    def __init__(self, store=None, keep_list_item=3, max_body_size=0):
+        self.store = store if store is not None else apistore.ApiStore('.')
+        self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
+        # segment 文件名 -> mmap，在多条记录间共用
+        self.segments = {}
+        # 映射的 .api 文件
+        self.maps = []
+        # 需要释放的对象
+        self.opened = []
+
+    @staticmethod
+    def map(filename):
+        with open(filename, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                return fp.read()
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, apifile):
+        """读取 apifile，返回 ApiRecord，格式错误时抛出 ApiFormatError
+        """
+        filename, offset, length = self.store.locate(apifile)
+        if length is None:
+            data = self.map(filename)
+            end = len(data)
+            if isinstance(data, mmap.mmap):
+                self.maps.append(data)
+        else:
+            data = self.segments.get(filename)
+            if data is None:
+                data = self.segments[filename] = self.map(filename)
+            end = min(offset + length, len(data))
+        record = parse_record(data, str(apifile), offset, end)
+        self.opened.append(record)
+        return record
+
+    def read_session(self, apifile, new_request, new_response, new_session):
+        """读取 apifile，用 new_request(timestamp, payload)、new_response(latency, payload) 和
+        new_session(request, response) 创建 session
+        """
+        record = self.read(apifile)
+
+        request = new_request(record.timestamp, record.request)
+        self.opened.append(request)
+        request.defer_body(self.keep_list_item, self.max_body_size)
+
+        response = new_response(record.latency, record.response)
+        self.opened.append(response)
+        response.defer_body(self.keep_list_item, self.max_body_size)
+
+        return new_session(request, response)
+
+    def release(self):
+        """释放读取的所有切片，关闭映射的 .api 文件，segment 文件保持打开
+        """
+        for item in self.opened:
+            item.release()
+        self.opened = []
+        self.maps = self.close_maps(self.maps)
+
+    def close(self):
+        self.release()
+        self.close_maps(self.segments.values())
+        self.segments = {}
+
+    @staticmethod
+    def close_maps(maps):
+        for data in maps:
+            if isinstance(data, mmap.mmap):
+                try:
+                    data.close()
+                except BufferError:
+                    # 还有切片没有释放（例如出错时异常中还引用着 Request），由垃圾回收关闭
+                    pass
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def api_name(filename):
+    """.api 文件名中的 API 名称：去掉前面的时间和后缀
+    """
+    return re.sub(r'^[\d_]+-(.*?)\.api', r'\1', filename)
+
+
+def walk_apis(store):
+    """遍历 store，返回 [(root, {API 名称: [文件名, ...]}), ...]，只包括有 .api 文件的目录
+    """
+    groups = []
+    for root, _, files in store.walk():
+        apis = collections.OrderedDict()
+        for filename in files:
+            if filename.endswith('.api'):
+                apis.setdefault(api_name(filename), []).append(filename)
+        if apis:
+            groups.append((root, apis))
+    return groups
+
+
+def _restore(cls, state):
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+
+def dump_session(session):
+    """把 detach 以后的 session 转成 bytes，只保存各个对象的属性，不保存类（可能是 __main__ 中的类）
+    """
+    state = dict(vars(session))
+    request = state.pop('request')
+    response = state.pop('response')
+    return pickle.dumps((vars(request), vars(response), state), pickle.HIGHEST_PROTOCOL)
+
+
+def restore_session(data, new_request, new_response, new_session):
+    """dump_session 的逆操作，new_request 等是 Request、Response 和 ApiSession 类
+    """
+    request_state, response_state, state = pickle.loads(data)
+    session = _restore(new_session, state)
+    session.request = _restore(new_request, request_state)
+    session.response = _restore(new_response, response_state)
+    return session
+
+
+# 进程池中每个进程的 ApiReader 和创建 session 的参数
+_worker = None
+
+
+def _init_worker(store, keep_list_item, max_body_size, factories):
+    global _worker
+    # 父进程（apiwatch）可能改了 SIGTERM 的处理，Pool.terminate 时直接退出
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _worker = ApiReader(store, keep_list_item, max_body_size), factories
+
+
+def _read_detached(reader, apifile, factories):
+    """读取 session 并 detach，返回 (session, 错误)
+    """
+    try:
+        session = reader.read_session(apifile, *factories)
+    except ApiFormatError as e:
+        return None, e
+    else:
+        session.request.detach()
+        session.response.detach()
+        return session, None
+    finally:
+        reader.release()
+
+
+def _load_session(apifile):
+    reader, factories = _worker
+    session, error = _read_detached(reader, apifile, factories)
+    return str(apifile), dump_session(session) if session is not None else None, error
+
+
+class SessionLoader(object):
+    """按顺序读取各个 API 的 session::
+
+        groups = walk_apis(store)
+        with SessionLoader(store, keep_list_item, max_body_size, Request, Response, ApiSession, jobs) as loader:
+            loader.prefetch(groups)
+            for root, apis in groups:
+                for name, filenames in apis.items():
+                    with loader.load([Path(root) / filename for filename in filenames]) as sessions:
+                        ...
+
+    jobs 为 1 时和 ApiReader 一样在本进程中读取；大于 1 时（0 表示 CPU 数），prefetch 在进程池中
+    读取所有文件，解码 body 后用 detach 得到精简的 session 传回来，load 按 prefetch 的顺序取出。
+    两种方式得到的 session 和顺序完全一样。格式错误的文件输出到 stderr 后跳过。
+
+    指定 cache（apicache.ParseCache）时，没有变化的文件直接使用缓存中的 session，其他文件读取后
+    保存到缓存中。
+    """
+    def __init__(self, store, keep_list_item, max_body_size, new_request, new_response, new_session, jobs=1,
+                 cache=None):
+        self.store = store
+        self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
+        self.factories = (new_request, new_response, new_session)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache = cache
+        self.pool = None
+        self.results = None
+        # 在进程池中读取的文件
+        self.submitted = set()
+        # 文件 -> 缓存用的 signature（prefetch 时已经 stat 过的文件）
+        self.signatures = {}
+
+    def signature(self, apifile):
+        signature = self.signatures.pop(str(apifile), None)
+        if signature is None:
+            signature = self.store.signature(apifile)
+        return signature
+
+    def prefetch(self, groups):
+        """groups 是 walk_apis 的结果，之后要按同样的顺序 load 其中的文件
+        """
+        # 上次 prefetch 的文件可能没有全部 load（例如 apiwatch 处理时出错），丢掉剩下的结果
+        self.close_pool(terminate=bool(self.submitted))
+        self.submitted = set()
+        apifiles = [Path(root) / filename
+                    for root, apis in groups for filenames in apis.values() for filename in filenames]
+        if self.cache is not None:
+            # 缓存中有的文件不用读
+            missing = []
+            for apifile in apifiles:
+                signature = self.signatures[str(apifile)] = self.store.signature(apifile)
+                if not self.cache.contains(apifile, signature):
+                    missing.append(apifile)
+            apifiles = missing
+        if self.jobs <= 1 or not apifiles:
+            return
+        self.submitted = set(map(str, apifiles))
+        # 多次 prefetch（例如 apiwatch）时每次用新的进程池：进程中的 store 和 mmap 是创建时的，segment 会变大
+        self.pool = multiprocessing.Pool(self.jobs, _init_worker, (
+            self.store, self.keep_list_item, self.max_body_size, self.factories))
+        # 每次给每个进程一批文件，减少进程间通信的次数
+        chunksize = max(1, min(256, len(apifiles) // (self.jobs * 8)))
+        self.results = self.pool.imap(_load_session, apifiles, chunksize)
+
+    @contextlib.contextmanager
+    def load(self, apifiles):
+        with ApiReader(self.store, self.keep_list_item, self.max_body_size) as reader:
+            yield self.sessions(reader, apifiles)
+
+    def sessions(self, reader, apifiles):
+        for apifile in apifiles:
+            name = str(apifile)
+            signature = self.signature(apifile) if self.cache is not None else None
+            if name in self.submitted:
+                self.submitted.discard(name)
+                result_name, data, error = next(self.results)
+                if result_name != name:
+                    raise RuntimeError('API 文件的顺序和 prefetch 不同: %s != %s' % (name, result_name))
+                session = restore_session(data, *self.factories) if data is not None else None
+            elif self.cache is not None:
+                data = self.cache.get(apifile, signature)
+                if data is not None:
+                    yield restore_session(data, *self.factories)
+                    continue
+                session, error = _read_detached(reader, apifile, self.factories)
+                data = dump_session(session) if session is not None else None
+            else:
+                # 不用缓存时不必 detach，body 用到时才解码
+                try:
+                    session, error = reader.read_session(apifile, *self.factories), None
+                except ApiFormatError as e:
+                    session, error = None, e
+
+            if error is not None:
+                print(error, file=sys.stderr)
+                continue
+            if self.cache is not None:
+                self.cache.put(apifile, signature, data)
+            yield session
+
+    def prune(self, groups):
+        """groups 是整个数据目录的 walk_apis 的结果（没有过滤条件），删除其中没有的文件的缓存
+        """
+        if self.cache is not None:
+            self.cache.prune(Path(root) / filename
+                             for root, apis in groups for filenames in apis.values() for filename in filenames)
+
+    def flush(self):
+        """提交缓存，让其他进程可以写入同一个缓存文件
+        """
+        if self.cache is not None:
+            self.cache.commit()
+
+    def close_pool(self, terminate=False):
+        if self.pool is not None:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = self.results = None
+
+    def close(self, terminate=False):
+        self.close_pool(terminate)
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(terminate=exc_type is not None)
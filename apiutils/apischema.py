@@ -1,30 +1,13 @@
 import click
+from apiutils import jsonlib
 
 
 def build_object(data, descriptions):
-    properties = {}
-    for name, value in data.items():
-        schema = build_schema(value, descriptions)
-        if descriptions and name in descriptions:
-            schema.update(description=descriptions[name])
-        properties[name] = schema
-    schema = {
-        'type': 'object',
-    }
-    if properties:
-        schema.update(properties=properties)
-    return schema
+    return build_schema(data, descriptions)
 
 
 def build_array(data, descriptions):
-     if len(data):
-        items = build_schema(data[0], descriptions)
-     else:
-        items = build_schema(None)
-     return {
-        'type': 'array',
-        'items': items
-     }
+    return build_schema(data, descriptions)
 
 
 def build_number(data):
@@ -54,12 +37,8 @@ def build_string(data):
     }
 
 
-def build_schema(data, descriptions=None):
-    if isinstance(data, dict):
-        return build_object(data, descriptions)
-    elif isinstance(data, list):
-        return build_array(data, descriptions)
-    elif isinstance(data, bool):
+def build_scalar(data):
+    if isinstance(data, bool):
         return build_boolean(data)
     elif isinstance(data, int):
         return build_number(data)
@@ -69,15 +48,53 @@ def build_schema(data, descriptions=None):
         return build_string(data)
 
 
+def build_schema(data, descriptions=None):
+    """生成 JSON 数据的 Schema
+
+    用栈代替递归，嵌套多深都可以：先生成外层的 Schema，内层的对象和列表放到栈中以后再填写。
+    """
+    if not isinstance(data, (dict, list)):
+        return build_scalar(data)
+
+    schema = {}
+    # (对象或列表, 要填写的 Schema, 属性名)
+    stack = [(data, schema, None)]
+    while stack:
+        data, target, key = stack.pop()
+        if isinstance(data, dict):
+            target['type'] = 'object'
+            if data:
+                properties = target['properties'] = {}
+                for name, value in data.items():
+                    if isinstance(value, (dict, list)):
+                        # 先占好位置，保证各个属性的顺序
+                        properties[name] = child = {}
+                        stack.append((value, child, name))
+                        continue
+                    properties[name] = child = build_scalar(value)
+                    if descriptions and name in descriptions:
+                        child['description'] = descriptions[name]
+        else:
+            item = data[0] if len(data) else None
+            target['type'] = 'array'
+            if isinstance(item, (dict, list)):
+                target['items'] = child = {}
+                stack.append((item, child, None))
+            else:
+                target['items'] = build_scalar(item)
+        if key is not None and descriptions and key in descriptions:
+            target['description'] = descriptions[key]
+    return schema
+
+
 @click.command()
 def run():
     import sys
-    import json
 
     text = sys.stdin.read()
-    data = json.loads(text)
+    data = jsonlib.loads(text)
     schema = build_schema(data)
-    print(json.dumps(schema, ensure_ascii=False, sort_keys=True, indent=2))
+    print(jsonlib.dumps(schema))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+"""API 数据文件的存储
+
+* 目录树：每个 session 一个 .api 文件，目录结构和 URL 路径一致（原来的方式）
+* segment：session 追加写入滚动的 segment 文件，索引文件记录每条记录的位置
+
+segment 中每条记录的格式和 .api 文件完全相同，索引文件每行一条记录::
+
+    <offset> <length> <path>
+
+其中 path 是这条记录在目录树方式下的相对路径。读取时 ApiStore 把 segment 中的记录当作
+目录树中的 .api 文件，所以各个工具不必关心数据是怎么保存的。
+"""
+import collections
+import contextlib
+import io
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+
+class TreeWriter(object):
+    """每个 session 保存为一个 .api 文件
+    """
+    # 各个文件互不相关，允许多个线程同时写
+    thread_safe = True
+
+    def __init__(self, save_dir):
+        self.save_dir = Path(save_dir)
+
+    def write(self, relpath, lines):
+        filepath = self.save_dir / relpath
+        path = filepath.parent
+        if not path.exists():
+            path.mkdir(0o777, True, True)
+        with filepath.open('wb') as fp:
+            fp.writelines(lines)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SegmentWriter(object):
+    """追加写入 segment 文件，超过 segment_size 字节后换一个新文件
+
+    写入时距离上次 flush 超过 flush_interval 秒就 flush 一次，不用 BackgroundWriter 时其他工具也能
+    及时读到新的记录，进程被杀掉时最多丢失这段时间的数据。
+    """
+    thread_safe = False
+
+    def __init__(self, save_dir, segment_size=256 << 20, prefix='segment', flush_interval=1.0):
+        self.save_dir = Path(save_dir)
+        self.segment_size = segment_size
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+        self.segment_no = self.last_segment_no()
+        self.fp = None
+        self.index = None
+        self.size = 0
+
+    def last_segment_no(self):
+        pattern = re.compile(r'^%s-(\d+)%s$' % (re.escape(self.prefix), re.escape(SEGMENT_SUFFIX)))
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(str(self.save_dir))) if m]
+        return max(numbers, default=0)
+
+    def open_segment(self):
+        # 总是写到新的 segment 文件中，不去追加已有的文件
+        self.segment_no += 1
+        name = '%s-%06d' % (self.prefix, self.segment_no)
+        self.fp = (self.save_dir / (name + SEGMENT_SUFFIX)).open('wb')
+        self.index = (self.save_dir / (name + INDEX_SUFFIX)).open('w', encoding='utf-8')
+        self.size = 0
+
+    def write(self, relpath, lines):
+        if self.fp is None:
+            self.open_segment()
+        data = b''.join(lines)
+        self.fp.write(data)
+        self.index.write('%d %d %s\n' % (self.size, len(data), relpath))
+        self.size += len(data)
+        if self.size >= self.segment_size:
+            self.close()
+        elif time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        # 先写数据再写索引，索引中的记录总是指向已经写入的数据
+        if self.fp is not None:
+            self.fp.flush()
+            self.index.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.fp is not None:
+            self.flush()
+            self.fp.close()
+            self.index.close()
+            self.fp = self.index = None
+
+
+class BackgroundWriter(object):
+    """在后台线程中写入，保存 API 时不必等待磁盘 IO
+
+    队列满时的处理方式 (policy):
+
+    * block: 等待队列有空位
+    * drop-newest: 丢弃新的数据
+    * drop-oldest: 丢弃队列中最早的数据
+
+    后台线程每次从队列中取出一批数据，同一路径只写最后一次（和目录树方式下覆盖同名文件一样），
+    并每隔 flush_interval 秒 flush 一次。写入或 flush 出错（磁盘满等）时记录日志并计入 failed，
+    线程继续处理队列中的数据，不会让写入的一方一直阻塞。
+    """
+    POLICIES = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, writer, threads=1, queue_size=1024, policy='block', flush_interval=1.0, batch_size=256):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown policy: %s' % policy)
+        self.writer = writer
+        self.policy = policy
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.write_lock = contextlib.nullcontext() if writer.thread_safe else self.lock
+        self.last_flush = time.monotonic()
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.threads = [threading.Thread(target=self.run, name='apistore-writer-%d' % i, daemon=True)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, relpath, lines):
+        item = (relpath, lines)
+        if self.policy == 'block':
+            self.queue.put(item)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            with self.lock:
+                self.dropped += 1
+            if self.policy == 'drop-newest':
+                return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            # None 表示结束，每个线程只取一个
+            while item is not None:
+                if item:
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+
+            items = collections.OrderedDict()
+            for relpath, lines in batch:
+                items.pop(relpath, None)
+                items[relpath] = lines
+
+            failed = 0
+            with self.write_lock:
+                for relpath, lines in items.items():
+                    try:
+                        self.writer.write(relpath, lines)
+                    except Exception:
+                        logging.exception('failed to write %s', relpath)
+                        failed += 1
+            with self.lock:
+                self.written += len(items) - failed
+                self.failed += failed
+                self.coalesced += len(batch) - len(items)
+                if time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.last_flush = time.monotonic()
+                    try:
+                        self.writer.flush()
+                    except Exception:
+                        logging.exception('failed to flush')
+
+    def close(self):
+        # 意外退出的线程不会再取队列中的数据
+        threads = [thread for thread in self.threads if thread.is_alive()]
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.writer.close()
+
+    def __str__(self):
+        return 'queued: %d, written: %d, coalesced: %d, dropped: %d, failed: %d' % (
+            self.queue.qsize(), self.written, self.coalesced, self.dropped, self.failed)
+
+
+def read_index(index_file):
+    """读取 segment 的索引，产生 (offset, length, relpath)
+
+    忽略超出 segment 文件大小的记录（写入 segment 时中断）。
+    """
+    segment_file = index_file[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX
+    try:
+        segment_size = os.path.getsize(segment_file)
+    except OSError:
+        return
+    with open(index_file, encoding='utf-8') as fp:
+        for line in fp:
+            tokens = line.rstrip('\n').split(' ', 2)
+            if len(tokens) != 3:
+                continue
+            offset, length, relpath = int(tokens[0]), int(tokens[1]), tokens[2]
+            if offset + length > segment_size:
+                continue
+            yield offset, length, relpath
+
+
+class ApiStore(object):
+    """遍历和读取 API 数据文件，segment 中的记录看起来和目录树中的 .api 文件一样
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        # 虚拟路径 -> (segment 文件, offset, length)
+        self.records = {}
+
+    def walk(self):
+        """和 os.walk 一样产生 (root, dirs, files)
+
+        segment 中的记录按其路径放到对应的目录（root）中，路径相同时后面的记录覆盖前面的，
+        和目录树方式下同名文件被覆盖一样。
+        """
+        tree = collections.OrderedDict()
+        indexes = []
+        for root, dirs, files in os.walk(self.data_dir):
+            tree[root] = (dirs, list(files))
+            indexes.extend(os.path.join(root, fn) for fn in sorted(files) if fn.endswith(INDEX_SUFFIX))
+
+        for index_file in indexes:
+            segment_dir = os.path.dirname(index_file)
+            segment_file = index_file[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX
+            for offset, length, relpath in read_index(index_file):
+                dirname, _, filename = relpath.rpartition('/')
+                root = os.path.join(segment_dir, dirname) if dirname else segment_dir
+                path = os.path.normpath(os.path.join(root, filename))
+                if path not in self.records:
+                    tree.setdefault(root, ([], []))[1].append(filename)
+                self.records[path] = (segment_file, offset, length)
+
+        for root, (dirs, files) in tree.items():
+            yield root, dirs, files
+
+    def locate(self, apifile):
+        """返回 (文件名, offset, length)：segment 中的记录为所在的 segment 文件和位置，
+        .api 文件为 (apifile, 0, None)，即整个文件
+        """
+        record = self.records.get(os.path.normpath(str(apifile)))
+        if record is None:
+            return str(apifile), 0, None
+        return record
+
+    def add_record(self, apifile, segment_file, offset, length):
+        """不遍历目录，直接登记 segment 中的记录（例如从索引中查到的记录）
+        """
+        self.records[os.path.normpath(str(apifile))] = (segment_file, offset, length)
+
+    def signature(self, apifile):
+        """文件没有变化时 signature 不变，只需要 stat 一次文件
+
+        .api 文件用大小和修改时间；segment 文件只会追加，已经写入的记录不会变，用所在文件的 inode 和位置。
+        """
+        filename, offset, length = self.locate(apifile)
+        stat = os.stat(filename)
+        if length is None:
+            return 'file:%d:%d' % (stat.st_size, stat.st_mtime_ns)
+        return 'segment:%d:%d:%d' % (stat.st_ino, offset, length)
+
+    def open(self, apifile):
+        """打开 .api 文件，或 segment 中对应的记录
+        """
+        segment_file, offset, length = self.locate(apifile)
+        if length is None:
+            return open(segment_file, 'rb')
+
+        with open(segment_file, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+        fp = io.BytesIO(data)
+        fp.name = str(apifile)
+        return fp
@@ -1,14 +1,19 @@
 import collections
-import json
-import os
 import re
 from pathlib import Path
 from urllib.parse import parse_qs
 
 import click
 import openapi
+from apiutils import apicache
+from apiutils import apiindex
+from apiutils import apireader
+from apiutils import apistore
+from apiutils import apiwatch
+from apiutils import jsonlib
 from apiutils import util
 from apiutils.apischema import build_schema
+from openapi.model import FormDataParameterSubSchema
 from openapi.model import Operation
 from openapi.model import ParametersList
 from openapi.model import PathItem
@@ -17,34 +22,30 @@ from openapi.model import Responses
 from openapi.model import Swagger, Info, Paths
 
 
-class HTTPMessage(object):
-    headers = dict()
-    body = b''
-    decoded_body = ''
-    simplified_body = ''
-    schema = None
-
-    def parse_body(self, keep_list_item):
-        self.decoded_body = util.decode_body(self.headers, self.body)
+class HTTPMessage(apireader.HTTPMessage):
+    def parse_body(self, keep_list_item, max_body_size=0):
+        self.decoded_body = util.decode_body(self.headers, self.body, max_body_size)
 
+        # 简化数据，只保留部分数据，并保存数据 Schema 以供比较。
+        # 不是 JSON、嵌套太深（见 util.MAX_JSON_DEPTH）或者生成 Schema 出错时保留原文
         # noinspection PyBroadException
         try:
-            obj = json.loads(self.decoded_body)
+            obj = util.json_loads_simplified(self.decoded_body, keep_list_item, util.MAX_JSON_DEPTH)
+            simplified_body = jsonlib.dumps(obj)
+            schema = build_schema(obj)
         except:
             self.simplified_body = self.decoded_body
             return
 
-        # 简化数据，只保留部分数据
-        util.simplify(obj, keep_list_item)
-        self.simplified_body = json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
-
-        # 保存数据 Schema 以供比较
-        self.schema = build_schema(obj)
+        self.simplified_body = simplified_body
+        self.schema = schema
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            return json.dumps(self.schema, sort_keys=True) == json.dumps(other.schema, sort_keys=True)
-        return self.simplified_body == other.simplified_body
+    def body_key(self):
+        """比较 body 用的 key：有 schema 时比较 schema，否则比较简化后的 body
+        """
+        if self.schema:
+            return 'schema', jsonlib.dumps(self.schema)
+        return 'body', self.simplified_body
 
 
 class Request(HTTPMessage):
@@ -53,8 +54,8 @@ class Request(HTTPMessage):
         self.payload = payload
 
         self.request_line, raw_headers, self.body = util.http_split_message(payload)
-        self.raw_headers = util.hack_gor_real_ip(raw_headers)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.headers = util.http_parse_headers(raw_headers, real_ip=True)
+        self.raw_headers = util.http_headers_text(raw_headers, self.headers)
         self.method, self.url, self.version = self.request_line.split(' ')
 
         self.host = self.headers.get('host', 'n/a')
@@ -63,8 +64,8 @@ class Request(HTTPMessage):
     def __str__(self):
         return '%s %s' % (self.timestamp, self.request_line)
 
-    def like(self, other):
-        return self.method == other.method and self.compare_body(other)
+    def key(self):
+        return self.method, self.body_key()
 
 
 class Response(HTTPMessage):
@@ -72,28 +73,28 @@ class Response(HTTPMessage):
         self.latency = latency
         self.payload = payload
 
-        self.response_line, self.raw_headers, self.body = util.http_split_message(payload)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.response_line, raw_headers, self.body = util.http_split_message(payload)
+        self.headers = util.http_parse_headers(raw_headers)
+        self.raw_headers = util.http_headers_text(raw_headers)
         self.version, self.status_code, self.reason = self.response_line.split(' ', 2)
 
     def __str__(self):
         return '%s %s' % (self.latency, self.response_line)
 
-    def like(self, other):
-        return self.response_line == other.response_line and self.compare_body(other)
+    def key(self):
+        return self.response_line, self.code_key(), self.body_key()
 
-    def compare_body(self, other):
-        if self.schema and other.schema:
-            # !!! 这里已经深入 API 数据内部，不再是通用的代码
-            # 如果 Response 中的 code 不同则认为不同
-            data = json.loads(self.simplified_body)
+    def code_key(self):
+        # !!! 这里已经深入 API 数据内部，不再是通用的代码
+        # 如果 Response 中的 code 不同则认为不同（schema 相同时，要么都有 code，要么都没有）
+        if self.schema:
+            data = jsonlib.loads(self.simplified_body)
             if isinstance(data, dict) and 'code' in data:
-                other_data = json.loads(other.simplified_body)
-                if isinstance(other_data, dict) and 'code' in other_data:
-                    if data['code'] != other_data['code']:
-                        return False
-
-        return super().compare_body(other)
+                code = data['code']
+                if isinstance(code, (dict, list)):
+                    return 'json', jsonlib.dumps(code)
+                return 'code', code
+        return None
 
 
 class ApiSession(object):
@@ -106,78 +107,128 @@ class ApiSession(object):
 
         self.method = request.method
 
-        self.parameters = ParametersList()
-        parameter_names = set()
-
-        for name, value in sorted(parse_qs(request.query).items()):
-            if name in parameter_names:
-                continue
-            parameter_names.add(name)
-            if len(value) == 1:
-                value = value[0]
-            else:
-                value = ','.join(map(str, value))
-            if isinstance(value, int):
-                type = 'integer'
-            elif isinstance(value, float):
-                type = 'number'
-            else:
-                type = 'string'
-            self.parameters.append(QueryParameterSubSchema({
-                'name': name,
-                'type': type,
-                'in': 'query',
-                'default': value,
-                'description': 'TODO: description of ' + name,
-            }))
+        # 参数位置 -> {参数名: [值, ...]}
+        self.parameters = collections.OrderedDict()
+        self.parameters['query'] = parse_qs(request.query)
+        if request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            self.parameters['formData'] = parse_qs(request.decoded_body)
 
-    def like(self, other):
-        return self.request.like(other.request) and self.response.like(other.response)
+    def key(self):
+        """request 和 response 的 key 都相同的 session 认为是重复的
+        """
+        return self.request.key(), self.response.key()
+
+
+def typed_value(value, type):
+    """把参数的值转换成 type 类型
+    """
+    if type == 'integer':
+        return int(value)
+    elif type == 'number':
+        return float(value)
+    elif type == 'boolean':
+        return value.strip().lower() == 'true'
+    return value
 
 
 class Api:
     """
     """
     path = None
+    parameter_schemas = {
+        'query': QueryParameterSubSchema,
+        'formData': FormDataParameterSubSchema,
+    }
 
     def __init__(self):
         self.sessions = []
-        self.parameters = ParametersList()
-        self.parameter_names = set()
+        # 已有 session 的 key（ApiSession.key），用来去重
+        self.keys = set()
+        # (参数位置, 参数名) -> 各个 session（包括重复的）中参数的值
+        self.values = collections.OrderedDict()
 
     def add_session(self, session):
+        for in_, parameters in session.parameters.items():
+            for name, values in sorted(parameters.items()):
+                self.values.setdefault((in_, name), []).extend(values)
+
         # 检查是不是和原来的 session 重复
-        for s in self.sessions:
-            if s.like(session):
-                return
+        key = session.key()
+        if key in self.keys:
+            return
 
+        self.keys.add(key)
         self.sessions.append(session)
         if self.path is None:
             self.path = session.request.path
-        for parameter in session.parameters:
-            if parameter['name'] in self.parameter_names:
-                continue
-            self.parameter_names.add(parameter['name'])
-            self.parameters.append(parameter)
+
+    @property
+    def parameters(self):
+        """合并各个 session 中的参数，根据所有的值推断参数的类型
+        """
+        parameters = ParametersList()
+        # query 参数在前，同一位置的参数按名称排序
+        keys = sorted(self.values, key=lambda key: (key[0] != 'query', key[1]))
+        for in_, name in keys:
+            values = self.values[in_, name]
+            value_type = util.infer_type(values)
+            parameter = self.parameter_schemas[in_]({
+                'name': name,
+                'type': value_type.type,
+                'in': in_,
+                'default': typed_value(values[0], value_type.type),
+                'description': 'TODO: description of ' + name,
+            })
+            if value_type.enum:
+                parameter['enum'] = value_type.enum
+            if value_type.minimum is not None:
+                parameter['minimum'] = value_type.minimum
+                parameter['maximum'] = value_type.maximum
+            parameters.append(parameter)
+        return parameters
 
 
 class ApiSwagger(object):
-    def __init__(self, title, host, keep_list_item, data_dir, output_file):
+    def __init__(self, title, host, keep_list_item, data_dir, output_file, max_body_size=0, jobs=1, cache_file=None,
+                 filters=(), index_file=None, update_index=False):
         self.title = title
         self.host = host.rstrip('/')
         self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
         self.data_dir = data_dir
+        self.store = apistore.ApiStore(data_dir)
+        self.filters = filters
+        self.index_file = index_file
+        self.update_index = update_index
         self.output_file = output_file
+        cache = apicache.ParseCache(cache_file, 'apiswagger', keep_list_item, max_body_size) if cache_file else None
+        self.loader = apireader.SessionLoader(
+            self.store, keep_list_item, max_body_size, Request, Response, ApiSession, jobs, cache)
         self.paths = {}
         self.tag = None
 
     def run(self):
-        for root, _, files in os.walk(self.data_dir):
-            apifiles = [fn for fn in files if fn.endswith('.api')]
-            if not apifiles:
-                continue
-            # noinspection PyTypeChecker
-            self.process_folder(root, apifiles)
+        groups = apiindex.walk_apis(self.store, self.filters, self.index_file, self.update_index)
+        with self.loader:
+            self.loader.prefetch(groups)
+            for root, apis in groups:
+                self.process_folder(root, apis)
+            if not self.filters:
+                self.loader.prune(groups)
+
+        self.output()
+
+    def watch(self, interval):
+        """每 interval 秒检查一次数据目录，只重新生成有变化的 API，再替换整个输出文件
+        """
+        watcher = apiwatch.ApiWatcher(self.store, self.loader, self.filters, self.index_file)
+        watcher.run(interval, self.process_action, self.write_actions)
+
+    def write_actions(self, groups, actions):
+        self.paths = {}
+        for root, names in groups:
+            for name in names:
+                self.paths.update(actions[root, name])
 
         self.output()
 
@@ -193,95 +244,47 @@ class ApiSwagger(object):
             paths=Paths(self.paths),
         )
 
-        with open(self.output_file, 'w') as fp:
-            json.dump(swagger, fp, ensure_ascii=False, sort_keys=True, indent=2)
+        util.atomic_write(self.output_file, jsonlib.dumps(swagger))
 
-    def process_folder(self, root, apifiles):
+    def process_folder(self, root, apis):
         self.tag = root.lstrip('./')
 
-        actions = collections.OrderedDict()
-
-        # 按名称分组
-        for filename in apifiles:
-            name = re.sub(r'^[\d_]+-(.*?)\.api', r'\1', filename)
-            actions.setdefault(name, []).append(filename)
-
-        for name, filenames in actions.items():
-            self.process_action(root, name, filenames)
+        for name, filenames in apis.items():
+            self.paths.update(self.process_action(root, name, filenames))
 
     def process_action(self, root, apiname, filenames):
-        api = Api()
-        for filename in filenames:
-            api.add_session(self.read_session(Path(root) / filename))
-
-        for seq_no, session in enumerate(api.sessions, 1):
-            request = session.request
-            response = session.response
-            path = (root + '/' + apiname).lstrip('.')
-
-            responses = Responses()
-            responses[response.status_code] = openapi.model.Response(
-                description='TODO: description',
-                # headers=response.headers,
-                schema=response.schema,
-            )
-
-            operation = Operation({
-                "parameters": session.parameters,
-                "responses": responses
-            })
-
-            self.paths[path] = PathItem({
-                request.method.lower(): operation,
-            })
-
-    def read_session(self, apifile):
-        fp = apifile.open('rb')
-
-        # API Headers
-        headers = self.read_headers(fp)
-        timestamp = headers.get('request-time', 'N/A')
-        latency = headers.get('latency', 'N/A')
-
-        # Request
-        line = fp.readline()
-        if not line.startswith(b'Request '):
-            print('API 文件格式错误(1):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        request = Request(timestamp, payload)
-        request.parse_body(self.keep_list_item)
-
-        # Skip empty line
-        line = fp.readline()
-        if line != b'\r\n':
-            print('API 文件格式错误(2):', fp.name)
-            return
-
-        # Response
-        line = fp.readline()
-        if not line.startswith(b'Response '):
-            print('API 文件格式错误(3):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        response = Response(latency, payload)
-        response.parse_body(self.keep_list_item)
-
-        return ApiSession(request, response)
-
-    @staticmethod
-    def read_headers(fp):
-        headers = {}
-        for line in fp:
-            if line == b'\r\n':
-                break
-            name, _, value = line.decode().partition(':')
-            headers[name.lower()] = value.strip()
-        return headers
+        """返回这个 API 的 {路径: PathItem}
+        """
+        paths = {}
+        # session 中的 payload 和 body 只在 with 中有效
+        with self.loader.load([Path(root) / filename for filename in filenames]) as sessions:
+            api = Api()
+            for session in sessions:
+                api.add_session(session)
+
+            parameters = api.parameters
+            for seq_no, session in enumerate(api.sessions, 1):
+                request = session.request
+                response = session.response
+                path = (root + '/' + apiname).lstrip('.')
+
+                responses = Responses()
+                responses[response.status_code] = openapi.model.Response(
+                    description='TODO: description',
+                    # headers=response.headers,
+                    schema=response.schema,
+                )
+
+                operation = Operation({
+                    "parameters": parameters,
+                    "responses": responses
+                })
+
+                paths[path] = PathItem({
+                    request.method.lower(): operation,
+                })
+
+        return paths
 
 
 @click.command()
@@ -289,8 +292,16 @@ class ApiSwagger(object):
 @click.option('--host', '-h', default='http://{host}', help='API 主机.')
 @click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
 @click.option('--data-dir', '-d', default='.', help='API 数据文件目录.')
+@click.option('--max-body-size', '-m', default=64, help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制）.')
 @click.option('--output', '-o', help='Swagger 文件名.')
-def run(title, host, keep_list_item, data_dir, output):
+@click.option('--jobs', '-j', default=1, help='读取 API 数据文件的进程数（0 表示 CPU 数）.')
+@click.option('--cache', '-c', default=None, help='解析结果的缓存文件（SQLite），没有变化的 API 数据文件直接使用缓存.')
+@click.option('--filter', '-F', 'filters', multiple=True, help='过滤条件，只使用索引中符合条件的 session（允许指定多个）.')
+@click.option('--index', '-i', default=None, help='索引文件名（默认为数据目录下的 apiindex.db）.')
+@click.option('--update-index', '-U', is_flag=True, help='使用索引前先更新（默认只在没有索引时建立）.')
+@click.option('--watch', '-w', default=0, help='每隔多少秒检查一次数据目录，增量更新输出文件（0 表示只生成一次）.')
+def run(title, host, keep_list_item, data_dir, max_body_size, output, jobs, cache, filters, index, update_index,
+        watch):
     if not output:
         if title is not None:
             output = 'apiswagger-%s.json' % (re.sub('[^\w.]', '-', title).lower())
@@ -298,8 +309,12 @@ def run(title, host, keep_list_item, data_dir, output):
             output = 'apiswagger.json'
     if title is None:
         title = 'API - ApiSwagger'
-    apiswagger = ApiSwagger(title, host, keep_list_item, data_dir, output)
-    apiswagger.run()
+    apiswagger = ApiSwagger(title, host, keep_list_item, data_dir, output, max_body_size << 20, jobs, cache,
+                            filters, index, update_index)
+    if watch:
+        apiswagger.watch(watch)
+    else:
+        apiswagger.run()
 
 
 if __name__ == "__main__":
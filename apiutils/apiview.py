@@ -1,28 +1,22 @@
+import os
+import sys
 from urllib.parse import parse_qs
 
 import click
+from apiutils import apiindex
+from apiutils import apireader
+from apiutils import apistore
 from apiutils import util
 
 
-class HTTPMessage(object):
-    headers = dict()
-    body = b''
-    decoded_body = ''
-    simplified_body = ''
-
-    def parse_body(self, keep_list_item):
-        self.decoded_body = util.decode_body(self.headers, self.body)
-        self.simplified_body = util.simplify_body(self.decoded_body, keep_list_item)
-
-
-class Request(HTTPMessage):
+class Request(apireader.HTTPMessage):
     def __init__(self, timestamp, payload):
         self.timestamp = timestamp
         self.payload = payload
 
         self.request_line, raw_headers, self.body = util.http_split_message(payload)
-        self.raw_headers = util.hack_gor_real_ip(raw_headers)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.headers = util.http_parse_headers(raw_headers, real_ip=True)
+        self.raw_headers = util.http_headers_text(raw_headers, self.headers)
         self.method, self.url, self.version = self.request_line.split(' ')
 
         self.host = self.headers.get('host', 'n/a')
@@ -32,13 +26,14 @@ class Request(HTTPMessage):
         return '%s %s' % (self.timestamp, self.request_line)
 
 
-class Response(HTTPMessage):
+class Response(apireader.HTTPMessage):
     def __init__(self, latency, payload):
         self.latency = latency
         self.payload = payload
 
-        self.response_line, self.raw_headers, self.body = util.http_split_message(payload)
-        self.headers = util.http_parse_headers(self.raw_headers)
+        self.response_line, raw_headers, self.body = util.http_split_message(payload)
+        self.headers = util.http_parse_headers(raw_headers)
+        self.raw_headers = util.http_headers_text(raw_headers)
         self.version, self.status_code, self.reason = self.response_line.split(' ', 2)
 
     def __str__(self):
@@ -61,13 +56,40 @@ class ApiSession(object):
 
 
 class ApiViewer(object):
-    def __init__(self, keep_list_item, apifiles):
+    def __init__(self, keep_list_item, apifiles, max_body_size=0, filters=(), index_file=None, update_index=False):
         self.keep_list_item = keep_list_item
+        self.max_body_size = max_body_size
         self.apifiles = apifiles
+        self.filters = filters
+        self.index_file = index_file
+        self.update_index = update_index
+        self.store = apistore.ApiStore('.')
 
     def run(self):
         for apifile in self.apifiles:
-            session = self.read_session(apifile)
+            if os.path.isdir(apifile):
+                # 目录（包括 segment 目录）中的所有 API 数据文件
+                store = apistore.ApiStore(apifile)
+                if self.filters:
+                    # 只看索引中符合条件的
+                    for root, apis in apiindex.walk_apis(store, self.filters, self.index_file, self.update_index):
+                        for filename in sorted(fn for filenames in apis.values() for fn in filenames):
+                            self.view(store, os.path.join(root, filename))
+                    continue
+                for root, _, files in store.walk():
+                    for filename in sorted(files):
+                        if filename.endswith('.api'):
+                            self.view(store, os.path.join(root, filename))
+            else:
+                self.view(self.store, apifile)
+
+    def view(self, store, apifile):
+        with apireader.ApiReader(store, self.keep_list_item, self.max_body_size) as reader:
+            try:
+                session = reader.read_session(apifile, Request, Response, ApiSession)
+            except apireader.ApiFormatError as e:
+                print(e, file=sys.stderr)
+                return
             self.print_request(session.request)
             self.print_response(session.response)
 
@@ -91,60 +113,19 @@ class ApiViewer(object):
             print(response.simplified_body)
         print()
 
-    def read_session(self, apifile):
-        fp = open(apifile, 'rb')
-
-        # API Headers
-        headers = self.read_headers(fp)
-        timestamp = headers.get('request-time', 'N/A')
-        latency = headers.get('latency', 'N/A')
-
-        # Request
-        line = fp.readline()
-        if not line.startswith(b'Request '):
-            print('API 文件格式错误(1):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        request = Request(timestamp, payload)
-        request.parse_body(self.keep_list_item)
-
-        # Skip empty line
-        line = fp.readline()
-        if line != b'\r\n':
-            print('API 文件格式错误(2):', fp.name)
-            return
-
-        # Response
-        line = fp.readline()
-        if not line.startswith(b'Response '):
-            print('API 文件格式错误(3):', fp.name)
-            return
-        length = int(line.partition(b' ')[-1])
-        payload = fp.read(length)
-
-        response = Response(latency, payload)
-        response.parse_body(self.keep_list_item)
-
-        return ApiSession(request, response)
-
-    @staticmethod
-    def read_headers(fp):
-        headers = {}
-        for line in fp:
-            if line == b'\r\n':
-                break
-            name, _, value = line.decode().partition(':')
-            headers[name.lower()] = value.strip()
-        return headers
-
 
 @click.command()
 @click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
+@click.option('--max-body-size', '-m', default=64, help='解码后 body 的最大大小，超出部分截断，单位: MB（0 表示不限制）.')
+@click.option('--filter', '-F', 'filters', multiple=True,
+              help='过滤条件，目录中只显示索引中符合条件的 session（允许指定多个）.')
+@click.option('--index', '-i', default=None, help='索引文件名（默认为目录下的 apiindex.db）.')
+@click.option('--update-index', '-U', is_flag=True, help='使用索引前先更新（默认只在没有索引时建立）.')
 @click.argument('apifiles', nargs=-1)
-def run(keep_list_item, apifiles):
-    viewer = ApiViewer(keep_list_item, apifiles)
+def run(keep_list_item, max_body_size, filters, index, update_index, apifiles):
+    if filters and not apifiles:
+        apifiles = ('.',)
+    viewer = ApiViewer(keep_list_item, apifiles, max_body_size << 20, filters, index, update_index)
     viewer.run()
 
 
@@ -0,0 +1,109 @@
+"""监视 API 数据目录，有新的或变了的 API 数据文件时增量更新生成的文档
+
+    apiblue -d api -o api.apib -w 10       # 每 10 秒检查一次
+    apiman -d api -w 10
+    apiswagger -d api -w 10
+
+每次检查遍历一遍目录（只用标准库，不依赖 inotify），按 ApiStore.signature 找出文件有变化的 API
+（目录 + API 名称），只重新读取这些 API 的文件、重新 add_session，其他 API 用上次生成的内容，
+最后用 util.atomic_write 整个替换输出文件。
+
+API 的 session 去重和文件的顺序有关，所以有变化的 API 总是用它所有的文件重新生成，保证输出文件和
+这时重新生成的完全一样。同时指定 -c 时，没有变化的文件直接使用缓存，不用再解码。
+"""
+import collections
+import logging
+import os
+import signal
+import sys
+import time
+
+from apiutils import apiindex
+
+
+class ApiWatcher(object):
+    def __init__(self, store, loader, filters=(), index_file=None):
+        self.store = store
+        self.loader = loader
+        self.filters = filters
+        self.index_file = index_file
+        # (目录, API 名称) -> ((文件名, signature), ...)
+        self.signatures = {}
+
+    def poll(self):
+        """返回 (groups, changed)：groups 和 walk_apis 一样，changed 为和上次比有变化（包括新增和删除）的 API
+        """
+        groups = []
+        signatures = {}
+        # 有过滤条件时每次都先更新索引（遍历一遍目录），新的文件才能查到
+        for root, apis in apiindex.walk_apis(self.store, self.filters, self.index_file, True):
+            existing = collections.OrderedDict()
+            for name, filenames in apis.items():
+                files = []
+                for filename in filenames:
+                    try:
+                        files.append((filename, self.store.signature(os.path.join(root, filename))))
+                    except FileNotFoundError:
+                        # 遍历以后被删除了
+                        continue
+                if files:
+                    existing[name] = [filename for filename, _ in files]
+                    signatures[root, name] = tuple(files)
+            if existing:
+                groups.append((root, existing))
+
+        changed = set(key for key, files in signatures.items() if self.signatures.get(key) != files)
+        changed.update(key for key in self.signatures if key not in signatures)
+        self.signatures = signatures
+        return groups, changed
+
+    def run(self, interval, process_api, write_apis):
+        """每 interval 秒检查一次，有变化时：
+
+        * process_api(root, name, filenames) 重新生成有变化的 API，返回这个 API 的内容
+        * write_apis(groups, apis) 按 groups 的顺序用各个 API 的内容（apis[root, name]）生成输出文件
+
+        出错时（例如检查以后文件被删除、索引被其他进程锁住、写输出文件失败）记录下来，下次检查时重试。
+        """
+        apis = {}
+        # kill（SIGTERM）和 Ctrl-C 一样正常退出
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            with self.loader:
+                while True:
+                    try:
+                        self.update(apis, process_api, write_apis)
+                    except Exception:
+                        logging.exception('failed to update, retry in %s seconds', interval)
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def update(self, apis, process_api, write_apis):
+        groups, changed = self.poll()
+        if not changed:
+            return
+        start = time.time()
+        try:
+            for key in changed:
+                if key not in self.signatures:
+                    apis.pop(key, None)
+            dirty = [(root, collections.OrderedDict(
+                (name, filenames) for name, filenames in names.items() if (root, name) in changed))
+                for root, names in groups]
+            dirty = [(root, names) for root, names in dirty if names]
+            self.loader.prefetch(dirty)
+            for root, names in dirty:
+                for name, filenames in names.items():
+                    apis[root, name] = process_api(root, name, filenames)
+            write_apis(groups, apis)
+            if not self.filters:
+                self.loader.prune(groups)
+            self.loader.flush()
+        except Exception:
+            # 这些 API 下次检查时重新生成
+            for key in changed:
+                self.signatures.pop(key, None)
+            raise
+        print('%s %d APIs changed, %d APIs, %.2fs' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), len(changed), len(apis), time.time() - start), file=sys.stderr)
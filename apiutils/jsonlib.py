@@ -0,0 +1,243 @@
+"""JSON 的解析和输出：安装了 orjson 时使用 orjson，否则使用标准库 json
+
+两者的结果完全一样：
+
+* loads: 相当于 json.loads。orjson 会把超出 64 位的整数解析成浮点数，所以有 19 位以上的数字时
+  交给 json.loads；orjson 不能解析的输入（NaN、Infinity 等）也交给 json.loads，出错时抛出的是
+  json.loads 的异常
+* dumps: 相当于 json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)。orjson 输出浮点数的格式
+  只在 repr 用指数表示时（小于 1e-4 或不小于 1e16）和标准库不同，NaN 和 Infinity 则输出为 null，
+  有这样的浮点数时交给 json.dumps；orjson 不支持的数据（超出 64 位的整数、非 str 的 key 等）也交给 json.dumps
+
+嵌套太深（标准库抛出 RecursionError）时，loads 和 dumps 改用栈代替递归的实现，结果也完全一样。
+
+设置环境变量 APIUTILS_JSON=json 时总是使用标准库。
+"""
+import json
+import os
+
+orjson = None
+if os.environ.get('APIUTILS_JSON') != 'json':
+    try:
+        import orjson
+    except ImportError:
+        pass
+
+# 把数字都换成 0，再查找连续 19 个 0，比正则表达式快得多
+_DIGITS = bytes.maketrans(b'0123456789', b'0' * 10)
+_BIG_NUMBER = b'0' * 19
+
+
+_scan_once = json.JSONDecoder().scan_once
+_whitespace = json.decoder.WHITESPACE.match
+_encode_string = json.encoder.encode_basestring
+# 列表或对象结束
+_END = object()
+
+
+def backend():
+    return 'orjson' if orjson is not None else 'json'
+
+
+def loads(s):
+    if orjson is not None:
+        try:
+            data = s.encode() if isinstance(s, str) else s
+        except UnicodeEncodeError:
+            data = None
+        if data is not None and _BIG_NUMBER not in data.translate(_DIGITS):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+    try:
+        return json.loads(s)
+    except RecursionError:
+        if isinstance(s, (bytes, bytearray)):
+            s = s.decode(json.detect_encoding(s), 'surrogatepass')
+        value, idx = scan_deep(s, _whitespace(s, 0).end())
+        idx = _whitespace(s, idx).end()
+        if idx != len(s):
+            raise json.JSONDecodeError('Extra data', s, idx)
+        return value
+
+
+def _key(s, idx):
+    """解析对象中的 "key": ，返回 (key, 值的位置)
+    """
+    idx = _whitespace(s, idx).end()
+    if s[idx:idx + 1] != '"':
+        raise json.JSONDecodeError('Expecting property name enclosed in double quotes', s, idx)
+    key, idx = json.decoder.scanstring(s, idx + 1)
+    idx = _whitespace(s, idx).end()
+    if s[idx:idx + 1] != ':':
+        raise json.JSONDecodeError("Expecting ':' delimiter", s, idx)
+    return key, _whitespace(s, idx + 1).end()
+
+
+def scan_deep(s, idx):
+    """从 s[idx] 开始解析一个值，返回 (值, 值后面的位置)，相当于 json.JSONDecoder.raw_decode，
+    但是用栈代替递归，嵌套多深都可以
+    """
+    # 正在解析的列表和对象: [容器, 对象的 key（列表为 None）]
+    stack = []
+    while True:
+        c = s[idx:idx + 1]
+        if c == '{':
+            idx = _whitespace(s, idx + 1).end()
+            if s[idx:idx + 1] != '}':
+                key, idx = _key(s, idx)
+                stack.append([{}, key])
+                continue
+            value, idx = {}, idx + 1
+        elif c == '[':
+            idx = _whitespace(s, idx + 1).end()
+            if s[idx:idx + 1] != ']':
+                stack.append([[], None])
+                continue
+            value, idx = [], idx + 1
+        else:
+            try:
+                value, idx = _scan_once(s, idx)
+            except StopIteration as err:
+                raise json.JSONDecodeError('Expecting value', s, err.value) from None
+
+        # 把值放到所在的容器中，容器结束时它自己又是上一层的值
+        while stack:
+            frame = stack[-1]
+            container, key = frame
+            idx = _whitespace(s, idx).end()
+            c = s[idx:idx + 1]
+            if key is None:
+                container.append(value)
+                if c == ',':
+                    idx = _whitespace(s, idx + 1).end()
+                    break
+                elif c != ']':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+            else:
+                container[key] = value
+                if c == ',':
+                    frame[1], idx = _key(s, idx + 1)
+                    break
+                elif c != '}':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+            value, idx = container, idx + 1
+            stack.pop()
+        else:
+            return value, idx
+
+
+def _plain_floats(obj):
+    """obj 中的浮点数都是 0 或者 1e-4 <= abs(f) < 1e16（不包括 NaN 和 Infinity），orjson 的输出和 repr 一样
+    """
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, float) and obj and not 1e-4 <= abs(obj) < 1e16:
+            return False
+    return True
+
+
+def dumps(obj):
+    if orjson is not None and _plain_floats(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+        except TypeError:
+            pass
+    try:
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
+    except RecursionError:
+        return _dumps_deep(obj)
+
+
+def _float(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _scalar(value):
+    if isinstance(value, str):
+        return _encode_string(value)
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, float):
+        return _float(value)
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+
+def _dict_key(key):
+    """和 json.dumps 一样把对象的 key 转成字符串
+    """
+    if isinstance(key, str):
+        return key
+    if isinstance(key, float):
+        return _float(key)
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    raise TypeError('keys must be str, int, float, bool or None, not %s' % type(key).__name__)
+
+
+def _dumps_deep(obj):
+    """和 json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2) 一样，但是用栈代替递归，嵌套多深都可以
+    """
+    parts = []
+    # 正在输出的列表和对象: [各项的迭代器, 是否对象, 已经输出的项数]
+    stack = []
+    value = obj
+    while True:
+        if isinstance(value, (list, tuple)):
+            if value:
+                parts.append('[')
+                stack.append([iter(value), False, 0])
+            else:
+                parts.append('[]')
+        elif isinstance(value, dict):
+            if value:
+                parts.append('{')
+                stack.append([iter(sorted(value.items())), True, 0])
+            else:
+                parts.append('{}')
+        else:
+            parts.append(_scalar(value))
+
+        # 找到下一个要输出的值，结束的列表和对象输出 "]" 和 "}"
+        while stack:
+            frame = stack[-1]
+            items, is_dict, count = frame
+            item = next(items, _END)
+            if item is _END:
+                stack.pop()
+                parts.append('\n%s%s' % ('  ' * len(stack), '}' if is_dict else ']'))
+                continue
+            frame[2] += 1
+            parts.append('%s\n%s' % (',' if count else '', '  ' * len(stack)))
+            if is_dict:
+                key, value = item
+                parts.append('%s: ' % _encode_string(_dict_key(key)))
+            else:
+                value = item
+            break
+        else:
+            return ''.join(parts)
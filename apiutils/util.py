@@ -1,91 +1,533 @@
-import gzip
+import collections
+import hashlib
 import json
+import logging
+import math
+import os
+import re
 import socket
+import stat
+import sys
+import tempfile
 import time
+import zlib
 
 import binascii
+from apiutils import jsonlib
 
 
 def http_split_message(data):
+    """分成第一行、Header（bytes）和 body
+
+    data 是 memoryview 时（例如映射的文件的切片）只复制第一行和 Header，body 是 data 的切片。
+    """
+    if isinstance(data, memoryview):
+        return _split_view(data)
     first_line, _, data = data.partition(b'\r\n')
     raw_headers, _, body = data.partition(b'\r\n\r\n')
+    return first_line.decode(errors='replace'), raw_headers, body
 
-    # ! Header 中有时会有非 utf-8 编码
-    return first_line.decode(errors='replace'), raw_headers.decode('iso-8859-1'), body
+
+def _split_view(data, size=4096):
+    # 从前 size 字节中找分隔符，找不到再加倍，直到整个 data
+    while True:
+        head = bytes(data[:size])
+        first_line, sep, rest = head.partition(b'\r\n')
+        if sep:
+            raw_headers, sep, _ = rest.partition(b'\r\n\r\n')
+            if sep:
+                body = data[len(first_line) + len(raw_headers) + 6:]
+                return first_line.decode(errors='replace'), raw_headers, body
+        if size >= len(data):
+            return http_split_message(head)
+        size *= 2
+
+
+# 原始 header 名 -> 小写的 header 名（intern 后，各个 session 共用同一个字符串）
+_header_names = {}
+_HEADER_NAMES_MAX = 4096
+
+# decode_body 用到的 header
+BODY_HEADERS = frozenset(('transfer-encoding', 'content-encoding'))
+
+
+class HTTPHeaders(dict):
+    """header 名（小写）-> 值
+
+    同名的 header 出现多次时（如 Set-Cookie），用 [] 或 get 取值时和原来一样返回最后一个值，
+    getall 返回所有的值。
+    """
+    # 出现多次的 header: header 名 -> 所有的值
+    multi = None
+    # 转换了 gor 的 X-Real-IP 时，记录 (原来的行, 转换后的行)
+    real_ip = None
+
+    def add(self, name, value):
+        if name in self:
+            if self.multi is None:
+                self.multi = {}
+            self.multi.setdefault(name, [self[name]]).append(value)
+        self[name] = value
+
+    def getall(self, name):
+        if name not in self:
+            return []
+        if self.multi and name in self.multi:
+            return list(self.multi[name])
+        return [self[name]]
+
+
+def _header_name(name):
+    key = _header_names.get(name)
+    if key is None:
+        if len(_header_names) >= _HEADER_NAMES_MAX:
+            _header_names.clear()
+        # 续行当作空的 header 名
+        key = '' if name[:1] in (' ', '\t') else sys.intern(name.strip().lower())
+        _header_names[name] = key
+    return key
 
 
-def http_parse_headers(raw_headers):
-    headers = {}
-    key = value = None
-    for line in raw_headers.splitlines(False):
-        if not line:
+def _find_headers(text, names):
+    """只取 names 中的 header：在小写的文本中直接查找 "\nname:"，不逐行分析
+
+    和逐行分析一样，header 名和冒号之间允许有空白（如 "Content-Encoding : gzip"）。
+    """
+    headers = HTTPHeaders()
+    lower = '\n' + text.lower()
+    for name in names:
+        pattern = '\n' + name
+        pos = lower.find(pattern)
+        while pos >= 0:
+            colon = pos + len(pattern)
+            while lower[colon:colon + 1] in (' ', '\t'):
+                colon += 1
+            if lower[colon:colon + 1] == ':':
+                # lower 前面多了一个 \n，text[colon] 正好是冒号后面的字符
+                end = text.find('\n', colon)
+                headers.add(name, text[colon:end if end >= 0 else len(text)].strip())
+            pos = lower.find(pattern, colon)
+    return headers
+
+
+def http_parse_headers(raw_headers, names=None, real_ip=False):
+    """分析 Header（bytes），返回 HTTPHeaders
+
+    names: 只取其中的 header（小写），None 表示全部
+    real_ip: 是否转换 gor 的 X-Real-IP（参见 hack_gor_real_ip）
+    """
+    # ! Header 中有时会有非 utf-8 编码
+    text = raw_headers.decode('iso-8859-1') if isinstance(raw_headers, bytes) else raw_headers
+    if names is not None and not real_ip and '\n ' not in text and '\n\t' not in text:
+        return _find_headers(text, names)
+
+    headers = HTTPHeaders()
+    cached = _header_names.get
+    last = None
+    for name, colon, value in [line.partition(':') for line in text.split('\n')]:
+        key = cached(name) or _header_name(name)
+        if not key:
+            # 续行或空行
+            if last is not None and name[:1] in (' ', '\t'):
+                value = '%s %s' % (headers[last], (name + colon + value).strip())
+                headers[last] = value
+                if headers.multi and last in headers.multi:
+                    headers.multi[last][-1] = value
             continue
-        if line[0] not in " \t":
-            key, _, value = line.partition(":")
-            key = key.strip().lower()
-            headers[key] = value.strip()
+        if key in headers:
+            headers.add(key, value.strip())
         else:
-            headers[key] += value.strip()
+            headers[key] = value.strip()
+        last = key
 
+    if real_ip and text.startswith('X-Real-IP:'):
+        ip = gor_real_ip(headers.getall('x-real-ip')[0])
+        if ip is not None:
+            headers.real_ip = (text.partition('\r\n')[0], 'X-Real-IP: %s' % ip)
+            if headers.multi and 'x-real-ip' in headers.multi:
+                headers.multi['x-real-ip'][0] = ip
+            else:
+                headers['x-real-ip'] = ip
+
+    if names is not None:
+        for key in set(headers) - set(names):
+            del headers[key]
     return headers
 
 
+def http_headers_text(raw_headers, headers=None):
+    """Header 的文本，headers 中转换了 X-Real-IP 时，文本中也一样转换
+    """
+    # ! Header 中有时会有非 utf-8 编码
+    text = raw_headers.decode('iso-8859-1')
+    if headers is not None and headers.real_ip:
+        line, real_ip = headers.real_ip
+        text = real_ip + text[len(line):]
+    return text
+
+
+def atomic_write(filename, data):
+    """先写到同一目录下的临时文件，再替换 filename，读的人不会看到写了一半的文件
+
+    data 为 str 时和 open(filename, 'w') 一样编码，文件权限和原来的文件一样（新文件按 umask）。
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, temp_file = tempfile.mkstemp(prefix='.%s.' % basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'w' if isinstance(data, str) else 'wb') as fp:
+            fp.write(data)
+        try:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temp_file, mode)
+        os.replace(temp_file, filename)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
 # noinspection PyShadowingBuiltins
 def strftime(timestamp, format='%Y-%m-%d %H:%M:%S'):
     return time.strftime(format, time.localtime(timestamp))
 
 
 def simplify(data, keep_list_item=3):
-    # ! 不能用 map, 因为 map 不会立即执行
-    if isinstance(data, dict):
-        for value in data.values():
-            simplify(value, keep_list_item)
-    elif isinstance(data, list):
-        del data[keep_list_item:]
-        for item in data:
-            simplify(item, keep_list_item)
+    """删除列表中 keep_list_item 以后的项（直接修改 data）
+
+    用栈代替递归，嵌套多深都可以。
+    """
+    stack = [data]
+    while stack:
+        data = stack.pop()
+        if isinstance(data, dict):
+            values = data.values()
+        elif isinstance(data, list):
+            del data[keep_list_item:]
+            values = data
+        else:
+            continue
+        stack.extend([value for value in values if isinstance(value, (dict, list))])
+
+
+# 生成文档时 JSON 最多嵌套的层数，更深的 body 当作文本（和原来用 json.loads 递归解析时的上限差不多）。
+# 带缩进输出的大小和嵌套层数的平方成正比，不限制时很深的 body 会输出几个 GB
+MAX_JSON_DEPTH = 1000
+
+_json_scan_once = json.JSONDecoder().scan_once
+_json_whitespace = json.decoder.WHITESPACE.match
+# 列表中一项后面的 "," 或 "]"，"," 后面的空白也一起跳过
+_json_item_end = re.compile(r'[ \t\n\r]*(?:,[ \t\n\r]*|(\]))').match
 
 
-def decode_body(headers, body):
-    body = body
+def _json_key(s, idx):
+    """解析对象中的 "key": ，返回 (key, 值的位置)
+    """
+    idx = _json_whitespace(s, idx).end()
+    if s[idx:idx + 1] != '"':
+        raise json.JSONDecodeError('Expecting property name enclosed in double quotes', s, idx)
+    key, idx = json.decoder.scanstring(s, idx + 1)
+    idx = _json_whitespace(s, idx).end()
+    if s[idx:idx + 1] != ':':
+        raise json.JSONDecodeError("Expecting ':' delimiter", s, idx)
+    return key, _json_whitespace(s, idx + 1).end()
+
+
+def _json_skip_items(s, idx):
+    """跳过列表中余下的项，返回 "]" 后面的位置
+
+    每次只解析一项，解析后马上丢弃，不会同时保存所有的项。嵌套太深的项改用 jsonlib.scan_deep。
+    """
+    while True:
+        try:
+            _, idx = _json_scan_once(s, idx)
+        except StopIteration as err:
+            raise json.JSONDecodeError('Expecting value', s, err.value) from None
+        except RecursionError:
+            _, idx = jsonlib.scan_deep(s, idx)
+        match = _json_item_end(s, idx)
+        if match is None:
+            raise json.JSONDecodeError("Expecting ',' delimiter", s, _json_whitespace(s, idx).end())
+        idx = match.end()
+        if match.group(1):
+            return idx
+
+
+def json_loads_simplified(s, keep_list_item=3, max_depth=0):
+    """相当于 json.loads 后再 simplify，但是解析时就跳过列表中多余的项
+
+    结果和 json.loads + simplify 完全一样，出错时同样抛出 json.JSONDecodeError。
+    只有保留的数据和当前跳过的一项会同时在内存中。max_depth 不为 0 时，
+    列表和对象嵌套超过 max_depth 层也抛出 json.JSONDecodeError（keep_list_item < 0 时不检查）。
+    """
+    if keep_list_item < 0:
+        data = jsonlib.loads(s)
+        simplify(data, keep_list_item)
+        return data
+
+    # 正在解析的列表和对象: [容器, 对象的 key（列表为 None）]
+    stack = []
+    idx = _json_whitespace(s, 0).end()
+    while True:
+        c = s[idx:idx + 1]
+        if max_depth and len(stack) >= max_depth and c in ('{', '['):
+            raise json.JSONDecodeError('Nested too deep', s, idx)
+        if c == '{':
+            idx = _json_whitespace(s, idx + 1).end()
+            if s[idx:idx + 1] != '}':
+                key, idx = _json_key(s, idx)
+                stack.append([{}, key])
+                continue
+            value, idx = {}, idx + 1
+        elif c == '[':
+            idx = _json_whitespace(s, idx + 1).end()
+            if s[idx:idx + 1] != ']':
+                if keep_list_item > 0:
+                    stack.append([[], None])
+                    continue
+                idx = _json_skip_items(s, idx)
+            else:
+                idx += 1
+            value = []
+        else:
+            try:
+                value, idx = _json_scan_once(s, idx)
+            except StopIteration as err:
+                raise json.JSONDecodeError('Expecting value', s, err.value) from None
+
+        # 把值放到所在的容器中，容器结束时它自己又是上一层的值
+        while stack:
+            frame = stack[-1]
+            container, key = frame
+            idx = _json_whitespace(s, idx).end()
+            c = s[idx:idx + 1]
+            if key is None:
+                container.append(value)
+                if c == ',':
+                    idx = _json_whitespace(s, idx + 1).end()
+                    if len(container) < keep_list_item:
+                        break
+                    idx = _json_skip_items(s, idx)
+                elif c == ']':
+                    idx += 1
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+            else:
+                container[key] = value
+                if c == ',':
+                    frame[1], idx = _json_key(s, idx + 1)
+                    break
+                elif c == '}':
+                    idx += 1
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+            value = container
+            stack.pop()
+        else:
+            idx = _json_whitespace(s, idx).end()
+            if idx != len(s):
+                raise json.JSONDecodeError('Extra data', s, idx)
+            return value
+
 
+def _shape_digest(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def json_shape(data, keep_list_item=3):
+    """JSON 数据的结构（键和值的类型），是一个字符串，可以作为 dict 的 key
+
+    列表只看前 keep_list_item 项（和 simplify 一致），各项结构相同时只算一次，和顺序无关。
+    列表和对象的结构是它的键和各项的结构的摘要（16 个十六进制字符），其他值为类型名称。
+    用栈代替递归，嵌套多深都可以，耗时和数据的大小成正比，比较时也不会递归。
+    """
+    # 算完的结构；栈中的容器第二次出栈时，它的各项的结构都在 shapes 的最后
+    shapes = []
+    # (数据, 对象排好序的 key（列表为 None），是否已经展开)
+    stack = [(data, None, False)]
+    while stack:
+        data, keys, expanded = stack.pop()
+        if isinstance(data, dict):
+            if not expanded:
+                keys = sorted(data)
+                stack.append((data, keys, True))
+                stack.extend((data[key], None, False) for key in reversed(keys))
+                continue
+            start = len(shapes) - len(keys)
+            shape = _shape_digest('object:' + ','.join(
+                '%r:%s' % (key, item) for key, item in zip(keys, shapes[start:])))
+            del shapes[start:]
+        elif isinstance(data, list):
+            items = data[:keep_list_item]
+            if not expanded:
+                stack.append((data, None, True))
+                stack.extend((item, None, False) for item in reversed(items))
+                continue
+            start = len(shapes) - len(items)
+            shape = _shape_digest('array:' + ','.join(sorted(set(shapes[start:]))))
+            del shapes[start:]
+        elif isinstance(data, bool):
+            shape = 'boolean'
+        elif isinstance(data, int):
+            shape = 'integer'
+        elif isinstance(data, float):
+            shape = 'number'
+        elif data is None:
+            shape = 'null'
+        else:
+            shape = 'string'
+        shapes.append(shape)
+    return shapes[0]
+
+
+def decode_chunked(body):
+    """解码 Transfer-Encoding: chunked 的数据
+
+    用偏移量遍历数据，不复制剩余的部分。返回 (数据, 错误信息)，数据不完整或格式错误时
+    返回已经解码的部分和错误信息，否则错误信息为 None。
+    """
+    if not body:
+        # 例如 HEAD 请求的 Response
+        return b'', None
+    if not isinstance(body, bytes):
+        body = bytes(body)
+    view = memoryview(body)
+    find = body.find
+    size = len(body)
+    chunks = []
+    error = None
+    pos = 0
+    while True:
+        line_end = find(b'\r\n', pos)
+        if line_end < 0:
+            error = 'truncated: missing last chunk'
+            break
+        # 忽略 chunk extension: <length>;name=value
+        length = body[pos:line_end].partition(b';')[0].strip()
+        try:
+            length = int(length, 0x10)
+        except ValueError:
+            length = -1
+        if length < 0:
+            error = 'malformed chunk size at %d: %r' % (pos, body[pos:min(line_end, pos + 16)])
+            break
+        if length == 0:
+            # 后面的 trailer 不需要
+            break
+
+        start = line_end + 2
+        end = start + length
+        if end > size:
+            chunks.append(view[start:])
+            error = 'truncated: chunk at %d needs %d bytes, %d left' % (pos, length, size - start)
+            break
+        chunks.append(view[start:end])
+        if body[end:end + 2] != b'\r\n':
+            error = 'malformed: missing CRLF after chunk at %d' % pos
+            break
+        pos = end + 2
+
+    return b''.join(chunks), error
+
+
+# body 被截断时加在后面的标记
+TRUNCATED_MARK = '\n... (truncated)'
+
+# Content-Encoding -> zlib 的 wbits
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def decompress(data, encoding, max_size=0):
+    """解压 gzip、deflate 数据，最多解压出 max_size 字节（0 表示不限制）
+
+    返回 (数据, 是否截断)。不支持的编码或数据错误时返回原来的数据。
+    """
+    wbits = _WBITS.get(encoding)
+    if wbits is None:
+        return data, False
+
+    chunks = []
+    remain = max_size
+    try:
+        while data:
+            try:
+                decompressor = zlib.decompressobj(wbits)
+                chunk = decompressor.decompress(data, remain)
+            except zlib.error:
+                # 很多服务器的 deflate 其实是没有 zlib 头的 raw deflate
+                if wbits != zlib.MAX_WBITS or chunks:
+                    raise
+                wbits = -zlib.MAX_WBITS
+                continue
+            chunks.append(chunk)
+            # gzip 可能由多个 member 组成
+            data = decompressor.unused_data if wbits > zlib.MAX_WBITS else b''
+            if max_size:
+                remain -= len(chunk)
+                if decompressor.unconsumed_tail or remain <= 0 and (data or not decompressor.eof):
+                    return b''.join(chunks), True
+    except zlib.error:
+        return data if not chunks else b''.join(chunks), False
+    return b''.join(chunks), False
+
+
+def decode_body(headers, body, max_size=0):
+    """解码 body：chunked、gzip/deflate 和 utf-8
+
+    解码后超过 max_size 字节（0 表示不限制）时截断，并在后面加上 TRUNCATED_MARK。
+    """
     # Transfer-Encoding: chunked
     if headers.get("transfer-encoding") == "chunked":
-        chunks = []
-        while body:
-            length, _, body = body.partition(b"\r\n")
-            length = int(length, 0x10)
-            if length == 0:
-                break
-            chunks.append(body[:length])
-            body = body[length + 2:]
-        body = b"".join(chunks)
-
-    # Content-Encoding: gzip
-    if headers.get("content-encoding") == "gzip":
-        try:
-            body = gzip.decompress(body)
-        except OSError:
-            pass
+        body, error = decode_chunked(body)
+        if error:
+            logging.warning('chunked body: %s', error)
 
+    # Content-Encoding: gzip, deflate
+    truncated = False
+    encoding = headers.get("content-encoding")
+    if encoding:
+        body, truncated = decompress(body, encoding.strip().lower(), max_size)
+    if max_size and len(body) > max_size:
+        body = body[:max_size]
+        truncated = True
+
+    # body 可能是 memoryview
     try:
-        body = body.decode("utf-8")
+        body = str(body, "utf-8")
     except UnicodeDecodeError:
-        body = body.decode("utf-8", "replace")
+        body = str(body, "utf-8", "replace")
 
+    if truncated:
+        body += TRUNCATED_MARK
     return body
 
 
 def simplify_body(body, keep_list_item):
+    # 简化数据，只保留部分数据，不是 JSON 或者嵌套太深（见 MAX_JSON_DEPTH）时返回原文
     # noinspection PyBroadException
     try:
-        obj = json.loads(body)
+        return jsonlib.dumps(json_loads_simplified(body, keep_list_item, MAX_JSON_DEPTH))
     except:
         return body
 
-    # 简化数据，只保留部分数据
-    simplify(obj, keep_list_item)
-    return json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
+
+def gor_real_ip(value):
+    """gor 把 X-Real-IP 写成 "c0a8:101::" 这样的格式，转换成 "192.168.1.1"，不是这种格式时返回 None
+    """
+    if not value.endswith('::'):
+        return None
+    # noinspection PyBroadException
+    try:
+        _12, _34, _ = value.strip().split(":", 2)
+        return socket.inet_ntoa(binascii.unhexlify(_12.rjust(4, "0") + _34.rjust(4, "0")))
+    except:
+        return None
 
 
 def hack_gor_real_ip(headers):
@@ -93,42 +535,65 @@ def hack_gor_real_ip(headers):
         return headers
 
     line, _, other = headers.partition('\r\n')
-    real_ip = line.strip().partition(':')[2].strip()
-    if real_ip.endswith('::'):
-        # noinspection PyBroadException
-        try:
-            _12, _34, _ = real_ip.strip().split(":", 2)
-            real_ip = binascii.unhexlify(_12.rjust(4, "0") + _34.rjust(4, "0"))
-            real_ip = socket.inet_ntoa(real_ip)
-        except:
-            return headers
-        else:
-            line = 'X-Real-IP: %s' % real_ip
-            return '\r\n'.join((line, other))
-    else:
+    real_ip = gor_real_ip(line.strip().partition(':')[2].strip())
+    if real_ip is None:
         return headers
+    return '\r\n'.join(('X-Real-IP: %s' % real_ip, other))
 
 
-def guess_value_type(value):
-    '''猜一猜数据类型
-    '''
-    try:
-        int(value)
-    except ValueError:
-        pass
-    else:
-        return 'integer'
+# 一组值（每行一个）都是整数、数字或布尔值，一次匹配所有的值
+_INTEGERS = re.compile(r'(?:[-+]?\d+\n)*[-+]?\d+')
+_NUMBERS = re.compile(r'(?:[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\n)*'
+                      r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_BOOLEANS = re.compile(r'(?:(?:true|false)\n)*(?:true|false)', re.IGNORECASE)
 
-    try:
-        float(value)
-    except ValueError:
-        pass
+# 类型、枚举值（不适合枚举时为 None）、数值范围和值的个数
+ValueType = collections.namedtuple('ValueType', 'type enum minimum maximum count')
+
+
+def _boolean(value):
+    return value.lower() == 'true'
+
+
+def infer_type(values, max_enum=10):
+    """推断一组值（如各个 session 中同一个参数的值）的类型
+
+    类型是能容纳所有值的最窄的类型: boolean, integer, number 或 string。
+    不同的值不超过 max_enum 个，并且有重复时，enum 是这些值（转换成对应的类型，排好序）；
+    数值类型的 minimum、maximum 是最小、最大值。
+    """
+    values = [value if isinstance(value, str) else str(value).lower() if isinstance(value, bool) else str(value)
+              for value in values if value is not None]
+    distinct = {value.strip() for value in values}
+    if not distinct or '' in distinct:
+        return ValueType('string', None, None, None, len(values))
+
+    text = '\n'.join(distinct)
+    minimum = maximum = None
+    if text.count('\n') != len(distinct) - 1:
+        # 值中有换行
+        value_type, convert = 'string', str
+    elif _INTEGERS.fullmatch(text):
+        value_type, convert = 'integer', int
+    elif _NUMBERS.fullmatch(text):
+        value_type, convert = 'number', float
+    elif _BOOLEANS.fullmatch(text):
+        value_type, convert = 'boolean', _boolean
     else:
-        return 'number'
+        value_type, convert = 'string', str
+
+    typed = sorted({convert(value) for value in distinct})
+    if value_type == 'number' and not all(map(math.isfinite, typed)):
+        # 1e400 之类超出 float 范围的值当作字符串，否则 JSON 中会出现 Infinity
+        value_type = 'string'
+        typed = sorted(distinct)
+    if value_type in ('integer', 'number'):
+        minimum, maximum = typed[0], typed[-1]
+    enum = typed if len(typed) <= max_enum and len(typed) < len(values) else None
+    return ValueType(value_type, enum, minimum, maximum, len(values))
 
-    if isinstance(value, str):
-        if value.lower() in ('true', 'false'):
-            return 'boolean'
-        return 'string'
 
-    return 'string'
+def guess_value_type(value):
+    '''猜一猜数据类型
+    '''
+    return infer_type([value]).type
@@ -0,0 +1,54 @@
+"""比较 chunked 解码的耗时，验证 util.decode_chunked 是线性的
+
+    python -m benchmarks.bench_chunked
+"""
+import time
+
+import click
+from apiutils import util
+
+
+def decode_chunked_slicing(body):
+    """原来的实现：每个 chunk 都重新切片剩余的数据
+    """
+    chunks = []
+    while body:
+        length, _, body = body.partition(b"\r\n")
+        length = int(length, 0x10)
+        if length == 0:
+            break
+        chunks.append(body[:length])
+        body = body[length + 2:]
+    return b"".join(chunks)
+
+
+def make_chunked(chunks, chunk_size):
+    chunk = b'x' * chunk_size
+    return b''.join(b'%x\r\n%s\r\n' % (chunk_size, chunk) for _ in range(chunks)) + b'0\r\n\r\n'
+
+
+def bench(func, body, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@click.command()
+@click.option('--chunk-size', '-s', default=16, help='每个 chunk 的字节数.')
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+def run(chunk_size, repeat):
+    print('%8s %10s %12s %12s %14s' % ('chunks', 'bytes', 'slicing', 'offsets', 'ns/chunk'))
+    for chunks in (1000, 4000, 16000, 64000):
+        body = make_chunked(chunks, chunk_size)
+        assert util.decode_chunked(body) == (decode_chunked_slicing(body), None)
+        old = bench(decode_chunked_slicing, body, repeat)
+        new = bench(util.decode_chunked, body, repeat)
+        print('%8d %10d %11.4fs %11.4fs %14.0f' % (chunks, len(body), old, new, new / chunks * 1e9))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,117 @@
+"""比较 Api.add_session 原来逐个 like() 比较的去重和现在按 key 查找的去重，并检查两者留下的 session 完全一样
+
+    python -m benchmarks.bench_dedup -n 5000 -e 10
+
+先用 benchmarks.corpus 生成 .api 数据文件，每个工具（apiblue、apiman、apiswagger）分别读取所有 session，
+再按 API 去重。接口少、session 多时原来的去重是 O(n²)，每次比较都要重新 dumps schema 和 loads body。
+"""
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from apiutils import apiblue
+from apiutils import apiman
+from apiutils import apireader
+from apiutils import apistore
+from apiutils import apiswagger
+from apiutils import jsonlib
+from benchmarks.corpus import Corpus, corpus_options
+
+
+def compare_body(message, other):
+    """原来的 HTTPMessage.compare_body
+    """
+    if message.schema and other.schema:
+        return jsonlib.dumps(message.schema) == jsonlib.dumps(other.schema)
+    return message.simplified_body == other.simplified_body
+
+
+def compare_response_body(response, other):
+    """原来的 Response.compare_body
+    """
+    if response.schema and other.schema:
+        data = jsonlib.loads(response.simplified_body)
+        if isinstance(data, dict) and 'code' in data:
+            other_data = jsonlib.loads(other.simplified_body)
+            if isinstance(other_data, dict) and 'code' in other_data:
+                if data['code'] != other_data['code']:
+                    return False
+    return compare_body(response, other)
+
+
+def like(session, other):
+    """原来的 ApiSession.like
+    """
+    return (session.request.method == other.request.method and compare_body(session.request, other.request) and
+            session.response.response_line == other.response.response_line and
+            compare_response_body(session.response, other.response))
+
+
+def dedup_like(sessions):
+    kept = []
+    for session in sessions:
+        if not any(like(s, session) for s in kept):
+            kept.append(session)
+    return kept
+
+
+def dedup_key(module, sessions):
+    api = module.Api()
+    for session in sessions:
+        api.add_session(session)
+    return api.sessions
+
+
+def load_apis(module, api_dir, keep_list_item):
+    """读取所有 session（解码 body 后 detach），返回 [[session, ...], ...]，每个 API 一个列表
+    """
+    store = apistore.ApiStore(api_dir)
+    apis = []
+    with apireader.ApiReader(store, keep_list_item) as reader:
+        for root, names in apireader.walk_apis(store):
+            for filenames in names.values():
+                sessions = []
+                for filename in filenames:
+                    session = reader.read_session(Path(root) / filename, module.Request, module.Response,
+                                                  module.ApiSession)
+                    session.request.detach()
+                    session.response.detach()
+                    reader.release()
+                    sessions.append(session)
+                apis.append(sessions)
+    return apis
+
+
+@click.command()
+@corpus_options
+@click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
+def run(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed, keep_list_item):
+    corpus = Corpus(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed)
+    work_dir = tempfile.mkdtemp(prefix='apiutils-dedup-')
+    try:
+        api_dir = os.path.join(work_dir, 'api')
+        corpus.write_api(api_dir)
+
+        print('%-10s %8s %8s %10s %10s %8s' % ('', 'sessions', 'kept', 'like()', 'key', 'speedup'))
+        for module in (apiblue, apiman, apiswagger):
+            apis = load_apis(module, api_dir, keep_list_item)
+            start = time.perf_counter()
+            old = [dedup_like(sessions) for sessions in apis]
+            old_time = time.perf_counter() - start
+            start = time.perf_counter()
+            new = [dedup_key(module, sessions) for sessions in apis]
+            new_time = time.perf_counter() - start
+            # 留下的 session 必须完全一样
+            assert [list(map(id, sessions)) for sessions in old] == [list(map(id, sessions)) for sessions in new]
+            print('%-10s %8d %8d %9.3fs %9.3fs %7.1fx' % (
+                module.__name__.rpartition('.')[2], sum(map(len, apis)), sum(map(len, new)),
+                old_time, new_time, old_time / new_time))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
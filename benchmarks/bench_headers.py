@@ -0,0 +1,87 @@
+"""比较 Header 分析的耗时：原来的实现（先解码整个 Header 再逐行 partition）和 util.http_parse_headers
+
+    python -m benchmarks.bench_headers
+"""
+import time
+
+import click
+from apiutils import util
+
+REQUEST_HEADERS = b'\r\n'.join([
+    b'X-Real-IP: a00:102::',
+    b'Host: api.example.com',
+    b'Connection: keep-alive',
+    b'Accept: application/json, text/plain, */*',
+    b'User-Agent: Mozilla/5.0 (iPhone; CPU iPhone OS 10_3 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) '
+    b'Mobile/14E277 MicroMessenger/6.5.10',
+    b'Referer: https://m.example.com/match/detail?id=20170714',
+    b'Accept-Encoding: gzip, deflate',
+    b'Accept-Language: zh-CN,zh;q=0.8,en;q=0.6',
+    b'Cookie: sid=4b0c1f2e8a9d4e7f; uid=10086; theme=dark; _ga=GA1.2.1234567890.1500000000',
+    b'Content-Type: application/x-www-form-urlencoded; charset=UTF-8',
+    b'Content-Length: 57',
+    b'X-Requested-With: XMLHttpRequest',
+    b'X-Forwarded-For: 10.0.1.2, 172.16.0.1',
+])
+
+RESPONSE_HEADERS = b'\r\n'.join([
+    b'Server: nginx/1.10.3',
+    b'Date: Fri, 14 Jul 2017 03:19:40 GMT',
+    b'Content-Type: application/json;charset=UTF-8',
+    b'Transfer-Encoding: chunked',
+    b'Connection: keep-alive',
+    b'Vary: Accept-Encoding',
+    b'Set-Cookie: sid=4b0c1f2e8a9d4e7f; Path=/; HttpOnly',
+    b'Set-Cookie: uid=10086; Path=/; Max-Age=2592000',
+    b'Set-Cookie: theme=dark; Path=/',
+    b'Cache-Control: no-cache',
+    b'Content-Encoding: gzip',
+])
+
+
+def parse_headers_text(raw_headers, real_ip=False):
+    """原来的实现：解码成文本，转换 X-Real-IP，再逐行分析
+    """
+    text = raw_headers.decode('iso-8859-1')
+    if real_ip:
+        text = util.hack_gor_real_ip(text)
+    headers = {}
+    key = value = None
+    for line in text.splitlines(False):
+        if not line:
+            continue
+        if line[0] not in " \t":
+            key, _, value = line.partition(":")
+            key = key.strip().lower()
+            headers[key] = value.strip()
+        else:
+            headers[key] += value.strip()
+    return headers
+
+
+def bench(func, count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count * 1e9
+
+
+@click.command()
+@click.option('--count', '-n', default=100000, help='每种情况分析的次数.')
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+def run(count, repeat):
+    print('%-10s %10s %10s %10s' % ('headers', 'text', 'bytes', 'subset'))
+    for name, raw, real_ip in (('request', REQUEST_HEADERS, True), ('response', RESPONSE_HEADERS, False)):
+        assert util.http_parse_headers(raw, real_ip=real_ip) == parse_headers_text(raw, real_ip)
+        old = bench(lambda: parse_headers_text(raw, real_ip), count, repeat)
+        new = bench(lambda: util.http_parse_headers(raw, real_ip=real_ip), count, repeat)
+        subset = bench(lambda: util.http_parse_headers(raw, util.BODY_HEADERS), count, repeat)
+        print('%-10s %8.0fns %8.0fns %8.0fns' % (name, old, new, subset))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,81 @@
+"""比较 apicapture 按行读取和按块读取 gor 数据流的吞吐量
+
+    python -m benchmarks.bench_ingest -n 20000
+
+另外比较按块读取时逐行解码 hex（unhexlify_lines）和整块一次解码再按行切开，后者要多复制两遍，并不更快。
+"""
+import binascii
+import io
+import time
+
+import click
+from apiutils.apicapture import APICapture, split_gor_lines, unhexlify_lines
+from benchmarks.gorstream import gor_stream
+
+
+class NullCapture(APICapture):
+    """只解码，不分析数据包，用于单独测量读取和解码的开销
+    """
+    def parse_gor_packet(self, packet):
+        pass
+
+
+def bench(capture, data, block_size):
+    capture.requests.clear()
+    capture.block_size = block_size
+    if block_size:
+        stream = io.BufferedReader(io.BytesIO(data))
+        start = time.perf_counter()
+        capture.ingest_blocks(stream)
+    else:
+        stream = io.TextIOWrapper(io.BytesIO(data), encoding='ascii')
+        start = time.perf_counter()
+        capture.ingest_lines(stream)
+    return time.perf_counter() - start
+
+
+def unhexlify_block(lines):
+    """整块一次解码：先拼成一块并去掉换行，解码后再按每行的长度切开
+    """
+    decoded = binascii.unhexlify(b''.join(lines))
+    packets = []
+    start = 0
+    for line in lines:
+        end = start + len(line) // 2
+        packets.append(decoded[start:end])
+        start = end
+    return packets
+
+
+def bench_hex(data, block_size):
+    batches = list(split_gor_lines(io.BufferedReader(io.BytesIO(data)), block_size))
+    results = []
+    for decode in (unhexlify_lines, unhexlify_block):
+        start = time.perf_counter()
+        packets = [packet for lines in batches for packet in decode(lines)]
+        results.append((packets, time.perf_counter() - start))
+    assert results[0][0] == results[1][0]
+    return [elapsed for _, elapsed in results]
+
+
+@click.command()
+@click.option('--count', '-n', default=20000, help='Request/Response 对数.')
+@click.option('--block-size', '-b', default=1 << 20, help='按块读取的字节数.')
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+@click.option('--host', '-h', multiple=True, help='host 过滤（测量过滤掉的流量的开销）.')
+def run(count, block_size, repeat, host):
+    data = gor_stream(count)
+    packets = count * 2
+    print('%d packets, %.1f MB' % (packets, len(data) / 1e6))
+    for cls in (NullCapture, APICapture):
+        capture = cls(host, (), None, False, 1, count * 2)
+        for mode, size in (('lines', 0), ('blocks', block_size)):
+            elapsed = min(bench(capture, data, size) for _ in range(repeat))
+            print('%-12s %-7s %8.3fs %10.0f packets/s' % (cls.__name__, mode, elapsed, packets / elapsed))
+    per_line, per_block = map(min, zip(*(bench_hex(data, block_size) for _ in range(repeat))))
+    print('hex decode   lines   %8.3fs %10.0f packets/s' % (per_line, packets / per_line))
+    print('hex decode   block   %8.3fs %10.0f packets/s' % (per_block, packets / per_block))
+
+
+if __name__ == '__main__':
+    run()
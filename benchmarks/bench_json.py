@@ -0,0 +1,122 @@
+"""比较标准库 json 和 orjson（apiutils.jsonlib）的耗时，并检查两者的输出完全一样
+
+    python -m benchmarks.bench_json -n 5000
+
+先用 benchmarks.corpus 生成 .api 数据文件，然后分别测量：
+
+* 简化后的 body 的 dumps 和 loads（apiblue 等比较 API 时会重新 loads）
+* apiblue、apiman、apiswagger 生成文档的总耗时
+"""
+import contextlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import click
+from apiutils import jsonlib
+from apiutils import util
+from apiutils.apiblue import ApiBlue
+from apiutils.apiman import ApiMan
+from apiutils.apiswagger import ApiSwagger
+from benchmarks.corpus import Corpus, corpus_options
+
+
+@contextlib.contextmanager
+def backend(name):
+    """临时切换 jsonlib 使用的库
+    """
+    orjson = jsonlib.orjson
+    if name == 'json':
+        jsonlib.orjson = None
+    try:
+        yield
+    finally:
+        jsonlib.orjson = orjson
+
+
+def simplified_bodies(corpus):
+    bodies = []
+    for _, _, response, _, _ in corpus.sessions():
+        _, raw_headers, body = util.http_split_message(response)
+        headers = util.http_parse_headers(raw_headers)
+        bodies.append(util.json_loads_simplified(util.decode_body(headers, body)))
+    return bodies
+
+
+def bench(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run_blue(api_dir, output):
+    with open(output, 'wb') as fp:
+        ApiBlue('API', 'http://{host}', 3, api_dir, fp).run()
+
+
+def run_man(api_dir, output):
+    ApiMan('API', 'http://{host}', 3, api_dir, output).run()
+
+
+def run_swagger(api_dir, output):
+    ApiSwagger('API', 'http://{host}', 3, api_dir, output).run()
+
+
+def read_output(filename):
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    # apiman 每次生成的 id 不同
+    return re.sub(rb'"id": "[0-9a-f-]{36}"', b'"id": "UUID"', data)
+
+
+@click.command()
+@corpus_options
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+def run(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed, repeat):
+    if jsonlib.orjson is None:
+        print('没有安装 orjson（或设置了 APIUTILS_JSON=json），两者相同')
+
+    corpus = Corpus(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed)
+    bodies = simplified_bodies(corpus)
+    texts = [jsonlib.dumps(body) for body in bodies]
+    print('%d bodies, %.1f MB simplified' % (len(bodies), sum(map(len, texts)) / 1e6))
+
+    print('%-10s %10s %10s %8s' % ('', 'json', 'orjson', 'speedup'))
+    for name, func in (('dumps', lambda: [jsonlib.dumps(body) for body in bodies]),
+                       ('loads', lambda: [jsonlib.loads(text) for text in texts])):
+        results = {}
+        for lib in ('json', 'orjson'):
+            with backend(lib):
+                results[lib] = bench(func, repeat)
+        assert results['json'][0] == results['orjson'][0]
+        old, new = results['json'][1], results['orjson'][1]
+        print('%-10s %9.3fs %9.3fs %7.1fx' % (name, old, new, old / new))
+
+    work_dir = tempfile.mkdtemp(prefix='apiutils-json-')
+    try:
+        api_dir = os.path.join(work_dir, 'api')
+        corpus.write_api(api_dir)
+        for name, func in (('apiblue', run_blue), ('apiman', run_man), ('apiswagger', run_swagger)):
+            results = {}
+            for lib in ('json', 'orjson'):
+                output = os.path.join(work_dir, '%s.%s' % (name, lib))
+                with backend(lib):
+                    _, results[lib] = bench(lambda: func(api_dir, output), repeat)
+                results[lib] = (read_output(output), results[lib])
+            # 输出必须完全一样
+            assert results['json'][0] == results['orjson'][0]
+            old, new = results['json'][1], results['orjson'][1]
+            print('%-10s %9.3fs %9.3fs %7.1fx' % (name, old, new, old / new))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
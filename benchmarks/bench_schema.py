@@ -0,0 +1,193 @@
+"""比较 util.simplify、apischema.build_schema 和 util.json_shape（按结构去重、索引的指纹）原来的递归实现和
+现在用栈的实现
+
+    python -m benchmarks.bench_schema
+
+文档分三种：很宽（一层有很多键）、很深（嵌套很多层）和列表很多。原来的 json_shape 返回嵌套的 tuple，
+再由 apiindex.canonical 转成字符串；现在的 json_shape 返回摘要，先用随机的文档检查两者认为结构相同的文档完全一样。
+"""
+import functools
+import json
+import random
+import time
+
+import click
+from apiutils import apischema
+from apiutils import util
+
+
+def simplify_recursive(data, keep_list_item=3):
+    """原来的 util.simplify
+    """
+    if isinstance(data, dict):
+        for value in data.values():
+            simplify_recursive(value, keep_list_item)
+    elif isinstance(data, list):
+        del data[keep_list_item:]
+        for item in data:
+            simplify_recursive(item, keep_list_item)
+
+
+def build_schema_recursive(data, descriptions=None):
+    """原来的 apischema.build_schema
+    """
+    if isinstance(data, dict):
+        properties = {}
+        for name, value in data.items():
+            schema = build_schema_recursive(value, descriptions)
+            if descriptions and name in descriptions:
+                schema.update(description=descriptions[name])
+            properties[name] = schema
+        schema = {
+            'type': 'object',
+        }
+        if properties:
+            schema.update(properties=properties)
+        return schema
+    elif isinstance(data, list):
+        return {
+            'type': 'array',
+            'items': build_schema_recursive(data[0] if len(data) else None, descriptions),
+        }
+    elif isinstance(data, bool):
+        return apischema.build_boolean(data)
+    elif isinstance(data, int):
+        return apischema.build_number(data)
+    elif data is None:
+        return apischema.build_null(data)
+    else:
+        return apischema.build_string(data)
+
+
+def json_shape_recursive(data, keep_list_item=3):
+    """原来的 util.json_shape
+    """
+    if isinstance(data, dict):
+        return 'object', tuple(sorted((key, json_shape_recursive(value, keep_list_item))
+                                      for key, value in data.items()))
+    elif isinstance(data, list):
+        return 'array', frozenset(json_shape_recursive(item, keep_list_item) for item in data[:keep_list_item])
+    elif isinstance(data, bool):
+        return 'boolean'
+    elif isinstance(data, int):
+        return 'integer'
+    elif isinstance(data, float):
+        return 'number'
+    elif data is None:
+        return 'null'
+    else:
+        return 'string'
+
+
+def canonical_recursive(shape):
+    """原来的 apiindex.canonical
+    """
+    if isinstance(shape, frozenset):
+        return '{%s}' % ','.join(sorted(canonical_recursive(item) for item in shape))
+    if isinstance(shape, tuple):
+        return '(%s)' % ','.join(canonical_recursive(item) for item in shape)
+    return repr(shape)
+
+
+def make_random(rnd, depth):
+    """随机的文档，键和值的种类很少，这样才会有很多结构相同的文档
+    """
+    if depth <= 0 or rnd.random() < 0.25:
+        return rnd.choice([1, 1.5, True, None, 'x'])
+    if rnd.random() < 0.5:
+        return [make_random(rnd, depth - 1) for _ in range(rnd.randint(0, 4))]
+    return {rnd.choice(['a', 'b', "it's"]): make_random(rnd, depth - 1) for _ in range(rnd.randint(0, 3))}
+
+
+def check_shapes(count, keep_list_item=3):
+    """原来的和现在的 json_shape 对文档的分组（结构相同的文档）必须完全一样
+    """
+    rnd = random.Random(0)
+    old_to_new = {}
+    new_to_old = {}
+    for _ in range(count):
+        data = make_random(rnd, 5)
+        old = canonical_recursive(json_shape_recursive(data, keep_list_item))
+        new = util.json_shape(data, keep_list_item)
+        assert old_to_new.setdefault(old, new) == new and new_to_old.setdefault(new, old) == old
+    print('%d random documents, %d shapes' % (count, len(old_to_new)))
+
+
+def make_wide(width):
+    return {'field_%d' % i: [i, 'value-%d' % i, i * 0.5, i % 2 == 0, None, {'id': i}][i % 6] for i in range(width)}
+
+
+def make_deep(depth):
+    data = {'leaf': 1}
+    for i in range(depth):
+        data = {'level': i, 'child': data} if i % 2 else [data, {'level': i}]
+    return data
+
+
+def make_arrays(items):
+    return {'code': 0, 'data': {'list': [{'id': i, 'tags': ['a', 'b', 'c', 'd'], 'scores': list(range(10)),
+                                          'children': [{'id': j, 'path': [i, j]} for j in range(5)]}
+                                         for i in range(items)]}}
+
+
+def bench(func, make_data, repeat):
+    """返回 (结果, 最好成绩)，RecursionError 时成绩为 None
+
+    simplify 会修改数据，所以每次都重新生成数据（不计时）。
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        data = make_data()
+        start = time.perf_counter()
+        try:
+            result = func(data)
+        except RecursionError:
+            return None, None
+        elapsed = time.perf_counter() - start
+        if result is None:
+            result = data
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def format_time(seconds):
+    return '%9.4fs' % seconds if seconds is not None else '%10s' % 'error'
+
+
+@click.command()
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+def run(repeat):
+    check_shapes(20000)
+    documents = [
+        ('wide 10000', functools.partial(make_wide, 10000)),
+        ('wide 100000', functools.partial(make_wide, 100000)),
+        ('deep 500', functools.partial(make_deep, 500)),
+        ('deep 5000', functools.partial(make_deep, 5000)),
+        ('deep 100000', functools.partial(make_deep, 100000)),
+        ('arrays 2000', functools.partial(make_arrays, 2000)),
+        ('arrays 20000', functools.partial(make_arrays, 20000)),
+    ]
+    print('%-14s %10s %10s %10s %10s %10s %10s' % (
+        'document', 'simplify', '(stack)', 'schema', '(stack)', 'shape', '(stack)'))
+    for name, make_data in documents:
+        old_simplified, old_simplify = bench(simplify_recursive, make_data, repeat)
+        new_simplified, new_simplify = bench(util.simplify, make_data, repeat)
+        old_schema, old_build = bench(build_schema_recursive, make_data, repeat)
+        new_schema, new_build = bench(apischema.build_schema, make_data, repeat)
+        _, old_shape_time = bench(lambda data: canonical_recursive(json_shape_recursive(data)), make_data, repeat)
+        new_shape, new_shape_time = bench(util.json_shape, make_data, repeat)
+        # 原来的实现在很深的文档上会 RecursionError，这时就不比较了；json.dumps 本身也是递归的
+        if old_simplify is not None:
+            assert json.dumps(old_simplified) == json.dumps(new_simplified)
+        if old_build is not None:
+            assert json.dumps(old_schema) == json.dumps(new_schema)
+        # 结构是摘要字符串，很深的文档也可以比较（嵌套的 tuple 比较时会 RecursionError）
+        assert new_shape == util.json_shape(make_data())
+        print('%-14s %s %s %s %s %s %s' % (name, format_time(old_simplify), format_time(new_simplify),
+                                           format_time(old_build), format_time(new_build),
+                                           format_time(old_shape_time), format_time(new_shape_time)))
+
+
+if __name__ == '__main__':
+    run()
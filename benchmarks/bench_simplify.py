@@ -0,0 +1,96 @@
+"""比较 simplify_body 的耗时和内存：json.loads + simplify 和 util.json_loads_simplified
+
+    python -m benchmarks.bench_simplify
+
+先检查嵌套很深的 body：不超过 util.MAX_JSON_DEPTH 层时正常输出（原来的实现递归出错），更深的返回原文，都不会出错。
+"""
+import json
+import time
+import tracemalloc
+
+import click
+from apiutils import util
+
+
+def simplify_body_loads(body, keep_list_item):
+    """原来的实现：先解析全部数据，再删除列表中多余的项
+    """
+    obj = json.loads(body)
+    util.simplify(obj, keep_list_item)
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
+
+
+def make_list_body(items):
+    """列表接口的 response：data.list 中有 items 项
+    """
+    return json.dumps({
+        'code': 0,
+        'message': 'ok',
+        'data': {
+            'total': items,
+            'list': [{'id': i, 'name': 'item-%d' % i, 'tags': ['a', 'b', 'c'], 'score': i * 0.5,
+                      'owner': {'id': i % 100, 'nick': '用户%d' % i}} for i in range(items)],
+        },
+    }, ensure_ascii=False)
+
+
+def deep_body(depth, is_dict):
+    """嵌套 depth 层的 body 和简化后应该输出的内容（超过 MAX_JSON_DEPTH 层时为原文）
+    """
+    if is_dict:
+        body = '{"a": ' * depth + '1' + '}' * depth
+    else:
+        body = '[' * depth + '1' + ']' * depth
+    if depth > util.MAX_JSON_DEPTH:
+        return body, body
+    if is_dict:
+        lines = ['{'] + ['  ' * i + '"a": {' for i in range(1, depth)] + ['  ' * depth + '"a": 1']
+        lines += ['  ' * i + '}' for i in reversed(range(depth))]
+    else:
+        lines = ['  ' * i + '[' for i in range(depth)] + ['  ' * depth + '1']
+        lines += ['  ' * i + ']' for i in reversed(range(depth))]
+    return body, '\n'.join(lines)
+
+
+def check_deep(keep_list_item):
+    for depth in (100, 500, util.MAX_JSON_DEPTH, util.MAX_JSON_DEPTH + 1, 5000, 100000):
+        for is_dict in (False, True):
+            body, expected = deep_body(depth, is_dict)
+            start = time.perf_counter()
+            result = util.simplify_body(body, keep_list_item)
+            elapsed = time.perf_counter() - start
+            assert result == expected, (depth, is_dict)
+            print('deep %-4s %6d levels: %s %.3fs' % (
+                'dict' if is_dict else 'list', depth, 'json' if result != body else 'text', elapsed))
+
+
+def bench(func, body, keep_list_item):
+    """返回 (结果, 耗时, 内存峰值)，tracemalloc 会拖慢速度，所以分开测
+    """
+    start = time.perf_counter()
+    result = func(body, keep_list_item)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(body, keep_list_item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+@click.command()
+@click.option('--keep-list-item', '-k', default=3, help='列表中保留的项数.')
+def run(keep_list_item):
+    check_deep(keep_list_item)
+    print('%8s %10s %10s %10s %12s %12s' % ('items', 'MB', 'loads', 'streaming', 'loads peak', 'stream peak'))
+    for items in (1000, 10000, 100000, 300000):
+        body = make_list_body(items)
+        old, old_time, old_peak = bench(simplify_body_loads, body, keep_list_item)
+        new, new_time, new_peak = bench(util.simplify_body, body, keep_list_item)
+        assert old == new
+        print('%8d %10.1f %9.3fs %9.3fs %10.1fMB %10.1fMB' % (
+            items, len(body) / 1e6, old_time, new_time, old_peak / 1e6, new_peak / 1e6))
+
+
+if __name__ == '__main__':
+    run()
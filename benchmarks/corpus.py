@@ -0,0 +1,281 @@
+"""生成性能测试用的模拟数据：gor 数据流（hex 格式）、.api 数据文件目录和 apigen 的 yaml 文件
+
+    python -m benchmarks.corpus -o /tmp/corpus -n 10000 -e 50 --body-size 4096 --gzip 0.3 --chunked 0.2 --depth 3
+
+生成的数据只由参数决定（包括 seed），同样的参数总是生成同样的数据::
+
+    /tmp/corpus/gor.hex       gor 数据流，可以直接输入 apicapture
+    /tmp/corpus/api/          用 apicapture 保存的 .api 数据文件
+    /tmp/corpus/apigen.yaml   每个接口一个 yaml 文档
+"""
+import binascii
+import gzip
+import json
+import os
+import random
+from urllib.parse import urlencode
+
+import click
+import yaml
+from apiutils.apicapture import APICapture
+from benchmarks.gorstream import make_request
+
+# 每层对象中的标量字段：(名称, 类型)
+SCALAR_TYPES = ('int', 'str', 'float', 'bool', 'null')
+# 出错的比例，出错时 Response 只有很小的 body
+ERROR_RATIO = 0.02
+CHUNK_SIZE = 4096
+
+
+def make_response(body, status='200 OK', encoding=None, chunked=False):
+    lines = [
+        'HTTP/1.1 %s' % status,
+        'Server: nginx',
+        'Date: Mon, 17 Oct 2026 10:00:00 GMT',
+        'Content-Type: application/json; charset=utf-8',
+    ]
+    if encoding:
+        lines.append('Content-Encoding: %s' % encoding)
+    if chunked:
+        lines.append('Transfer-Encoding: chunked')
+        body = b''.join(b'%x\r\n%s\r\n' % (len(body[i:i + CHUNK_SIZE]), body[i:i + CHUNK_SIZE])
+                        for i in range(0, len(body), CHUNK_SIZE)) + b'0\r\n\r\n'
+    else:
+        lines.append('Content-Length: %d' % len(body))
+    lines.append('Connection: keep-alive')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+class Endpoint(object):
+    """一个接口：路径、方法、query 参数和 Response 的结构都是固定的，只有值是随机的
+    """
+    def __init__(self, rnd, index, depth):
+        self.index = index
+        self.path = '/interface/group%d/action%d' % (index % 7, index)
+        self.method = 'POST' if index % 3 == 0 else 'GET'
+        self.form = index % 6 == 0
+        self.query_keys = ['q%d' % i for i in range(rnd.randrange(4))]
+        # fields[level] 是第 level 层对象（0 是最里层）的标量字段
+        self.fields = [[('f%d_%d' % (level, i), rnd.choice(SCALAR_TYPES)) for i in range(rnd.randrange(2, 6))]
+                       for level in range(depth)]
+
+    def make_query(self, rnd):
+        query = [(key, str(rnd.randrange(100))) for key in self.query_keys]
+        return '?' + urlencode(query) if query else ''
+
+    def make_request_body(self, rnd):
+        if self.method != 'POST':
+            return b''
+        data = {'id': rnd.randrange(10000), 'name': 'user%d' % rnd.randrange(100), 'vip': rnd.random() < 0.5}
+        if self.form:
+            return urlencode(dict(data, vip=json.dumps(data['vip']))).encode()
+        return json.dumps(data).encode()
+
+    def make_record(self, rnd, seq):
+        """生成一条记录，从最里层开始逐层包装，嵌套层数由 depth 决定
+        """
+        record = {'id': seq}
+        for fields in self.fields:
+            obj = {'child': record, 'tags': ['a', 'b', 'c']}
+            for name, type_ in fields:
+                obj[name] = make_scalar(rnd, type_)
+            record = obj
+        return record
+
+    def make_body(self, rnd, body_size):
+        """生成大小约为 body_size 的 body：data.list 中的记录数按第一条记录的大小估算
+        """
+        first = self.make_record(rnd, 0)
+        count = max(1, body_size // len(json.dumps(first)))
+        data = {
+            'code': 0,
+            'message': 'ok',
+            'data': {
+                'total': count,
+                'list': [first] + [self.make_record(rnd, seq) for seq in range(1, count)],
+            },
+        }
+        return data
+
+
+def make_scalar(rnd, type_):
+    if type_ == 'int':
+        return rnd.randrange(1 << 20)
+    elif type_ == 'str':
+        return 'value-%d' % rnd.randrange(1000)
+    elif type_ == 'float':
+        return round(rnd.random() * 100, 3)
+    elif type_ == 'bool':
+        return rnd.random() < 0.5
+    return None
+
+
+class Corpus(object):
+    """模拟数据的参数和生成方法
+
+    * size: Request/Response 对数
+    * endpoints: 接口数
+    * body_size: Response body（压缩前）的大约字节数
+    * gzip_ratio: 用 gzip 压缩的 Response 的比例
+    * chunked_ratio: 用 chunked 传输的 Response 的比例
+    * depth: Response 中记录的嵌套层数
+    """
+    def __init__(self, size=1000, endpoints=20, body_size=2048, gzip_ratio=0.3, chunked_ratio=0.2, depth=3, seed=0):
+        self.size = size
+        self.endpoints = endpoints
+        self.body_size = body_size
+        self.gzip_ratio = gzip_ratio
+        self.chunked_ratio = chunked_ratio
+        self.depth = depth
+        self.seed = seed
+
+    @property
+    def params(self):
+        return {
+            'size': self.size,
+            'endpoints': self.endpoints,
+            'body_size': self.body_size,
+            'gzip_ratio': self.gzip_ratio,
+            'chunked_ratio': self.chunked_ratio,
+            'depth': self.depth,
+            'seed': self.seed,
+        }
+
+    def make_endpoints(self):
+        rnd = random.Random(self.seed)
+        return [Endpoint(rnd, index, self.depth) for index in range(self.endpoints)]
+
+    def sessions(self):
+        """产生 (endpoint, request, response, timestamp, latency)，时间戳单位是纳秒
+
+        相邻两个 session 至少间隔 1 秒，保存的 .api 文件名不会重复（文件名精确到秒）。
+        """
+        endpoints = self.make_endpoints()
+        rnd = random.Random(self.seed + 1)
+        timestamp = 1500000000000000000
+        for seq in range(self.size):
+            endpoint = rnd.choice(endpoints)
+            body = endpoint.make_request_body(rnd)
+            request = make_request(endpoint.path + endpoint.make_query(rnd), body=body)
+            if endpoint.form and body:
+                request = request.replace(b'application/json', b'application/x-www-form-urlencoded', 1)
+
+            if rnd.random() < ERROR_RATIO:
+                status, data = '500 Internal Server Error', {'code': 500, 'message': 'error'}
+            else:
+                status, data = '200 OK', endpoint.make_body(rnd, self.body_size)
+            body = json.dumps(data).encode()
+            encoding = None
+            if rnd.random() < self.gzip_ratio:
+                body = gzip.compress(body, mtime=0)
+                encoding = 'gzip'
+            chunked = rnd.random() < self.chunked_ratio
+            response = make_response(body, status, encoding, chunked)
+
+            timestamp += rnd.randrange(1000000000, 3000000000)
+            latency = rnd.randrange(1000000, 500000000)
+            yield endpoint, request, response, timestamp, latency
+
+    def gor_packets(self):
+        """产生 gor 数据包（未编码）
+        """
+        for seq, (_, request, response, timestamp, latency) in enumerate(self.sessions()):
+            uuid = '%024x' % (self.seed << 64 | seq)
+            yield ('1 %s %d\n' % (uuid, timestamp)).encode() + request
+            yield ('2 %s %d %d\n' % (uuid, timestamp, latency)).encode() + response
+
+    def gor_stream(self):
+        lines = [binascii.hexlify(packet) for packet in self.gor_packets()]
+        lines.append(b'')
+        return b'\n'.join(lines)
+
+    def write_gor(self, filename):
+        with open(filename, 'wb') as fp:
+            for packet in self.gor_packets():
+                fp.write(binascii.hexlify(packet))
+                fp.write(b'\n')
+
+    def write_api(self, save_dir):
+        """用 apicapture 保存 .api 数据文件，格式和实际采集的数据完全一样
+        """
+        capture = APICapture((), (), save_dir, False, 1, 1024)
+        for packet in self.gor_packets():
+            capture.parse_gor_packet(packet)
+        capture.close_writer()
+
+    def apigen_documents(self):
+        """每个接口一个 apigen 的 yaml 文档
+        """
+        rnd = random.Random(self.seed + 2)
+        for endpoint in self.make_endpoints():
+            request = {
+                'summary': 'action%d' % endpoint.index,
+                'method': endpoint.method,
+                'url': endpoint.path + endpoint.make_query(rnd),
+                'tags': ['group%d' % (endpoint.index % 7)],
+            }
+            body = endpoint.make_request_body(rnd)
+            if body:
+                request['form' if endpoint.form else 'body'] = body.decode()
+            yield {
+                'request': request,
+                'responses': {
+                    '200': {
+                        'description': 'OK',
+                        'body': json.dumps(endpoint.make_body(rnd, self.body_size)),
+                    },
+                },
+            }
+
+    def write_apigen(self, filename):
+        with open(filename, 'w', encoding='utf-8') as fp:
+            yaml.safe_dump_all(self.apigen_documents(), fp, allow_unicode=True)
+
+    def sample_bodies(self):
+        """每个接口一个 Response body（已解析的 JSON），用于测试 apischema.build_schema
+        """
+        rnd = random.Random(self.seed + 3)
+        return [endpoint.make_body(rnd, self.body_size) for endpoint in self.make_endpoints()]
+
+    def write(self, output_dir):
+        """生成全部数据，返回 (gor 数据流文件, .api 数据文件目录, apigen yaml 文件)
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        gor_file = os.path.join(output_dir, 'gor.hex')
+        api_dir = os.path.join(output_dir, 'api')
+        apigen_file = os.path.join(output_dir, 'apigen.yaml')
+        self.write_gor(gor_file)
+        self.write_api(api_dir)
+        self.write_apigen(apigen_file)
+        return gor_file, api_dir, apigen_file
+
+
+def corpus_options(func):
+    """模拟数据的命令行参数，harness 也使用
+    """
+    options = [
+        click.option('--size', '-n', default=1000, help='Request/Response 对数.'),
+        click.option('--endpoints', '-e', default=20, help='接口数.'),
+        click.option('--body-size', default=2048, help='Response body（压缩前）的大约字节数.'),
+        click.option('--gzip', 'gzip_ratio', default=0.3, help='用 gzip 压缩的 Response 的比例.'),
+        click.option('--chunked', 'chunked_ratio', default=0.2, help='用 chunked 传输的 Response 的比例.'),
+        click.option('--depth', default=3, help='Response 中记录的嵌套层数.'),
+        click.option('--seed', default=0, help='随机数种子.'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+@click.command()
+@click.option('--output-dir', '-o', default='corpus', help='输出目录.')
+@corpus_options
+def run(output_dir, size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed):
+    corpus = Corpus(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed)
+    for filename in corpus.write(output_dir):
+        print(filename)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,48 @@
+"""模拟多个 goreplay 实例，通过 socket 向 `apicapture --listen` 发送 gor 数据流
+
+    apicapture -l :28020 -s /tmp/api &
+    python -m benchmarks.gorfeed -a :28020 -c 4 -n 10000
+"""
+import asyncio
+import time
+
+import click
+from apiutils.apicapture import parse_listen_address
+from benchmarks.gorstream import gor_stream
+
+
+async def feed(address, data, chunk_size):
+    kind, *address = parse_listen_address(address)
+    if kind == 'unix':
+        _, writer = await asyncio.open_unix_connection(*address)
+    else:
+        _, writer = await asyncio.open_connection(*address)
+    for start in range(0, len(data), chunk_size):
+        writer.write(data[start:start + chunk_size])
+        # 服务端读不过来时在这里等待（背压）
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def feed_all(address, streams, chunk_size):
+    await asyncio.gather(*(feed(address, data, chunk_size) for data in streams))
+
+
+@click.command()
+@click.option('--address', '-a', default=':28020', help='apicapture 监听地址.')
+@click.option('--connections', '-c', default=4, help='并发连接数.')
+@click.option('--count', '-n', default=10000, help='每个连接发送的 Request/Response 对数.')
+@click.option('--chunk-size', default=1 << 16, help='每次发送的字节数.')
+def run(address, connections, count, chunk_size):
+    # 不同的 seed 保证各个连接的 uuid 不重复
+    streams = [gor_stream(count, seed=seed) for seed in range(connections)]
+    start = time.perf_counter()
+    asyncio.run(feed_all(address, streams, chunk_size))
+    elapsed = time.perf_counter() - start
+    packets = connections * count * 2
+    print('%d packets in %.3fs, %.0f packets/s' % (packets, elapsed, packets / elapsed))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,71 @@
+"""生成模拟的 gor 数据流（goreplay middleware 的 hex 格式）
+"""
+import binascii
+import json
+import random
+
+
+def make_request(path, host='api.example.com', body=b''):
+    method = 'POST' if body else 'GET'
+    lines = [
+        '%s %s HTTP/1.1' % (method, path),
+        'Host: %s' % host,
+        'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36',
+        'Accept: application/json',
+        'Accept-Encoding: gzip, deflate',
+        'Connection: keep-alive',
+    ]
+    if body:
+        lines.append('Content-Type: application/json')
+        lines.append('Content-Length: %d' % len(body))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def make_response(body, status='200 OK'):
+    lines = [
+        'HTTP/1.1 %s' % status,
+        'Server: nginx',
+        'Date: Mon, 17 Oct 2026 10:00:00 GMT',
+        'Content-Type: application/json; charset=utf-8',
+        'Content-Length: %d' % len(body),
+        'Connection: keep-alive',
+    ]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def make_body(rnd, items):
+    data = {
+        'code': 0,
+        'message': 'ok',
+        'data': [{'id': rnd.randrange(1 << 20), 'name': 'item-%d' % i, 'score': rnd.random()}
+                 for i in range(items)],
+    }
+    return json.dumps(data).encode()
+
+
+def gor_packets(count, endpoints=20, items=10, seed=0):
+    """产生 count 对 Request/Response 的 gor 数据包（未编码）
+    """
+    rnd = random.Random(seed)
+    timestamp = 1500000000000000000
+    for seq in range(count):
+        uuid = '%024x' % rnd.getrandbits(96)
+        path = '/interface/v1/endpoint%d?page=%d' % (rnd.randrange(endpoints), seq % 5)
+        timestamp += rnd.randrange(1000000000)
+        latency = rnd.randrange(1000000, 500000000)
+        yield ('1 %s %d\n' % (uuid, timestamp)).encode() + make_request(path)
+        yield ('2 %s %d %d\n' % (uuid, timestamp, latency)).encode() + make_response(make_body(rnd, items))
+
+
+def gor_stream(count, endpoints=20, items=10, seed=0):
+    """产生 hex 编码的 gor 数据流，每行一个数据包
+    """
+    lines = [binascii.hexlify(packet) for packet in gor_packets(count, endpoints, items, seed)]
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.stdout.buffer.write(gor_stream(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
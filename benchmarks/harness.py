@@ -0,0 +1,257 @@
+"""用模拟数据对各个工具做性能测试，结果保存为 JSON，便于比较不同版本
+
+    python -m benchmarks.harness -n 2000 -o results.json
+    python -m benchmarks.harness -n 2000 -o new.json --baseline results.json
+
+每项测试先计时（重复 repeat 次取最好成绩），再单独运行一次用 tracemalloc 测量内存峰值
+（tracemalloc 会拖慢速度，所以不和计时一起做）。指定 --baseline 时比较最好成绩，
+变慢超过 threshold 的测试会标出来，并以状态码 1 退出。
+"""
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+import yaml
+import apiutils
+from apiutils import apischema
+from apiutils.apiblue import ApiBlue
+from apiutils.apicapture import APICapture
+from apiutils.apigen import ApiGen
+from apiutils.apiman import ApiMan
+from apiutils.apiswagger import ApiSwagger
+from apiutils.apiview import ApiViewer
+from benchmarks.corpus import Corpus, corpus_options
+
+
+@contextlib.contextmanager
+def redirect_stdin(data):
+    """APICapture.run 从 stdin 读取数据（按行读取 sys.stdin，按块读取 sys.stdin.buffer）
+    """
+    stdin = sys.stdin
+    sys.stdin = io.TextIOWrapper(io.BytesIO(data), encoding='ascii')
+    try:
+        yield
+    finally:
+        sys.stdin = stdin
+
+
+class Context(object):
+    """各项测试共用的数据：模拟数据文件和输出目录
+    """
+    def __init__(self, corpus, work_dir):
+        self.corpus = corpus
+        self.work_dir = work_dir
+        self.gor_file, self.api_dir, self.apigen_file = corpus.write(os.path.join(work_dir, 'corpus'))
+        with open(self.gor_file, 'rb') as fp:
+            self.gor_data = fp.read()
+        with open(self.apigen_file, encoding='utf-8') as fp:
+            self.apigen_documents = list(yaml.safe_load_all(fp))
+        self.bodies = corpus.sample_bodies()
+        self.output_dir = os.path.join(work_dir, 'output')
+        os.makedirs(self.output_dir)
+
+    def output(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def fresh_dir(self, name):
+        path = self.output(name)
+        shutil.rmtree(path, ignore_errors=True)
+        return path
+
+
+# 每项测试是一个函数：参数为 Context，做好准备工作（不计时）后返回被测函数和处理的项数
+
+
+def bench_capture(ctx, block_size=0):
+    save_dir = ctx.fresh_dir('capture')
+
+    def run():
+        capture = APICapture((), (), save_dir, False, 1, 1024, block_size)
+        with redirect_stdin(ctx.gor_data):
+            capture.run()
+    return run, ctx.corpus.size
+
+
+def bench_capture_blocks(ctx):
+    return bench_capture(ctx, 1 << 20)
+
+
+def bench_view(ctx):
+    def run():
+        with open(os.devnull, 'w') as fp, contextlib.redirect_stdout(fp):
+            ApiViewer(3, [ctx.api_dir]).run()
+    return run, ctx.corpus.size
+
+
+def bench_blue(ctx):
+    def run():
+        with open(ctx.output('api.apib'), 'wb') as fp:
+            ApiBlue('API', 'http://{host}', 3, ctx.api_dir, fp).run()
+    return run, ctx.corpus.size
+
+
+def bench_man(ctx):
+    def run():
+        ApiMan('API', 'http://{host}', 3, ctx.api_dir, ctx.output('apiman.json')).run()
+    return run, ctx.corpus.size
+
+
+def bench_swagger(ctx):
+    def run():
+        ApiSwagger('API', 'http://{host}', 3, ctx.api_dir, ctx.output('apiswagger.json')).run()
+    return run, ctx.corpus.size
+
+
+def bench_gen(ctx):
+    # ApiGen.process 用的 yaml.load_all 在新版 PyYAML 中需要指定 Loader，这里直接处理解析好的文档，
+    # 只测量生成文档的开销
+    def run():
+        with open(ctx.output('apigen.yaml'), 'w', encoding='utf-8') as fp:
+            apigen = ApiGen(fp)
+            for document in ctx.apigen_documents:
+                apigen.process_obj(document)
+    return run, len(ctx.apigen_documents)
+
+
+def bench_schema(ctx):
+    def run():
+        for body in ctx.bodies:
+            apischema.build_schema(body)
+    return run, len(ctx.bodies)
+
+
+BENCHMARKS = [
+    ('apicapture', bench_capture),
+    ('apicapture-blocks', bench_capture_blocks),
+    ('apiview', bench_view),
+    ('apiblue', bench_blue),
+    ('apiman', bench_man),
+    ('apiswagger', bench_swagger),
+    ('apigen', bench_gen),
+    ('build_schema', bench_schema),
+]
+
+
+def measure(ctx, make_bench, repeat):
+    times = []
+    for _ in range(repeat):
+        func, items = make_bench(ctx)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    func, items = make_bench(ctx)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'items': items,
+        'times': times,
+        'best': best,
+        'items_per_second': items / best if best else None,
+        'peak_memory': peak,
+    }
+
+
+def git_revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def compare(results, baseline, threshold):
+    """返回变慢超过 threshold 的测试名称
+    """
+    regressions = []
+    print('%-18s %10s %10s %12s %8s' % ('benchmark', 'best', 'items/s', 'peak memory', 'vs base'),
+          file=sys.stderr)
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = result['best'] / base['best'] if base and base['best'] else None
+        mark = ''
+        if ratio is not None and ratio > 1 + threshold:
+            regressions.append(name)
+            mark = ' !'
+        print('%-18s %9.3fs %10.0f %10.1fMB %8s%s' % (
+            name, result['best'], result['items_per_second'] or 0, result['peak_memory'] / 1e6,
+            '%.2fx' % ratio if ratio is not None else '-', mark), file=sys.stderr)
+    return regressions
+
+
+@click.command()
+@corpus_options
+@click.option('--repeat', '-r', default=3, help='重复次数（取最好成绩）.')
+@click.option('--only', multiple=True, type=click.Choice([name for name, _ in BENCHMARKS]),
+              help='只运行指定的测试（允许指定多个）.')
+@click.option('--output', '-o', default=None, help='结果 JSON 文件名（默认输出到 stdout）.')
+@click.option('--baseline', '-b', default=None, type=click.File('r'), help='用于比较的上次结果 JSON 文件.')
+@click.option('--threshold', default=0.1, help='变慢超过这个比例时认为是性能下降.')
+@click.option('--work-dir', default=None, help='模拟数据和输出的目录（默认使用临时目录，结束后删除）.')
+def run(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed, repeat, only, output, baseline,
+        threshold, work_dir):
+    corpus = Corpus(size, endpoints, body_size, gzip_ratio, chunked_ratio, depth, seed)
+    if work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        cleanup = False
+    else:
+        work_dir = tempfile.mkdtemp(prefix='apiutils-bench-')
+        cleanup = True
+
+    try:
+        ctx = Context(corpus, work_dir)
+        results = {}
+        for name, make_bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            results[name] = measure(ctx, make_bench, repeat)
+            print('%-18s %9.3fs' % (name, results[name]['best']), file=sys.stderr)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'version': apiutils.__version__,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'corpus': corpus.params,
+        'repeat': repeat,
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if baseline:
+        base = json.load(baseline)
+        if base.get('corpus') != report['corpus']:
+            print('警告: 模拟数据的参数和 baseline 不同: %s' % base.get('corpus'), file=sys.stderr)
+        if compare(results, base.get('results', {}), threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
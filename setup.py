@@ -17,6 +17,7 @@ setup(
             [
                 'apicapture = apiutils.apicapture:run',
                 'apiview = apiutils.apiview:run',
+                'apiindex = apiutils.apiindex:run',
                 'apiswagger = apiutils.apiswagger:run',
                 'apischema = apiutils.apischema:run',
                 'apiblue = apiutils.apiblue:run',